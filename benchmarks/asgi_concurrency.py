@@ -0,0 +1,201 @@
+"""Benchmark requests/sec and memory per concurrent connection of running services.
+
+Compares e.g. the WSGI app under uWSGI with the ASGI app under uvicorn,
+both serving the same tenant config and DB. Each target is loaded with
+--concurrency keep-alive connections resolving --keys prefilled permalinks
+with Zipfian popularity for --duration seconds per concurrency level. If a
+PID is given for a target, the resident memory of the process and its
+children is sampled before and during the load.
+
+Usage:
+
+    uwsgi --http :5000 --processes 4 --threads 4 --wsgi-file src/server.py --callable app
+    uvicorn --app-dir src asgi:app --port 8000 --workers 1
+    python benchmarks/asgi_concurrency.py \\
+        --target wsgi=http://localhost:5000,<uwsgi master PID> \\
+        --target asgi=http://localhost:8000,<uvicorn PID> \\
+        --concurrency 10 --concurrency 100 --concurrency 500
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+import urllib.request
+from urllib.parse import urlencode, urlparse, parse_qs
+
+
+def percentiles(latencies):
+    """Return dict with latency percentiles in ms."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": round(quantiles[49] * 1000, 3),
+        "p95": round(quantiles[94] * 1000, 3),
+        "p99": round(quantiles[98] * 1000, 3),
+        "mean": round(statistics.mean(latencies) * 1000, 3)
+    }
+
+
+def process_tree(pid):
+    """Return PIDs of a process and all its descendants."""
+    pids = [pid]
+    for pid in pids:
+        for task in os.listdir('/proc/%d/task' % pid):
+            try:
+                with open('/proc/%d/task/%s/children' % (pid, task)) as fh:
+                    pids += [int(child) for child in fh.read().split()]
+            except OSError:
+                pass
+    return pids
+
+
+def rss_kib(pid):
+    """Return resident memory in KiB of a process and its descendants."""
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open('/proc/%d/status' % child) as fh:
+                for line in fh:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def create_permalinks(base_url, count, rng):
+    """Create permalinks, return their keys."""
+    keys = []
+    for i in range(count):
+        state = {"layers": [{"name": "layer_%d" % j, "visibility": rng.random() < 0.5} for j in range(30)]}
+        req = urllib.request.Request(
+            base_url + '/createpermalink?' + urlencode({'url': 'https://example.com/?t=theme_1'}),
+            json.dumps(state).encode('utf-8'), {'Content-Type': 'application/json'}, method='POST'
+        )
+        with urllib.request.urlopen(req) as response:
+            permalink = json.loads(response.read())["permalink"]
+        keys.append(parse_qs(urlparse(permalink).query)['k'][0])
+    return keys
+
+
+async def connection_loop(base_url, paths, deadline, latencies, errors):
+    """Send requests on a keep-alive connection until the deadline."""
+    url = urlparse(base_url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        while time.monotonic() < deadline:
+            path = url.path.rstrip('/') + next(paths)
+            start = time.perf_counter()
+            writer.write((
+                "GET %s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n" % (path, url.netloc)
+            ).encode('latin-1'))
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            close = False
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, value = line.split(':', 1)
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'connection' and value.strip().lower() == 'close':
+                    close = True
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors.append(status)
+            if close:
+                writer.close()
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    finally:
+        writer.close()
+
+
+async def load(base_url, paths, concurrency, duration, pid):
+    """Load target with concurrent connections, return dict with results."""
+    latencies = []
+    errors = []
+    rss_idle = rss_kib(pid) if pid else None
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    tasks = [
+        asyncio.create_task(connection_loop(base_url, paths, deadline, latencies, errors))
+        for i in range(concurrency)
+    ]
+    # sample memory while loaded
+    rss_samples = []
+    while pid and not all(task.done() for task in tasks):
+        await asyncio.sleep(min(0.5, duration / 4))
+        rss_samples.append(rss_kib(pid))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors) + sum(1 for r in results if isinstance(r, Exception)),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms": percentiles(latencies) if len(latencies) > 1 else None
+    }
+    if pid:
+        rss_load = max(rss_samples) if rss_samples else rss_kib(pid)
+        result |= {
+            "rss_idle_kib": rss_idle,
+            "rss_load_kib": rss_load,
+            "rss_per_connection_kib": round((rss_load - rss_idle) / concurrency, 1)
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--target', dest='targets', action='append', required=True,
+        help="Target as <name>=<base URL>[,<PID>], can be repeated"
+    )
+    parser.add_argument(
+        '--concurrency', dest='concurrencies', type=int, action='append',
+        help="Number of concurrent connections, can be repeated (default: 10, 100)"
+    )
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per concurrency level")
+    parser.add_argument('--keys', type=int, default=1000, help="Number of prefilled permalinks")
+    parser.add_argument('--zipf-s', type=float, default=1.1, help="Exponent of Zipfian key popularity")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    targets = []
+    for target in args.targets:
+        name, spec = target.split('=', 1)
+        base_url, _, pid = spec.partition(',')
+        targets.append((name, base_url, int(pid) if pid else None))
+
+    rng = random.Random(args.seed)
+    # all targets are expected to use the same DB
+    keys = create_permalinks(targets[0][1], args.keys, rng)
+    cum_weights = list(itertools.accumulate(1 / (rank ** args.zipf_s) for rank in range(1, len(keys) + 1)))
+    samples = rng.choices(keys, cum_weights=cum_weights, k=100000)
+    paths = ['/resolvepermalink?' + urlencode({'key': key}) for key in samples]
+
+    results = {}
+    for name, base_url, pid in targets:
+        results[name] = []
+        for concurrency in args.concurrencies or [10, 100]:
+            results[name].append(asyncio.run(
+                load(base_url, itertools.cycle(paths), concurrency, args.duration, pid)
+            ))
+
+    print(json.dumps({
+        "duration": args.duration,
+        "keys": args.keys,
+        "targets": {name: base_url for name, base_url, pid in targets},
+        "results": results
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Benchmark bookmark list queries on a large bookmarks table.
+
+Compares the legacy list query, which resolves the user ID with a CTE on
+the users table, with the UNION ALL query of own and public bookmarks
+using a cached :user_id, on scratch tables prefilled with --rows
+bookmarks of --users users.
+
+Usage:
+
+    python benchmarks/bookmark_queries.py --db-url postgresql:///?service=qwc_configdb --rows 1000000
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+
+LEGACY_SQL = """
+    WITH "user" AS (
+        SELECT id FROM {users_table} WHERE name=:username
+    )
+    SELECT key, description, to_char(date, 'YYYY-MM-DD') as date, theme_id, public, COALESCE(user_id = (SELECT id FROM "user"), FALSE) as own
+    FROM {table}
+    WHERE user_id = (SELECT id FROM "user") OR public = TRUE
+    ORDER BY date DESC, description
+"""
+
+USER_ID_SQL = """
+    SELECT key, description, to_char(date, 'YYYY-MM-DD') as date, theme_id, public, own
+    FROM (
+        SELECT *, TRUE AS own FROM {table}
+        WHERE user_id = :user_id
+        UNION ALL
+        SELECT *, FALSE AS own FROM {table}
+        WHERE public = TRUE AND NOT COALESCE(user_id = :user_id, FALSE)
+    ) b
+    ORDER BY b.date DESC NULLS FIRST, b.description ASC NULLS LAST, b.key ASC NULLS LAST
+"""
+
+
+def percentiles(latencies):
+    """Return dict with latency percentiles in ms."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": round(quantiles[49] * 1000, 3),
+        "p95": round(quantiles[94] * 1000, 3),
+        "p99": round(quantiles[98] * 1000, 3),
+        "mean": round(statistics.mean(latencies) * 1000, 3)
+    }
+
+
+def plan(connection, sql, params):
+    """Return EXPLAIN ANALYZE output of a query as list of lines."""
+    result = connection.execute(sql_text("EXPLAIN (ANALYZE, BUFFERS) " + sql.text), params)
+    return [row[0] for row in result]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-url', default='postgresql:///?service=qwc_configdb')
+    parser.add_argument('--schema', default='bench_bookmarks', help="Scratch schema (dropped afterwards)")
+    parser.add_argument('--rows', type=int, default=1000000, help="Number of bookmarks")
+    parser.add_argument('--users', type=int, default=10000, help="Number of users")
+    parser.add_argument('--public-ratio', type=float, default=0.001, help="Ratio of public bookmarks")
+    parser.add_argument('--queries', type=int, default=500, help="Number of measured queries")
+    parser.add_argument('--keep', action='store_true', help="Keep scratch schema")
+    args = parser.parse_args()
+
+    db = create_engine(args.db_url)
+    users_table = '"%s"."users"' % args.schema
+    table = '"%s"."user_bookmarks"' % args.schema
+
+    with db.begin() as connection:
+        connection.execute(sql_text('DROP SCHEMA IF EXISTS "%s" CASCADE' % args.schema))
+        connection.execute(sql_text('CREATE SCHEMA "%s"' % args.schema))
+        connection.execute(sql_text("""
+            CREATE TABLE {users_table} (id serial PRIMARY KEY, name varchar NOT NULL UNIQUE)
+        """.format(users_table=users_table)))
+        connection.execute(sql_text("""
+            CREATE TABLE {table} (
+                user_id integer, username varchar, data text, key varchar(10),
+                date date, description text, theme_id varchar, public boolean DEFAULT FALSE
+            )
+        """.format(table=table)))
+        connection.execute(sql_text("""
+            INSERT INTO {users_table} (name)
+            SELECT 'user' || i FROM generate_series(1, :users) AS i
+        """.format(users_table=users_table)), {"users": args.users})
+        connection.execute(sql_text("""
+            INSERT INTO {table} (user_id, username, data, key, date, description, public)
+            SELECT u, 'user' || u, repeat('x', 500), substr(md5(i::text), 1, 9),
+                CURRENT_DATE - (i % 1000), 'bookmark ' || i, random() < :public_ratio
+            FROM generate_series(1, :rows) AS i, LATERAL (SELECT 1 + (i % :users) AS u) AS s
+        """.format(table=table)), {
+            "rows": args.rows, "users": args.users, "public_ratio": args.public_ratio
+        })
+        connection.execute(sql_text("CREATE INDEX ON {table} (user_id)".format(table=table)))
+        connection.execute(sql_text(
+            "CREATE INDEX ON {table} (date) WHERE public".format(table=table)
+        ))
+        connection.execute(sql_text("ANALYZE {table}".format(table=table)))
+        connection.execute(sql_text("ANALYZE {users_table}".format(users_table=users_table)))
+
+    legacy_sql = sql_text(LEGACY_SQL.format(users_table=users_table, table=table))
+    user_id_sql = sql_text(USER_ID_SQL.format(table=table))
+
+    usernames = ['user%d' % random.randint(1, args.users) for i in range(args.queries)]
+    # user IDs as cached by the service
+    with db.connect() as connection:
+        user_ids = dict(connection.execute(sql_text(
+            "SELECT name, id FROM {users_table}".format(users_table=users_table)
+        )).all())
+
+    results = {}
+    with db.connect() as connection:
+        for name, sql, params in [
+            ("legacy", legacy_sql, lambda username: {"username": username}),
+            ("user_id", user_id_sql, lambda username: {"user_id": user_ids[username]})
+        ]:
+            # warm up
+            for username in usernames[:20]:
+                connection.execute(sql, params(username)).all()
+            latencies = []
+            for username in usernames:
+                start = time.perf_counter()
+                connection.execute(sql, params(username)).all()
+                latencies.append(time.perf_counter() - start)
+            results[name] = {
+                "latency_ms": percentiles(latencies),
+                "plan": plan(connection, sql, params(usernames[0]))
+            }
+
+    if not args.keep:
+        with db.begin() as connection:
+            connection.execute(sql_text('DROP SCHEMA "%s" CASCADE' % args.schema))
+
+    print(json.dumps({
+        "rows": args.rows,
+        "users": args.users,
+        "public_ratio": args.public_ratio,
+        "queries": args.queries
+    } | results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
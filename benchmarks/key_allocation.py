@@ -0,0 +1,136 @@
+"""Benchmark insert latency of permalink key allocation on a large table.
+
+Compares the legacy sha224 retry loop (one transaction per attempt) with
+the single round trip KeyAllocator, on a scratch copy of the permalinks
+table prefilled with --rows keys.
+
+Usage:
+
+    python benchmarks/key_allocation.py --db-url postgresql:///?service=qwc_configdb --rows 10000000
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from key_allocator import KeyAllocator
+
+
+def percentiles(latencies):
+    """Return dict with latency percentiles in ms."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": round(quantiles[49] * 1000, 3),
+        "p95": round(quantiles[94] * 1000, 3),
+        "p99": round(quantiles[98] * 1000, 3),
+        "mean": round(statistics.mean(latencies) * 1000, 3)
+    }
+
+
+def legacy_insert(db, table, datastr, date):
+    """Insert as done before KeyAllocator, return number of attempts."""
+    sql = sql_text("""
+        INSERT INTO {table} (key, data, date, expires, permitted_group)
+        VALUES (:key, :data, :date, NULL, NULL)
+    """.format(table=table))
+    hexdigest = hashlib.sha224((datastr + str(time.time())).encode('utf-8')).hexdigest()[0:9]
+    attempts = 0
+    while attempts < 100:
+        try:
+            with db.begin() as connection:
+                connection.execute(sql, {"key": hexdigest, "data": datastr, "date": date})
+            break
+        except Exception:
+            pass
+        hexdigest = hashlib.sha224((datastr + str(random.random())).encode('utf-8')).hexdigest()[0:9]
+        attempts += 1
+    return attempts + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-url', default='postgresql:///?service=qwc_configdb')
+    parser.add_argument('--table', default='public.permalinks_key_bench')
+    parser.add_argument('--rows', type=int, default=10000000, help='Number of prefilled rows')
+    parser.add_argument('--inserts', type=int, default=2000, help='Number of measured inserts per variant')
+    parser.add_argument('--key-length', type=int, default=9)
+    parser.add_argument('--key-alphabet', default='hex')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch table')
+    args = parser.parse_args()
+
+    db = create_engine(args.db_url)
+    table = args.table
+    with db.begin() as connection:
+        connection.execute(sql_text("""
+            CREATE TABLE IF NOT EXISTS {table} (
+              key character(10) NOT NULL PRIMARY KEY,
+              data text, date date, expires date, permitted_group varchar
+            )
+        """.format(table=table)))
+        count = connection.execute(sql_text("SELECT count(*) FROM {table}".format(table=table))).scalar()
+    if count < args.rows:
+        print("Prefilling %s with %d rows..." % (table, args.rows - count), file=sys.stderr)
+        start = time.perf_counter()
+        with db.begin() as connection:
+            connection.execute(sql_text("""
+                INSERT INTO {table} (key, data, date)
+                SELECT substr(md5(i::text || random()::text), 1, :length), '{{}}', CURRENT_DATE
+                FROM generate_series(1, :rows) AS i
+                ON CONFLICT DO NOTHING
+            """.format(table=table)), {"length": args.key_length, "rows": args.rows - count})
+        print("Prefilled in %.1fs" % (time.perf_counter() - start), file=sys.stderr)
+
+    datastr = json.dumps({"query": {"t": "theme"}, "state": {"layers": list(range(50))}})
+    date = datetime.date.today().strftime(r"%Y-%m-%d")
+
+    legacy_latencies = []
+    legacy_attempts = []
+    for i in range(args.inserts):
+        start = time.perf_counter()
+        legacy_attempts.append(legacy_insert(db, table, datastr, date))
+        legacy_latencies.append(time.perf_counter() - start)
+
+    allocator = KeyAllocator(args.key_length, args.key_alphabet)
+    sql = sql_text("""
+        INSERT INTO {table} (key, data, date, expires, permitted_group)
+        VALUES (:key, :data, :date, NULL, NULL)
+        ON CONFLICT DO NOTHING
+        RETURNING key
+    """.format(table=table))
+    allocator_latencies = []
+    for i in range(args.inserts):
+        start = time.perf_counter()
+        with db.begin() as connection:
+            allocator.insert(connection, sql, {"data": datastr, "date": date})
+        allocator_latencies.append(time.perf_counter() - start)
+
+    with db.connect() as connection:
+        rows = connection.execute(sql_text("SELECT count(*) FROM {table}".format(table=table))).scalar()
+    if not args.keep:
+        with db.begin() as connection:
+            connection.execute(sql_text("DROP TABLE {table}".format(table=table)))
+
+    print(json.dumps({
+        "rows": rows,
+        "legacy": {
+            "latency_ms": percentiles(legacy_latencies),
+            "mean_attempts": statistics.mean(legacy_attempts)
+        },
+        "allocator": {
+            "latency_ms": percentiles(allocator_latencies),
+            **allocator.stats()
+        }
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
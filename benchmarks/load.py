@@ -0,0 +1,407 @@
+"""Load benchmark of the permalink service API.
+
+Drives the Flask app in-process through FlaskClient, or a running service
+over HTTP with --url, with synthetic QWC2 sized state payloads and Zipfian
+key popularity. Scenarios:
+
+    create_resolve  mix of /createpermalink and /resolvepermalink of --keys
+                    prefilled permalinks (--resolve-ratio)
+    bookmark_list   GET /bookmarks/ with --public-bookmarks public bookmarks
+    bookmark_crud   POST, GET, PUT and DELETE of a bookmark
+
+Reports latency percentiles per operation, throughput and the peak memory
+allocated per request (measured with tracemalloc in a separate pass) as
+JSON, optionally saved with --output. With --baseline, results are compared
+with a previous result and the exit code is 1 if any metric regressed by
+more than --tolerance.
+
+In-process runs use the tenant config of $CONFIG_PATH. To run without a
+ConfigDB, use the SQLite or memory storage backend, e.g.:
+
+    STORAGE_BACKEND=memory CONFIG_PATH=<CONFIG_PATH> python benchmarks/load.py --output baseline.json
+    STORAGE_BACKEND=memory CONFIG_PATH=<CONFIG_PATH> python benchmarks/load.py --baseline baseline.json
+
+Over HTTP, pass a JWT for the benchmark user with --token. Public
+bookmarks are then created through the API and require the
+public_bookmarks permission for this user.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode, urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+
+def percentiles(latencies):
+    """Return dict with latency percentiles in ms."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": round(quantiles[49] * 1000, 3),
+        "p95": round(quantiles[94] * 1000, 3),
+        "p99": round(quantiles[98] * 1000, 3),
+        "mean": round(statistics.mean(latencies) * 1000, 3)
+    }
+
+
+def zipf_sampler(rng, count, s):
+    """Return function returning indexes in range(count) with Zipfian
+    popularity, index 0 being the most popular."""
+    cum_weights = list(itertools.accumulate(1 / (rank ** s) for rank in range(1, count + 1)))
+    population = range(count)
+    return lambda: rng.choices(population, cum_weights=cum_weights)[0]
+
+
+def qwc2_state(rng, layers):
+    """Return synthetic QWC2 map state with a number of theme layers."""
+    sublayers = [
+        {
+            "name": "layer_%d" % i,
+            "title": "Layer %d" % i,
+            "visibility": rng.random() < 0.5,
+            "opacity": rng.choice([255, 200, 128]),
+            "queryable": True
+        }
+        for i in range(layers)
+    ]
+    return {
+        "layers": [
+            {
+                "id": "theme_%d" % rng.randint(1, 20),
+                "type": "wms",
+                "url": "https://example.com/ows/theme_%d" % rng.randint(1, 20),
+                "role": 2,
+                "params": {
+                    "LAYERS": ",".join(layer["name"] for layer in sublayers if layer["visibility"]),
+                    "OPACITIES": ",".join(str(layer["opacity"]) for layer in sublayers)
+                },
+                "sublayers": sublayers
+            },
+            {"id": "bg_osm", "type": "osm", "role": 1, "visibility": True}
+        ],
+        "objects": {"annotations": []},
+        "view": {
+            "center": [2600000 + rng.random() * 1000, 1200000 + rng.random() * 1000],
+            "scale": rng.choice([1000, 5000, 25000, 100000])
+        },
+        "permalinkParams": {"t": "theme_1", "bl": "bg_osm"}
+    }
+
+
+class FlaskClientSession:
+    """Requests to the Flask app in-process."""
+
+    def __init__(self, username):
+        from flask import Response
+        from flask.testing import FlaskClient
+        from flask_jwt_extended import JWTManager, create_access_token
+        import server
+
+        server.app.testing = True
+        if not server.app.config.get('JWT_SECRET_KEY'):
+            server.app.config['JWT_SECRET_KEY'] = os.urandom(16).hex()
+            JWTManager(server.app)
+        self.server = server
+        self.client = FlaskClient(server.app, Response)
+        with server.app.app_context():
+            self.headers = {'Authorization': 'Bearer ' + create_access_token(username)}
+
+    def request(self, method, path, data=None):
+        """Return status code and JSON response of a request."""
+        response = self.client.open(
+            path, method=method, headers=self.headers,
+            data=json.dumps(data) if data is not None else None,
+            content_type='application/json' if data is not None else None
+        )
+        return response.status_code, response.get_json(silent=True)
+
+    def insert_public_bookmarks(self, count, state, owner):
+        """Store public bookmarks of another user directly in the storage."""
+        with self.server.app.test_request_context('/'):
+            ctx = self.server.tenant_context()
+        date = datetime.date.today().isoformat()
+        datastr = ctx.storage_codec.encode({"query": {}, "state": state})
+        for i in range(count):
+            ctx.storage.insert_bookmark(
+                'bookmarks', owner, datastr, date, "public bookmark %d" % i, None, True
+            )
+
+
+class HttpSession:
+    """Requests to a running service over HTTP."""
+
+    def __init__(self, base_url, token):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': 'Bearer ' + token} if token else {}
+
+    def request(self, method, path, data=None):
+        """Return status code and JSON response of a request."""
+        headers = dict(self.headers)
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, body, headers, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, content = e.code, e.read()
+        try:
+            return status, json.loads(content)
+        except ValueError:
+            return status, None
+
+    def insert_public_bookmarks(self, count, state, owner):
+        """Store public bookmarks of the benchmark user through the API."""
+        for i in range(count):
+            self.request('POST', '/bookmarks/?' + urlencode({
+                'url': 'https://example.com/?t=theme_1',
+                'description': 'public bookmark %d' % i, 'public': 'true'
+            }), state)
+
+
+class Recorder:
+    """Latencies, errors and allocations per operation."""
+
+    def __init__(self, session, trace):
+        self.session = session
+        self.trace = trace
+        # latencies[<op>] = [<seconds>]
+        self.latencies = {}
+        # allocations[<op>] = [<bytes>]
+        self.allocations = {}
+        self.errors = 0
+
+    def call(self, op, method, path, data=None):
+        """Send request and record latency, or peak allocations if tracing."""
+        if self.trace:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        status, result = self.session.request(method, path, data)
+        duration = time.perf_counter() - start
+        if self.trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.allocations.setdefault(op, []).append(peak - base)
+        else:
+            self.latencies.setdefault(op, []).append(duration)
+        if status >= 400 or (isinstance(result, dict) and result.get("success") is False):
+            self.errors += 1
+        return result
+
+
+def create_permalink(recorder, state, op="create"):
+    """Create permalink, return its key or None."""
+    result = recorder.call(op, 'POST', '/createpermalink?' + urlencode({
+        'url': 'https://example.com/?t=theme_1&bl=bg_osm'
+    }), state)
+    if result and "permalink" in result:
+        return parse_qs(urlparse(result["permalink"]).query)['k'][0]
+    return None
+
+
+def scenario_create_resolve(args, rng, states):
+    """Return setup and step functions of the create/resolve mix."""
+    keys = []
+    sample = zipf_sampler(rng, args.keys, args.zipf_s)
+
+    def setup(recorder):
+        for i in range(args.keys):
+            keys.append(create_permalink(recorder, states[i % len(states)], "setup"))
+
+    def step(recorder):
+        if rng.random() < args.resolve_ratio:
+            key = keys[sample()]
+            recorder.call('resolve', 'GET', '/resolvepermalink?' + urlencode({'key': key}))
+        else:
+            create_permalink(recorder, rng.choice(states))
+
+    return setup, step
+
+
+def scenario_bookmark_list(args, rng, states):
+    """Return setup and step functions of listing bookmarks."""
+
+    def setup(recorder):
+        recorder.session.insert_public_bookmarks(args.public_bookmarks, states[0], "bench-owner")
+        for i in range(args.own_bookmarks):
+            recorder.call('setup', 'POST', '/bookmarks/?' + urlencode({
+                'url': 'https://example.com/?t=theme_1', 'description': 'own bookmark %d' % i
+            }), rng.choice(states))
+
+    def step(recorder):
+        recorder.call('list', 'GET', '/bookmarks/')
+
+    return setup, step
+
+
+def scenario_bookmark_crud(args, rng, states):
+    """Return setup and step functions of bookmark CRUD."""
+
+    def setup(recorder):
+        pass
+
+    def step(recorder):
+        result = recorder.call('create', 'POST', '/bookmarks/?' + urlencode({
+            'url': 'https://example.com/?t=theme_1', 'description': 'bookmark'
+        }), rng.choice(states))
+        key = result.get("key") if result else None
+        if not key:
+            return
+        recorder.call('get', 'GET', '/bookmarks/' + key)
+        recorder.call('update', 'PUT', '/bookmarks/%s?%s' % (key, urlencode({
+            'url': 'https://example.com/?t=theme_2', 'description': 'updated bookmark'
+        })), rng.choice(states))
+        recorder.call('delete', 'DELETE', '/bookmarks/' + key)
+
+    return setup, step
+
+
+SCENARIOS = {
+    'create_resolve': scenario_create_resolve,
+    'bookmark_list': scenario_bookmark_list,
+    'bookmark_crud': scenario_bookmark_crud
+}
+
+
+def run_scenario(args, session, name):
+    """Run scenario, return dict with results."""
+    rng = random.Random(args.seed)
+    states = [qwc2_state(rng, args.payload_layers) for i in range(50)]
+    setup, step = SCENARIOS[name](args, rng, states)
+
+    recorder = Recorder(session, False)
+    setup(recorder)
+    # warm up
+    for i in range(args.warmup):
+        step(recorder)
+
+    recorder = Recorder(session, False)
+    start = time.perf_counter()
+    for i in range(args.requests):
+        step(recorder)
+    elapsed = time.perf_counter() - start
+
+    tracer = Recorder(session, True)
+    tracemalloc.start()
+    try:
+        for i in range(args.alloc_requests):
+            step(tracer)
+    finally:
+        tracemalloc.stop()
+
+    requests = sum(len(latencies) for latencies in recorder.latencies.values())
+    return {
+        "requests": requests,
+        "errors": recorder.errors,
+        "throughput_rps": round(requests / elapsed, 1),
+        "ops": {
+            op: {
+                "count": len(latencies),
+                "latency_ms": percentiles(latencies),
+                "alloc_peak_kib": round(
+                    statistics.mean(tracer.allocations[op]) / 1024, 1
+                ) if tracer.allocations.get(op) else None
+            }
+            for op, latencies in sorted(recorder.latencies.items())
+        }
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions of results compared to baseline."""
+    regressions = []
+    for name, scenario in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        if scenario["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append({
+                "scenario": name, "metric": "throughput_rps",
+                "baseline": base["throughput_rps"], "value": scenario["throughput_rps"]
+            })
+        for op, values in scenario["ops"].items():
+            base_op = base["ops"].get(op)
+            if not base_op:
+                continue
+            for metric in ["p50", "p95", "p99"]:
+                value = values["latency_ms"][metric]
+                if value > base_op["latency_ms"][metric] * (1 + tolerance):
+                    regressions.append({
+                        "scenario": name, "op": op, "metric": metric,
+                        "baseline": base_op["latency_ms"][metric], "value": value
+                    })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--scenario', dest='scenarios', action='append', choices=list(SCENARIOS),
+        help="Scenario to run, can be repeated (default: all scenarios)"
+    )
+    parser.add_argument('--url', help="Base URL of a running service (default: in-process)")
+    parser.add_argument('--token', help="JWT of the benchmark user for --url")
+    parser.add_argument('--username', default='bench', help="Benchmark user for in-process runs")
+    parser.add_argument('--requests', type=int, default=2000, help="Number of measured steps per scenario")
+    parser.add_argument('--warmup', type=int, default=100, help="Number of warm up steps per scenario")
+    parser.add_argument('--alloc-requests', type=int, default=100, help="Number of steps traced for allocations")
+    parser.add_argument('--keys', type=int, default=1000, help="Number of prefilled permalinks")
+    parser.add_argument('--zipf-s', type=float, default=1.1, help="Exponent of Zipfian key popularity")
+    parser.add_argument('--resolve-ratio', type=float, default=0.9, help="Ratio of resolves in create/resolve mix")
+    parser.add_argument('--public-bookmarks', type=int, default=500, help="Number of public bookmarks")
+    parser.add_argument('--own-bookmarks', type=int, default=20, help="Number of own bookmarks")
+    parser.add_argument('--payload-layers', type=int, default=30, help="Number of layers in state payloads")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Save results as JSON file")
+    parser.add_argument('--baseline', help="Compare with results JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Max relative regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.url:
+        session = HttpSession(args.url, args.token)
+    else:
+        session = FlaskClientSession(args.username)
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "target": args.url or "in-process",
+            "storage_backend": os.environ.get('STORAGE_BACKEND'),
+            "requests": args.requests,
+            "seed": args.seed,
+            "payload_bytes": len(json.dumps(qwc2_state(random.Random(args.seed), args.payload_layers)))
+        },
+        "scenarios": {
+            name: run_scenario(args, session, name)
+            for name in args.scenarios or SCENARIOS
+        }
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        results["regressions"] = regressions
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    print(json.dumps(results, indent=2))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
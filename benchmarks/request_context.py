@@ -0,0 +1,94 @@
+"""Benchmark the per-request overhead of looking up tenant config, tables and SQL.
+
+Compares the legacy setup (re-reading the tenant config, resolving tables
+and building the statement on every request) with the per-tenant
+TenantContext. No DB connection is made.
+
+Usage:
+
+    CONFIG_PATH=<CONFIG_PATH> python benchmarks/request_context.py [--requests 10000]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy.sql import bindparam, text as sql_text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+import server
+from db_connection import db_conn
+
+
+def percentiles(latencies):
+    """Return dict with latency percentiles in µs."""
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": round(quantiles[49] * 1e6, 2),
+        "p95": round(quantiles[94] * 1e6, 2),
+        "p99": round(quantiles[98] * 1e6, 2),
+        "mean": round(statistics.mean(latencies) * 1e6, 2)
+    }
+
+
+def legacy_setup():
+    """Request setup of /resolvepermalink as done before TenantContext."""
+    tenant = server.tenant_handler.tenant()
+    config = server.config_handler.tenant_config(tenant)
+    db, qwc_config_schema, users_table = db_conn(config)
+    permalinks_table = config.get('permalinks_table', qwc_config_schema + '.permalinks')
+    return sql_text("""
+        SELECT key, data, permitted_group, expires
+        FROM {table}
+        WHERE key IN :keys AND (expires IS NULL OR expires >= CURRENT_DATE)
+    """.format(table=permalinks_table)).bindparams(bindparam("keys", expanding=True))
+
+
+def context_setup():
+    """Request setup of /resolvepermalink with TenantContext."""
+    ctx = server.tenant_context()
+    storage = ctx.storage
+    return storage.statement(('resolve_permalinks',), lambda: sql_text("""
+        SELECT key, data, permitted_group, expires
+        FROM {table}
+        WHERE key IN :keys AND (expires IS NULL OR expires >= CURRENT_DATE)
+    """.format(table=storage.tables['permalinks'])).bindparams(bindparam("keys", expanding=True)))
+
+
+def measure(setup, requests):
+    """Return list of setup latencies in seconds."""
+    latencies = []
+    with server.app.test_request_context('/resolvepermalink?key=0123456789'):
+        for i in range(requests):
+            start = time.perf_counter()
+            setup()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--requests', type=int, default=10000,
+        help="Number of measured requests (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    # warm up
+    measure(legacy_setup, 100)
+    measure(context_setup, 100)
+
+    legacy_latencies = measure(legacy_setup, args.requests)
+    context_latencies = measure(context_setup, args.requests)
+
+    print(json.dumps({
+        "requests": args.requests,
+        "legacy": {"latency_us": percentiles(legacy_latencies)},
+        "context": {"latency_us": percentiles(context_latencies)}
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
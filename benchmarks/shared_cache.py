@@ -0,0 +1,127 @@
+"""Benchmark hit rate and memory per pod of per-process and shared resolve caches.
+
+Simulates --workers worker processes, e.g. uWSGI processes of a pod, which
+are sent Zipfian distributed resolves of --keys permalinks round robin.
+Each miss stores the entry, as when resolving from the DB. Compares
+per-process TTLCaches of --cache-size entries with a shared mmap cache
+with the same number of entries per pod.
+
+Memory per pod is the sum of the private memory growth of the workers
+and, for the shared cache, the allocated size of the cache file.
+
+Usage:
+
+    python benchmarks/shared_cache.py --workers 8 --keys 100000 --cache-size 1000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+from caches import TTLCache
+from shared_cache import MmapTable, SharedCache
+
+
+def private_kib():
+    """Return private resident memory in KiB of this process."""
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    return 0
+
+
+def entry(key, size):
+    """Return resolve cache entry with a payload of size bytes."""
+    return {
+        "body": b'{"state":"%s"}' % (b'x' * size),
+        "permitted_group": None,
+        "expires": None,
+        "etag": "%032x" % key
+    }
+
+
+def worker(mode, path, args, requests, queue):
+    """Serve requests, put (hits, misses, private memory growth in KiB)."""
+    if mode == 'shared':
+        cache = SharedCache(
+            MmapTable(path, args.cache_size * args.workers, args.slot_size),
+            "default:resolve", args.cache_size, 300
+        )
+    else:
+        cache = TTLCache(args.cache_size, 300)
+    rss = private_kib()
+    hits = 0
+    for key in requests:
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.set(key, entry(key, args.payload_size))
+    queue.put((hits, len(requests) - hits, private_kib() - rss))
+
+
+def run(mode, args, requests):
+    """Run workers, return dict with results."""
+    path = os.path.join(args.dir, 'qwc-permalink-benchmark-cache')
+    if os.path.exists(path):
+        os.unlink(path)
+    queue = multiprocessing.Queue()
+    start = time.perf_counter()
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(mode, path, args, requests[i::args.workers], queue)
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    results = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    hits = sum(result[0] for result in results)
+    memory = sum(result[2] for result in results)
+    if mode == 'shared':
+        memory += os.stat(path).st_blocks * 512 // 1024
+        os.unlink(path)
+    return {
+        "hit_rate": round(hits / len(requests), 4),
+        "memory_per_pod_kib": memory,
+        "requests_per_sec": round(len(requests) / elapsed, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8, help="Number of worker processes")
+    parser.add_argument('--keys', type=int, default=100000, help="Number of permalinks")
+    parser.add_argument('--requests', type=int, default=400000, help="Total number of resolves")
+    parser.add_argument('--cache-size', type=int, default=1000, help="Cache entries per worker")
+    parser.add_argument('--payload-size', type=int, default=1500, help="Payload size in bytes")
+    parser.add_argument('--slot-size', type=int, default=4096, help="Shared cache slot size")
+    parser.add_argument('--zipf-s', type=float, default=1.1, help="Exponent of Zipfian key popularity")
+    parser.add_argument('--dir', default='/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    weights = [1 / (rank ** args.zipf_s) for rank in range(1, args.keys + 1)]
+    requests = rng.choices(range(args.keys), weights=weights, k=args.requests)
+
+    print(json.dumps({
+        "workers": args.workers,
+        "keys": args.keys,
+        "requests": args.requests,
+        "cache_size_per_worker": args.cache_size,
+        "results": {mode: run(mode, args, requests) for mode in ('per_process', 'shared')}
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""ASGI entry point of the QWC Permalink Service.
+
+Serves the same routes as the WSGI app in server.py. Resolving permalinks,
+reading bookmarks and visibility presets and the health check run as async
+handlers, with PostgreSQL queries on an async DB engine with a connection
+pool shared by all tenants. Blocking steps of these handlers, e.g. JWT
+verification, tenant setup, permission lookups and queries of delta bases,
+run in worker threads. All other requests are passed to the WSGI app in
+worker threads.
+
+Config, tenant, auth handling and responses are those of the WSGI app.
+
+Usage:
+
+    uvicorn --app-dir src asgi:app
+"""
+import asyncio
+import io
+import sys
+import weakref
+
+from flask import g, request, jsonify, make_response
+from flask_jwt_extended import verify_jwt_in_request
+from qwc_services_core.auth import get_identity, get_username
+from qwc_services_core.tenant_handler import TenantPrefixMiddleware
+
+import request_profiler
+import server
+from async_storage import create_async_storage, dispose_async_engines
+from health_check import pool_status
+from storage_codec import StorageCodec
+
+
+# async_storages[<TenantContext>] = <AsyncStorage>
+async_storages = weakref.WeakKeyDictionary()
+
+# Adds the tenant path prefix to a WSGI environ, as for the WSGI app
+tenant_environ = TenantPrefixMiddleware(lambda environ, start_response: environ)
+
+# min size in bytes of the chunks of a streamed response body
+STREAM_CHUNK_SIZE = 65536
+
+
+class StreamingResponse(server.app.response_class):
+    """ Response whose body is sent in chunks of an async iterator """
+
+    def __init__(self, chunks, **kwargs):
+        """ Constructor
+
+        :param AsyncIterator chunks: Body chunks as bytes
+        """
+        super().__init__(**kwargs)
+        # NOTE: an iterator without length marks the response as streamed
+        self.response = chunks
+
+
+async def tenant_context():
+    """ Return the context of the current tenant, set up in a worker thread """
+    return await asyncio.to_thread(server.tenant_context)
+
+
+def async_storage(ctx):
+    """ Return async storage of a tenant context """
+    storage = async_storages.get(ctx)
+    if storage is None:
+        storage = async_storages[ctx] = create_async_storage(ctx)
+        for engine in (getattr(storage, 'engine', None), getattr(storage, 'engine_readonly', None)):
+            if engine is not None:
+                server.metrics.instrument_engine(
+                    engine.sync_engine, 'qwc_permalink_db_query_duration_seconds'
+                )
+                if server.profiler.enabled:
+                    request_profiler.instrument_engine(engine.sync_engine)
+    return storage
+
+
+async def resolve_permalinks(ctx, keys):
+    """ Return list of cached or stored permalink entries per key, None if not found """
+    entries, lookup = server.cached_permalinks(ctx, keys)
+    if lookup:
+        try:
+            rows = await async_storage(ctx).get_permalinks(lookup)
+            server.add_stored_permalinks(ctx, entries, lookup, rows)
+        except Exception as e:
+            server.app.logger.debug("Query failed: %s" % str(e))
+    ctx.storage.record_access(list(entries))
+    return [entries.get(key) for key in keys]
+
+
+async def resolve_permalink():
+    """ Resolve a permalink """
+    args = server.resolvepermalink_parser.parse_args()
+    ctx = await tenant_context()
+
+    key = args['key']
+    entry = (await resolve_permalinks(ctx, [key]))[0]
+    if entry and entry["permitted_group"]:
+        # looks up the groups of the user
+        return await asyncio.to_thread(server.resolve_response, ctx, key, entry)
+    return server.resolve_response(ctx, key, entry)
+
+
+async def resolve_permalinks_batch():
+    """ Resolve multiple permalinks """
+    ctx = await tenant_context()
+
+    keys = server.resolve_batch_keys(ctx)
+    entries = await resolve_permalinks(ctx, keys)
+    if any(entry and entry["permitted_group"] for entry in entries):
+        # looks up the groups of the user
+        return await asyncio.to_thread(server.resolve_batch_response, ctx, keys, entries)
+    return server.resolve_batch_response(ctx, keys, entries)
+
+
+async def user_permalink():
+    """ Get a user permalink """
+    username = get_username(get_identity())
+    if not username:
+        return jsonify({})
+
+    ctx = await tenant_context()
+    try:
+        data = StorageCodec.decode(await async_storage(ctx).get_user_permalink(username))
+    except Exception:
+        data = {}
+
+    # Backward compatibility
+    if "permalinkParams" in data.get("state", {}):
+        data["query"] = data.get("query") | data["state"]["permalinkParams"]
+
+    return jsonify(data)
+
+
+async def bookmarks_list():
+    """ Get the list of bookmarks or visibility presets """
+    username = get_username(get_identity()) or "public"
+    endpoint = request.path.split("/")[1]
+
+    ctx = await tenant_context()
+    limit, after, stream = server.bookmarks_list_args(ctx)
+    if stream:
+        response = StreamingResponse(
+            stream_bookmarks(ctx, endpoint, username, after, limit),
+            mimetype=server.app.json.mimetype
+        )
+        response.headers['Cache-Control'] = server.bookmarks_cache_control(ctx)
+        return response
+
+    try:
+        # fetch one more row to detect next page
+        rows = await async_storage(ctx).list_bookmarks(
+            endpoint, username, after, limit + 1 if limit is not None else None
+        )
+    except Exception as e:
+        server.app.logger.debug("Query failed: %s" % str(e))
+        rows = []
+    return server.bookmarks_list_response(ctx, rows, limit)
+
+
+async def stream_bookmarks(ctx, endpoint, username, after, limit):
+    """ Yield chunks of a bookmarks list as JSON array, with rows fetched
+    incrementally """
+    chunk = b"["
+    count = 0
+    try:
+        async for row in async_storage(ctx).stream_bookmarks(endpoint, username, after, limit):
+            chunk += (b"," if count else b"") + server.app.json.dumps(
+                server.bookmark_item(row)
+            ).encode('utf-8')
+            count += 1
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield chunk
+                chunk = b""
+    except Exception as e:
+        server.app.logger.debug("Query failed: %s" % str(e))
+    yield chunk + b"]"
+
+
+async def bookmark(key):
+    """ Get a bookmark or visibility preset """
+    username = get_username(get_identity()) or "public"
+    endpoint = request.path.split("/")[1]
+
+    ctx = await tenant_context()
+    if ctx.negative_cache.known_missing(endpoint, key, username):
+        server.app.logger.debug("Bookmark %s is known not to exist" % key)
+        return jsonify({})
+    try:
+        row = await async_storage(ctx).get_bookmark(endpoint, username, key)
+    except Exception as e:
+        server.app.logger.debug("Query failed: %s" % str(e))
+        return jsonify({})
+    if row is not None and StorageCodec.is_delta(row["data"]):
+        # reconstructs the delta encoded payload, which may query its base
+        return await asyncio.to_thread(
+            server.bookmark_response, ctx, endpoint, key, username, row
+        )
+    return server.bookmark_response(ctx, endpoint, key, username, row)
+
+
+async def healthz():
+    """ Liveness probe """
+    try:
+        ctx = await tenant_context()
+        storage = async_storage(ctx)
+    except Exception as e:
+        return make_response(jsonify(
+            {"status": "FAIL", "cause": str(e)}), 500)
+
+    # cached result of the storage check, may wait for the first check
+    status = await asyncio.to_thread(ctx.health_check.status)
+    status["pools"] = server.db_pools(ctx)
+    for role, engine in (
+        ("async_primary", getattr(storage, 'engine', None)),
+        ("async_replica", getattr(storage, 'engine_readonly', None))
+    ):
+        if engine is not None:
+            status["pools"][role] = pool_status(engine.sync_engine)
+    return make_response(jsonify(status), 200 if status["status"] == "OK" else 500)
+
+
+# ASYNC_HANDLERS[(<method>, <URL rule>)] = (<handler>, <optional auth>)
+ASYNC_HANDLERS = {
+    ('GET', '/resolvepermalink'): (resolve_permalink, True),
+    ('POST', '/resolvepermalinks'): (resolve_permalinks_batch, True),
+    ('GET', '/userpermalink'): (user_permalink, True),
+    ('GET', '/bookmarks/'): (bookmarks_list, True),
+    ('GET', '/visibility_presets/'): (bookmarks_list, True),
+    ('GET', '/bookmarks/<key>'): (bookmark, True),
+    ('GET', '/visibility_presets/<key>'): (bookmark, True),
+    ('GET', '/healthz'): (healthz, False)
+}
+
+
+def wsgi_environ(scope, body):
+    """ Return WSGI environ for an ASGI HTTP request
+
+    :param dict scope: ASGI connection scope
+    :param bytes body: Request body
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+        elif 'HTTP_' + name in environ:
+            environ['HTTP_' + name] += ',' + value
+        else:
+            environ['HTTP_' + name] = value
+    return environ
+
+
+def call_wsgi(environ):
+    """ Return status, headers and body of the WSGI app response """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    result = server.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+async def call_async_handler(environ):
+    """ Return status, headers and body of the async handler response, or
+    None if there is no async handler for the request
+
+    The body is bytes, or an async iterator of chunks for a streamed
+    response.
+    """
+    with server.app.request_context(tenant_environ(dict(environ), None)):
+        rule = request.url_rule.rule if request.url_rule else None
+        handler, optional_auth = ASYNC_HANDLERS.get((request.method, rule), (None, False))
+        if handler is None:
+            return None
+
+        g.defer_metrics_sync = True
+        try:
+            rv = server.app.preprocess_request()
+            if rv is None:
+                if optional_auth:
+                    with request_profiler.phase('auth'):
+                        await asyncio.to_thread(verify_jwt_in_request, optional=True)
+                rv = await handler(**request.view_args)
+        except Exception as e:
+            try:
+                rv = server.app.handle_user_exception(e)
+            except Exception as e:
+                rv = server.app.handle_exception(e)
+        response = server.app.process_response(server.app.make_response(rv))
+        await asyncio.to_thread(server.metrics.sync)
+        if isinstance(response, StreamingResponse):
+            body = response.response
+        else:
+            body = response.get_data()
+        return response.status_code, response.headers.to_wsgi_list(), body
+
+
+async def read_body(receive):
+    """ Return complete request body """
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def lifespan(receive, send):
+    """ Handle ASGI lifespan events """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await dispose_async_engines()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ ASGI application """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    response = await call_async_handler(environ)
+    if response is None:
+        response = await asyncio.to_thread(call_wsgi, environ)
+    status, headers, body = response
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ]
+    })
+    if isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+        return
+    try:
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        # close DB connection if the client disconnected
+        await body.aclose()
@@ -0,0 +1,266 @@
+import asyncio
+import itertools
+import threading
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import text as sql_text
+
+from storage import PostgresStorage
+
+
+# async_engines[<DB URL>] = <AsyncEngine>
+async_engines = {}
+async_engines_lock = threading.Lock()
+
+
+def async_db_engine(url, pool_size=10, max_overflow=10):
+    """Return shared async DB engine for a PostgreSQL URL.
+
+    The URL is used with the async psycopg (version 3) driver. Engines are
+    shared by all tenants with the same URL.
+
+    :param URL url: SQLAlchemy URL of the synchronous DB engine
+    :param int pool_size: Number of pooled connections
+    :param int max_overflow: Number of connections beyond pool_size
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = url.set(drivername="postgresql+psycopg")
+    key = url.render_as_string(hide_password=False)
+    with async_engines_lock:
+        engine = async_engines.get(key)
+        if engine is None:
+            engine = async_engines[key] = create_async_engine(
+                url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True
+            )
+    return engine
+
+
+async def dispose_async_engines():
+    """Close all connections of the shared async DB engines."""
+    with async_engines_lock:
+        engines = list(async_engines.values())
+        async_engines.clear()
+    for engine in engines:
+        await engine.dispose()
+
+
+class AsyncStorage:
+    """Async reads of a storage, running its methods in worker threads.
+
+    Used for storage backends without an async driver.
+    """
+
+    def __init__(self, storage):
+        """Constructor
+
+        :param Storage storage: Storage
+        """
+        self.storage = storage
+
+    async def get_permalinks(self, keys):
+        """See Storage.get_permalinks()"""
+        return await asyncio.to_thread(self.storage.get_permalinks, keys)
+
+    async def get_user_permalink(self, username):
+        """See Storage.get_user_permalink()"""
+        return await asyncio.to_thread(self.storage.get_user_permalink, username)
+
+    async def list_bookmarks(self, kind, username, after=None, limit=None):
+        """Return list of bookmarks, see Storage.list_bookmarks()"""
+        return await asyncio.to_thread(
+            lambda: list(self.storage.list_bookmarks(kind, username, after, limit))
+        )
+
+    async def stream_bookmarks(self, kind, username, after=None, limit=None):
+        """Yield bookmarks, fetched incrementally in worker threads, see
+        Storage.list_bookmarks()"""
+        rows = iter(await asyncio.to_thread(
+            self.storage.list_bookmarks, kind, username, after, limit, True
+        ))
+        try:
+            while True:
+                batch = await asyncio.to_thread(lambda: list(itertools.islice(rows, 500)))
+                if not batch:
+                    return
+                for row in batch:
+                    yield row
+        finally:
+            if hasattr(rows, 'close'):
+                await asyncio.to_thread(rows.close)
+
+    async def get_bookmark(self, kind, username, key):
+        """See Storage.get_bookmark()"""
+        return await asyncio.to_thread(self.storage.get_bookmark, kind, username, key)
+
+    async def check(self):
+        """See Storage.check()"""
+        await asyncio.to_thread(self.storage.check)
+
+
+class AsyncPostgresStorage(AsyncStorage):
+    """Async reads of a PostgresStorage with an async DB engine.
+
+    Reuses the prebuilt statements and the user ID cache of the storage.
+    Reads are routed to the read-only DB as by the storage. Archived
+    permalinks are looked up by the storage in worker threads.
+    """
+
+    def __init__(self, storage, engine, engine_readonly=None):
+        """Constructor
+
+        :param PostgresStorage storage: Storage
+        :param AsyncEngine engine: Async DB engine
+        :param AsyncEngine engine_readonly: Optional async DB engine for reads
+        """
+        super().__init__(storage)
+        self.engine = engine
+        self.engine_readonly = engine_readonly
+
+    async def read(self, query, recent=(), retry_missing=False):
+        """See PostgresStorage.read()
+
+        :param callable query: Async function(<AsyncConnection>) returning
+                               the result
+        :param list recent: Keys in recent_writes of written data
+        :param bool retry_missing: Whether to repeat the query on the
+                                   primary DB if the result is empty
+        """
+        storage = self.storage
+        if self.engine_readonly is not None and not any(
+            storage.recent_writes.get(key) for key in recent
+        ):
+            try:
+                async with self.engine_readonly.connect() as connection:
+                    result = await query(connection)
+                storage.count_read('replica_reads')
+                if result or not retry_missing:
+                    return result
+            except SQLAlchemyError as e:
+                storage.logger.warning("Query on read-only DB failed, using primary DB: %s" % e)
+                storage.count_read('replica_failures')
+        storage.count_read('primary_reads')
+        async with self.engine.connect() as connection:
+            return await query(connection)
+
+    async def user_params(self, connection, username):
+        """Return statement params identifying the user.
+
+        :param AsyncConnection connection: DB connection
+        :param str username: User name
+        """
+        storage = self.storage
+        params = {"username": username}
+        if storage.users_table:
+            user_id = storage.user_ids.get(username)
+            if user_id is None:
+                result = await connection.execute(storage.user_id_sql(), {"username": username})
+                user_id = result.scalar()
+                if user_id is not None:
+                    storage.user_ids.set(username, user_id)
+            params["user_id"] = user_id
+        return params
+
+    async def get_permalinks(self, keys):
+        async def query(connection):
+            result = await connection.execute(self.storage.get_permalinks_sql(), {"keys": keys})
+            return result.mappings().all()
+
+        entries = PostgresStorage.permalink_entries(await self.read(
+            query, [('permalinks', key) for key in keys], len(keys) == 1
+        ))
+        if self.storage.archive_table:
+            missing = [key for key in keys if key.rstrip(' ') not in entries]
+            if missing:
+                entries.update(await asyncio.to_thread(
+                    self.storage.get_archived_permalinks, missing
+                ))
+        return entries
+
+    async def get_user_permalink(self, username):
+        async def query(connection):
+            result = await connection.execute(
+                self.storage.get_user_permalink_sql(), {"user": username}
+            )
+            return result.scalar()
+
+        return await self.read(query, [('user', username)], True)
+
+    async def list_bookmarks(self, kind, username, after=None, limit=None):
+        sql, params = self.storage.list_bookmarks_sql(kind, after, limit)
+
+        async def query(connection):
+            result = await connection.execute(
+                sql, params | await self.user_params(connection, username)
+            )
+            return result.mappings().all()
+
+        return await self.read(query, [('user', username)])
+
+    async def stream_bookmarks(self, kind, username, after=None, limit=None):
+        """Yield bookmarks, fetched incrementally, see
+        PostgresStorage.stream_bookmarks()"""
+        storage = self.storage
+        sql, params = storage.list_bookmarks_sql(kind, after, limit)
+
+        async def execute(connection):
+            return await connection.stream(
+                sql, params | await self.user_params(connection, username)
+            )
+
+        connection = None
+        result = None
+        if self.engine_readonly is not None and not storage.recent_writes.get(('user', username)):
+            try:
+                connection = await self.engine_readonly.connect()
+                result = await execute(connection)
+                storage.count_read('replica_reads')
+            except SQLAlchemyError as e:
+                storage.logger.warning("Query on read-only DB failed, using primary DB: %s" % e)
+                storage.count_read('replica_failures')
+                if connection is not None:
+                    await connection.close()
+                    connection = None
+        try:
+            if result is None:
+                connection = await self.engine.connect()
+                storage.count_read('primary_reads')
+                result = await execute(connection)
+            async for row in result.mappings():
+                yield row
+        finally:
+            if connection is not None:
+                await connection.close()
+
+    async def get_bookmark(self, kind, username, key):
+        async def query(connection):
+            params = await self.user_params(connection, username) | {"key": key}
+            result = await connection.execute(self.storage.get_bookmark_sql(kind), params)
+            return result.mappings().first()
+
+        return await self.read(query, [('user', username)], True)
+
+    async def check(self):
+        async with self.engine.connect() as connection:
+            await connection.execute(sql_text("SELECT 1"))
+
+
+def create_async_storage(ctx):
+    """Return async storage for the storage of a tenant context.
+
+    PostgreSQL storages use shared async DB engines, configured by
+    async_db_pool_size and async_db_max_overflow, other storages run in
+    worker threads.
+
+    :param TenantContext ctx: Tenant context
+    """
+    storage = ctx.storage
+    if isinstance(storage, PostgresStorage) and storage.db.dialect.name == 'postgresql':
+        pool_size = ctx.config.get('async_db_pool_size', 10)
+        max_overflow = ctx.config.get('async_db_max_overflow', 10)
+        engine = async_db_engine(storage.db.url, pool_size, max_overflow)
+        engine_readonly = None
+        if storage.db_readonly is not None:
+            engine_readonly = async_db_engine(storage.db_readonly.url, pool_size, max_overflow)
+        return AsyncPostgresStorage(storage, engine, engine_readonly)
+    return AsyncStorage(storage)
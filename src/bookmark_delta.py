@@ -0,0 +1,214 @@
+import json_codec
+from caches import TTLCache
+from storage_codec import DELTA_MARKER, StorageCodec
+
+
+def escape_pointer(token):
+    """Return JSON pointer reference token of a key."""
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def diff(source, target, path=""):
+    """Return list of JSON patch (RFC 6902) operations turning source into
+    target, using only add, remove and replace.
+
+    Objects are compared per key and arrays per index, so e.g. toggling a
+    layer in a list of layers yields a single replace operation.
+
+    :param obj source: JSON data
+    :param obj target: JSON data
+    :param str path: JSON pointer of source and target
+    """
+    if type(source) is not type(target):
+        return [{"op": "replace", "path": path, "value": target}]
+    if isinstance(source, dict):
+        patch = []
+        for key in source:
+            if key not in target:
+                patch.append({"op": "remove", "path": path + "/" + escape_pointer(key)})
+        for key, value in target.items():
+            child = path + "/" + escape_pointer(key)
+            if key not in source:
+                patch.append({"op": "add", "path": child, "value": value})
+            else:
+                patch += diff(source[key], value, child)
+        return patch
+    if isinstance(source, list):
+        patch = []
+        for i in range(min(len(source), len(target))):
+            patch += diff(source[i], target[i], "%s/%d" % (path, i))
+        # remove from the end, so indices of remaining items are unchanged
+        for i in range(len(source) - 1, len(target) - 1, -1):
+            patch.append({"op": "remove", "path": "%s/%d" % (path, i)})
+        for i in range(len(source), len(target)):
+            patch.append({"op": "add", "path": "%s/%d" % (path, i), "value": target[i]})
+        return patch
+    if source != target:
+        return [{"op": "replace", "path": path, "value": target}]
+    return []
+
+
+def apply(doc, patch):
+    """Return doc with JSON patch operations of diff() applied.
+
+    The doc is modified in place.
+
+    :param obj doc: JSON data
+    :param list patch: JSON patch operations
+    """
+    for op in patch:
+        path = op["path"]
+        if not path:
+            doc = op["value"]
+            continue
+        tokens = [
+            token.replace('~1', '/').replace('~0', '~')
+            for token in path[1:].split('/')
+        ]
+        parent = doc
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        token = tokens[-1]
+        if isinstance(parent, list):
+            if op["op"] == "add":
+                parent.insert(len(parent) if token == '-' else int(token), op["value"])
+            elif op["op"] == "remove":
+                del parent[int(token)]
+            else:
+                parent[int(token)] = op["value"]
+        elif op["op"] == "remove":
+            del parent[token]
+        else:
+            parent[token] = op["value"]
+    return doc
+
+
+class BookmarkDeltas:
+    """Delta encoding of bookmark and visibility preset payloads.
+
+    Payloads are stored as JSON patch against a base payload per user,
+    bookmark kind and theme, with the base ID after the delta marker, e.g.
+    'd1:<base ID>:<JSON patch>'. The patch is encoded with the storage
+    codec.
+
+    The first payload of a user and theme becomes its base. If the patch
+    of a payload exceeds max_ratio of its size, the payload becomes the
+    new base, and bases no longer referenced by bookmarks are deleted,
+    except the latest two. Payloads smaller than min_size are stored as
+    is.
+
+    Bases are immutable, so bases and reconstructed payloads are cached
+    by their ID and stored text.
+    """
+
+    def __init__(self, storage, codec, logger, enabled=False, max_ratio=0.5,
+                 min_size=256, cache_size=1000, cache_ttl=3600, make_cache=None):
+        """Constructor
+
+        :param Storage storage: Bookmark storage
+        :param StorageCodec codec: Codec for bases and patches
+        :param Logger logger: Application logger
+        :param bool enabled: Whether to delta encode new payloads
+        :param float max_ratio: Max size of a patch relative to its payload
+                                before rebasing
+        :param int min_size: Min size in bytes of a JSON payload for delta
+                             encoding it
+        :param int cache_size: Max number of cached bases and payloads each
+        :param float cache_ttl: Time in seconds reconstructed payloads are
+                                cached
+        :param callable make_cache: Optional function(<name>, <maxsize>,
+                                    <ttl>) returning a cache, e.g. a
+                                    shared cache
+        """
+        self.storage = storage
+        self.codec = codec
+        self.logger = logger
+        self.enabled = enabled
+        self.max_ratio = max_ratio
+        self.min_size = min_size
+        if make_cache is None:
+            def make_cache(name, maxsize, ttl):
+                return TTLCache(maxsize, ttl)
+        # bases[<base ID>] = <JSON document>
+        self.bases = make_cache('bookmark_bases', cache_size, cache_ttl)
+        # docs[<stored text>] = <reconstructed JSON document>
+        self.docs = make_cache('bookmark_docs', cache_size, cache_ttl)
+
+        # counters
+        self.deltas = 0
+        self.rebases = 0
+
+    def encode(self, kind, username, theme_id, data, date):
+        """Return text to store for a bookmark payload.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str theme_id: Theme ID, or None
+        :param obj data: JSON serializable payload
+        :param str date: Current date
+        """
+        raw = json_codec.dumps(data)
+        if not self.enabled or len(raw) < self.min_size:
+            return self.codec.encode_json(raw)
+
+        theme_id = theme_id or ''
+        base = self.storage.latest_bookmark_base(kind, username, theme_id)
+        if base is not None:
+            base_id, text = base
+            base_raw = self.bases.get(base_id)
+            if base_raw is None:
+                base_raw = StorageCodec.decode_bytes(text)
+                self.bases.set(base_id, base_raw)
+            patch = json_codec.dumps(diff(json_codec.loads(base_raw), data))
+            if len(patch) <= self.max_ratio * len(raw):
+                self.deltas += 1
+                return "%s%d:%s" % (DELTA_MARKER, base_id, self.codec.encode_json(patch))
+
+        # make payload the new base
+        base_id = self.storage.insert_bookmark_base(
+            kind, username, theme_id, self.codec.encode_json(raw), date
+        )
+        self.bases.set(base_id, raw)
+        self.rebases += 1
+        purged = self.storage.purge_bookmark_bases(kind, username, theme_id)
+        self.logger.debug(
+            "New bookmark base %d for %s, purged %d bases" % (base_id, username, purged)
+        )
+        return "%s%d:[]" % (DELTA_MARKER, base_id)
+
+    def decode_bytes(self, text):
+        """Return JSON document of stored text as UTF-8 bytes, or None if
+        the base of a delta encoded payload is missing.
+
+        :param str text: Stored text
+        """
+        if not StorageCodec.is_delta(text):
+            return StorageCodec.decode_bytes(text)
+        doc = self.docs.get(text)
+        if doc is not None:
+            return doc
+
+        base_id = StorageCodec.delta_base_id(text)
+        patch = text[len(DELTA_MARKER):].split(':', 1)[1]
+        base_raw = self.bases.get(base_id)
+        if base_raw is None:
+            base = self.storage.get_bookmark_base(base_id)
+            if base is None:
+                self.logger.warning("Bookmark base %d is missing" % base_id)
+                return None
+            base_raw = StorageCodec.decode_bytes(base)
+            self.bases.set(base_id, base_raw)
+        doc = json_codec.dumps(apply(
+            json_codec.loads(base_raw), json_codec.loads(StorageCodec.decode_bytes(patch))
+        ))
+        self.docs.set(text, doc)
+        return doc
+
+    def stats(self):
+        """Return dict with counters and cache stats."""
+        return {
+            "deltas": self.deltas,
+            "rebases": self.rebases,
+            "bases": self.bases.stats(),
+            "docs": self.docs.stats()
+        }
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """Bounded LRU cache where each entry expires after a time-to-live.
+
+    Entries are evicted in least-recently-used order once the cache holds
+    more than maxsize entries. Safe for use from multiple threads.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        """Constructor
+
+        :param int maxsize: Max number of entries (0 disables the cache)
+        :param float ttl: Default time-to-live of an entry in seconds
+        """
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default if missing or expired.
+
+        :param obj key: Cache key
+        :param obj default: Value to return on a cache miss
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Store value under key.
+
+        :param obj key: Cache key
+        :param obj value: Value to store
+        :param float ttl: Optional time-to-live overriding the default
+        """
+        if self.maxsize == 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from cache.
+
+        :param obj key: Cache key
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return dict with size and hit/miss counters."""
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class NegativeCache:
+    """Cache of keys known not to exist in a table.
+
+    Misses are remembered for a short time-to-live, so that repeated
+    lookups of unknown keys, e.g. by crawlers or of broken links, are
+    answered without a DB round trip. Keys stored by this process drop
+    their remembered misses, keys stored by other processes are found
+    once the misses have expired.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30):
+        """Constructor
+
+        :param int maxsize: Max number of remembered misses
+        :param float ttl: Time in seconds a miss is remembered
+        """
+        self.misses = TTLCache(maxsize, ttl)
+        self.short_circuited = 0
+        self.lock = threading.Lock()
+        # optional callable(<table>) called for each short-circuited lookup
+        self.listener = None
+
+    def known_missing(self, table, key, scope=None):
+        """Return whether key is remembered not to exist.
+
+        :param str table: Table name
+        :param str key: Key
+        :param str scope: Optional scope of the lookup, e.g. the username
+        """
+        missing = self.misses.get((table, key, scope)) is not None
+        if missing:
+            with self.lock:
+                self.short_circuited += 1
+            if self.listener is not None:
+                self.listener(table)
+        return missing
+
+    def add_missing(self, table, key, scope=None):
+        """Remember that key does not exist.
+
+        :param str table: Table name
+        :param str key: Key
+        :param str scope: Optional scope of the lookup, e.g. the username
+        """
+        self.misses.set((table, key, scope), True)
+
+    def add_existing(self, table, key, scopes=(None,)):
+        """Record a stored key.
+
+        :param str table: Table name
+        :param str key: Key
+        :param list scopes: Scopes of remembered misses to drop
+        """
+        for scope in scopes:
+            self.misses.invalidate((table, key, scope))
+
+    def stats(self):
+        """Return dict with counters."""
+        return {
+            "short_circuited": self.short_circuited,
+            **self.misses.stats()
+        }
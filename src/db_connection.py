@@ -0,0 +1,23 @@
+from qwc_services_core.database import DatabaseEngine
+
+
+# DB engines of this process, shared by all tenants
+db_engine = DatabaseEngine()
+
+
+def db_conn(config):
+    """Return DB engine, config schema and users table of a tenant config.
+
+    :param RuntimeConfig config: Tenant config
+    """
+    db_url = config.get('db_url', 'postgresql:///?service=qwc_configdb')
+    qwc_config_schema = config.get('qwc_config_schema', 'qwc_config')
+    db = db_engine.db_engine(db_url)
+
+    store_bookmarks_by_userid = config.get('store_bookmarks_by_userid', True)
+    if store_bookmarks_by_userid:
+        users_table = f'"{qwc_config_schema}"."users"'
+    else:
+        users_table = None
+
+    return db, qwc_config_schema, users_table
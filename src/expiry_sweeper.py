@@ -0,0 +1,98 @@
+import threading
+import time
+
+
+class ExpirySweeper:
+    """Purge permalinks past their expiry date and archive permalinks which
+    have not been resolved recently, in bounded batches.
+
+    The storage ensures that only one process across all workers and hosts
+    sharing the storage purges or archives it at a time, e.g. with an
+    advisory lock.
+    """
+
+    def __init__(self, logger, interval=3600, batch_size=1000):
+        """Constructor
+
+        :param Logger logger: Application logger
+        :param float interval: Min interval in seconds between purges
+                               when using schedule() (0 disables)
+        :param int batch_size: Max number of rows deleted or archived per
+                               statement
+        """
+        self.logger = logger
+        self.interval = interval
+        self.batch_size = max(1, int(batch_size))
+        # monotonic time of last scheduled purge
+        self.last_run = None
+
+        # counters
+        self.runs = 0
+        self.rows_purged = 0
+        self.rows_archived = 0
+        self.last_duration = None
+        self.lock = threading.Lock()
+        # optional callable(<purged rows>, <archived rows>, <duration>)
+        # called after each completed purge
+        self.listener = None
+
+    def schedule(self, storage):
+        """Purge storage in a background thread if the interval has elapsed.
+
+        :param Storage storage: Permalink storage
+        """
+        if not self.interval:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if self.last_run is not None and now - self.last_run < self.interval:
+                return
+            self.last_run = now
+        threading.Thread(target=self.purge, args=(storage,), daemon=True).start()
+
+    def purge(self, storage):
+        """Delete expired permalinks and archive stale permalinks in batches.
+
+        Returns the number of purged rows, or None if the storage is being
+        purged by another process or the purge failed.
+
+        :param Storage storage: Permalink storage
+        """
+        start = time.perf_counter()
+        try:
+            purged = storage.purge_expired_permalinks(self.batch_size)
+        except Exception as e:
+            self.logger.warning("Failed to purge expired permalinks: %s" % e)
+            return None
+        if purged is None:
+            self.logger.debug("Purge of expired permalinks is already running")
+            return None
+
+        try:
+            archived = storage.archive_permalinks(self.batch_size) or 0
+        except Exception as e:
+            self.logger.warning("Failed to archive permalinks: %s" % e)
+            archived = 0
+
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.runs += 1
+            self.rows_purged += purged
+            self.rows_archived += archived
+            self.last_duration = duration
+        if self.listener is not None:
+            self.listener(purged, archived, duration)
+        self.logger.info(
+            "Purged %d expired and archived %d permalinks in %.3fs" % (purged, archived, duration)
+        )
+        return purged
+
+    def stats(self):
+        """Return dict with counters."""
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "rows_purged": self.rows_purged,
+                "rows_archived": self.rows_archived,
+                "last_duration": self.last_duration
+            }
@@ -0,0 +1,150 @@
+import threading
+import time
+
+
+class Batch:
+    """Permalinks queued for a common commit."""
+
+    def __init__(self):
+        self.items = []
+        self.opened = time.monotonic()
+        self.results = None
+        self.error = None
+        self.flushing = False
+        self.done = threading.Event()
+
+
+class GroupCommit:
+    """Store permalinks of concurrent requests in common transactions.
+
+    Queued permalinks are flushed as multi-row INSERTs once max_batch_size
+    permalinks are queued or max_wait has elapsed since the first one. The
+    request which opened a batch waits for it and flushes it, the others
+    wait until it is committed, so each request returns only after its
+    permalinks are durable. A full batch is closed immediately, so the next
+    batch fills while it is being stored. A request which is not woken up
+    within timeout stores its permalinks itself, after withdrawing them
+    from its batch if it is not being stored yet.
+
+    Only requests of the same process are batched, so this requires
+    multiple request threads per process.
+
+    Keys are allocated in-process by the key allocator of the storage.
+    """
+
+    def __init__(self, storage, max_batch_size=100, max_wait=0.01, timeout=5):
+        """Constructor
+
+        :param Storage storage: Permalink storage
+        :param int max_batch_size: Max number of permalinks per batch
+        :param float max_wait: Max time in seconds a batch is kept open
+        :param float timeout: Max time in seconds a request waits for the
+                              commit of a batch stored by another request
+        """
+        self.storage = storage
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self.timeout = timeout
+        # currently open batch
+        self.batch = None
+        self.cond = threading.Condition()
+
+        # counters
+        self.batches = 0
+        self.permalinks = 0
+        self.timeouts = 0
+        # optional callable(<batch size>, <wait time>) called after each flush
+        self.listener = None
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        """Queue permalinks and return list of (key, expires) per payload
+        once their batch is committed.
+
+        See Storage.store_permalinks().
+        """
+        with self.cond:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = Batch()
+            start = len(batch.items)
+            for i, data in enumerate(datas):
+                batch.items.append(
+                    (data, hashes[i] if hashes else None, date, expires, permitted_group)
+                )
+            if len(batch.items) >= self.max_batch_size:
+                # close full batch
+                self.batch = None
+                self.cond.notify_all()
+
+        if leader:
+            deadline = batch.opened + self.max_wait
+            with self.cond:
+                while self.batch is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.batch = None
+                        break
+                    self.cond.wait(remaining)
+                batch.flushing = True
+            self.flush(batch)
+        elif not batch.done.wait(self.timeout):
+            with self.cond:
+                self.timeouts += 1
+                if not batch.flushing:
+                    # withdraw permalinks, else they may be stored twice
+                    batch.items[start:start + len(datas)] = [None] * len(datas)
+            return self.storage.store_permalinks(datas, hashes, date, expires, permitted_group)
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[start:start + len(datas)]
+
+    def flush(self, batch):
+        """Store permalinks of a closed batch and wake up its requests.
+
+        Permalinks with the same creation date, expiry date and permitted
+        group are stored with a single call of the storage. Withdrawn
+        permalinks are skipped.
+
+        :param Batch batch: Closed batch
+        """
+        wait = time.monotonic() - batch.opened
+        try:
+            # groups[(<date>, <expires>, <permitted_group>)] = [<item index>]
+            groups = {}
+            for i, item in enumerate(batch.items):
+                if item is not None:
+                    groups.setdefault(item[2:], []).append(i)
+            results = [None] * len(batch.items)
+            for (date, expires, permitted_group), indices in groups.items():
+                hashes = [batch.items[i][1] for i in indices]
+                stored = self.storage.store_permalinks(
+                    [batch.items[i][0] for i in indices],
+                    hashes if hashes[0] is not None else None,
+                    date, expires, permitted_group
+                )
+                for i, result in zip(indices, stored):
+                    results[i] = result
+            batch.results = results
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+        size = sum(1 for item in batch.items if item is not None)
+        with self.cond:
+            self.batches += 1
+            self.permalinks += size
+        if self.listener is not None:
+            self.listener(size, wait)
+
+    def stats(self):
+        """Return dict with counters."""
+        with self.cond:
+            return {
+                "batches": self.batches,
+                "permalinks": self.permalinks,
+                "timeouts": self.timeouts,
+                "avg_batch_size": round(self.permalinks / self.batches, 2) if self.batches else None
+            }
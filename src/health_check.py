@@ -0,0 +1,124 @@
+import threading
+import time
+
+
+class HealthCheck:
+    """Cached result of a health check, refreshed in a background thread.
+
+    Probes return the last result and start a refresh if it is older than
+    interval, so a slow or unavailable DB neither delays probes nor is
+    queried by each of them. Only one refresh runs at a time. If a refresh
+    has been running for longer than timeout, probes fail.
+    """
+
+    def __init__(self, check, logger, interval=10, timeout=2):
+        """Constructor
+
+        :param callable check: Function raising if not healthy
+        :param Logger logger: Application logger
+        :param float interval: Max age in seconds of a result before
+                               refreshing it (0 checks on every probe)
+        :param float timeout: Max duration in seconds of a check
+        """
+        self.check = check
+        self.logger = logger
+        self.interval = interval
+        self.timeout = timeout
+        # last result as (<monotonic time>, <status>, <cause>)
+        self.result = None
+        # monotonic start time of running refresh, None if not running
+        self.running = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+        # counters
+        self.checks = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def refresh(self):
+        """Run check and store result."""
+        start = time.monotonic()
+        try:
+            self.check()
+            status, cause = "OK", None
+        except Exception as e:
+            self.logger.warning("Health check failed: %s" % e)
+            status, cause = "FAIL", str(e)
+        with self.lock:
+            self.checks += 1
+            if cause is not None:
+                self.failures += 1
+            self.result = (start, status, cause)
+            self.running = None
+            self.done.set()
+
+    def status(self):
+        """Return dict with status, cause if failed and age in seconds of
+        the result."""
+        now = time.monotonic()
+        with self.lock:
+            result = self.result
+            if self.running is None and (result is None or now - result[0] >= self.interval):
+                self.running = now
+                self.done.clear()
+                threading.Thread(target=self.refresh, daemon=True).start()
+            running = self.running
+            done = self.done
+
+        if running is not None and (result is None or not self.interval):
+            # wait for the first or an uncached result
+            done.wait(max(0, self.timeout - (now - running)))
+            with self.lock:
+                result = self.result
+                running = self.running
+
+        if running is not None and time.monotonic() - running >= self.timeout:
+            with self.lock:
+                self.timeouts += 1
+            return {
+                "status": "FAIL",
+                "cause": "Health check timed out after %.1fs" % (time.monotonic() - running),
+                "age": None if result is None else round(now - result[0], 3)
+            }
+        if result is None:
+            # first check finished just before timing out
+            return {"status": "FAIL", "cause": "Health check is pending", "age": None}
+        status = {"status": result[1], "age": round(time.monotonic() - result[0], 3)}
+        if result[2] is not None:
+            status["cause"] = result[2]
+        return status
+
+    def stats(self):
+        """Return dict with counters."""
+        with self.lock:
+            return {
+                "checks": self.checks,
+                "failures": self.failures,
+                "timeouts": self.timeouts
+            }
+
+
+def pool_status(engine):
+    """Return dict with the connection pool saturation of a DB engine.
+
+    Only numbers are returned, as the status is public, e.g. no URLs.
+    Values not provided by the pool class are None, e.g. for a NullPool.
+
+    :param Engine engine: DB engine
+    """
+    pool = engine.pool
+    status = {}
+    for name, method in (
+        ("size", "size"), ("checked_out", "checkedout"),
+        ("overflow", "overflow"), ("checked_in", "checkedin")
+    ):
+        status[name] = getattr(pool, method)() if hasattr(pool, method) else None
+    if status["overflow"] is not None:
+        # negative while the pool has not been filled
+        status["overflow"] = max(0, status["overflow"])
+    # NOTE: threads waiting for a connection are only tracked by the queue
+    #       of a QueuePool
+    waiters = getattr(getattr(getattr(pool, '_pool', None), 'not_empty', None), '_waiters', None)
+    status["waiting"] = len(waiters) if waiters is not None else None
+    return status
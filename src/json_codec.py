@@ -0,0 +1,124 @@
+import json
+import json.encoder
+import math
+
+from flask.json.provider import DefaultJSONProvider
+
+from request_profiler import phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def canonical_float(value):
+    """Return JSON number of a float as written by orjson.
+
+    The shortest digits which round trip (as by repr()) are written in
+    fixed notation for decimal exponents from -5 to 15, else in
+    scientific notation without '+' and leading zeros, e.g. 1e20 and
+    0.000025. Non-finite values are written as null.
+
+    :param float value: Float
+    """
+    if math.isnan(value) or math.isinf(value):
+        return 'null'
+    text = repr(value)
+    sign = '-' if text[0] == '-' else ''
+    mantissa, _, exponent = text.lstrip('-').partition('e')
+    integer, _, fraction = mantissa.partition('.')
+    digits = (integer + fraction).lstrip('0')
+    if not digits:
+        return sign + '0.0'
+    # value = <digits> * 10^exponent
+    exponent = int(exponent or 0) - len(fraction) + len(digits) - len(digits.rstrip('0'))
+    digits = digits.rstrip('0')
+    # position of the decimal point relative to the first digit
+    point = len(digits) + exponent
+    if exponent >= 0 and point <= 16:
+        return sign + digits + '0' * exponent + '.0'
+    if 0 < point <= 16:
+        return sign + digits[:point] + '.' + digits[point:]
+    if -5 < point <= 0:
+        return sign + '0.' + '0' * -point + digits
+    if len(digits) == 1:
+        return sign + digits + 'e' + str(point - 1)
+    return sign + digits[0] + '.' + digits[1:] + 'e' + str(point - 1)
+
+
+class CanonicalEncoder(json.JSONEncoder):
+    """JSON encoder writing floats with canonical_float(), so its output
+    matches orjson."""
+
+    def iterencode(self, o, _one_shot=False):
+        # NOTE: the C encoder always writes floats with repr()
+        return json.encoder._make_iterencode(
+            {} if self.check_circular else None, self.default,
+            json.encoder.encode_basestring, self.indent, canonical_float,
+            self.key_separator, self.item_separator, self.sort_keys,
+            self.skipkeys, _one_shot
+        )(o, 0)
+
+
+def dumps(data):
+    """Return canonical JSON document of data as UTF-8 bytes.
+
+    Keys are sorted, separators are compact and non-ASCII characters are
+    not escaped, so equal payloads always serialize to the same bytes.
+    Uses orjson if installed, else an encoder with the same output, so
+    hashes of stored payloads do not depend on whether orjson is
+    installed.
+
+    :param obj data: JSON serializable data
+    """
+    with phase('json'):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+            except orjson.JSONEncodeError:
+                # e.g. integers beyond 64 bit
+                pass
+        return json.dumps(
+            data, cls=CanonicalEncoder, sort_keys=True, separators=(',', ':'),
+            ensure_ascii=False
+        ).encode('utf-8')
+
+
+def loads(doc):
+    """Return data of a JSON document. Uses orjson if installed.
+
+    :param bytes|str doc: JSON document
+    """
+    with phase('json'):
+        if orjson is not None:
+            return orjson.loads(doc)
+        return json.loads(doc)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider for request payloads and jsonify() responses,
+    using orjson if installed.
+
+    Dates and other types not native to JSON are serialized as by the
+    default provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+        with phase('json'):
+            # orjson output is always compact, use json for indented output
+            if orjson is None or kwargs.get("indent") is not None:
+                return super().dumps(obj, **kwargs)
+            try:
+                return orjson.dumps(
+                    obj, default=kwargs.get("default", self.default),
+                    option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                ).decode('utf-8')
+            except orjson.JSONEncodeError:
+                return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        with phase('json'):
+            if orjson is None or kwargs:
+                return super().loads(s, **kwargs)
+            return orjson.loads(s)
@@ -0,0 +1,157 @@
+import secrets
+import string
+import threading
+
+
+ALPHABETS = {
+    "hex": string.digits + "abcdef",
+    "base62": string.digits + string.ascii_letters
+}
+
+
+class KeyAllocator:
+    """Allocate random keys for new rows of tables with unique keys.
+
+    Each attempt passes a candidate key as :key parameter to an INSERT
+    statement of the form
+
+        INSERT INTO <table> (key, ...)
+        VALUES (:key, ...)
+        ON CONFLICT DO NOTHING
+        RETURNING key
+
+    which stores the row in a single round trip if the key is free and
+    returns no row on a collision. Only collisions are retried, within the
+    same transaction, any other error is raised.
+    """
+
+    def __init__(self, length=9, alphabet="hex", max_attempts=10):
+        """Constructor
+
+        :param int length: Key length
+        :param str alphabet: Name of key alphabet ('hex' or 'base62')
+        :param int max_attempts: Max number of attempts per insert
+        """
+        self.length = length
+        self.alphabet = ALPHABETS.get(alphabet, ALPHABETS["hex"])
+        self.max_attempts = max(1, max_attempts)
+
+        # counters
+        self.inserts = 0
+        self.failures = 0
+        self.collisions = 0
+        # attempts_histogram[<attempts>] = <number of inserts>
+        self.attempts_histogram = {}
+        self.lock = threading.Lock()
+        # optional callable(<collisions>, <failures>, <attempts per row>)
+        # called after each insert
+        self.listener = None
+
+    def generate(self):
+        """Return a random key."""
+        return "".join(secrets.choice(self.alphabet) for i in range(self.length))
+
+    def insert(self, connection, sql, params):
+        """Execute INSERT statement with random keys until a row is stored.
+
+        Returns the allocated key, or None if all attempts collided.
+
+        :param Connection connection: DB connection
+        :param TextClause sql: INSERT statement with :key parameter
+        :param dict params: Further statement parameters
+        """
+        key = None
+        attempts = 0
+        while key is None and attempts < self.max_attempts:
+            attempts += 1
+            row = connection.execute(sql, params | {"key": self.generate()}).first()
+            if row is not None:
+                key = row[0].rstrip(' ')
+
+        with self.lock:
+            if key is not None:
+                self.inserts += 1
+                self.collisions += attempts - 1
+            else:
+                self.failures += 1
+                self.collisions += attempts
+            self.attempts_histogram[attempts] = self.attempts_histogram.get(attempts, 0) + 1
+        if self.listener is not None:
+            self.listener(
+                attempts - 1 if key is not None else attempts, 0 if key is not None else 1, [attempts]
+            )
+        return key
+
+    def insert_many(self, connection, sql, params, columns):
+        """Execute multi-row INSERT statement until all rows are stored.
+
+        The statement gets the keys as :keys array parameter and the values
+        of each further column as array parameter, e.g.
+
+            INSERT INTO <table> (key, data, ...)
+            SELECT key, data, ...
+            FROM unnest(CAST(:keys AS text[]), CAST(:datas AS text[])) AS rows(key, data)
+            ON CONFLICT DO NOTHING
+            RETURNING key
+
+        Rows whose key collided are retried with new keys.
+
+        Returns the list of allocated keys, with None for rows for which all
+        attempts collided.
+
+        :param Connection connection: DB connection
+        :param TextClause sql: INSERT statement with :keys parameter
+        :param dict params: Further statement parameters common to all rows
+        :param dict columns: Lists of per-row values by parameter name
+        """
+        count = len(next(iter(columns.values()), []))
+        keys = [None] * count
+        attempts = [0] * count
+        pending = list(range(count))
+        while pending:
+            candidates = {}
+            for i in pending:
+                attempts[i] += 1
+                key = self.generate()
+                while key in candidates:
+                    key = self.generate()
+                candidates[key] = i
+            row_params = {
+                name: [values[i] for i in pending] for name, values in columns.items()
+            }
+            result = connection.execute(sql, params | row_params | {"keys": list(candidates)})
+            for row in result:
+                i = candidates[row[0].rstrip(' ')]
+                keys[i] = row[0].rstrip(' ')
+            pending = [
+                i for i in pending if keys[i] is None and attempts[i] < self.max_attempts
+            ]
+
+        collisions = 0
+        failures = 0
+        for i in range(count):
+            if keys[i] is not None:
+                collisions += attempts[i] - 1
+            else:
+                failures += 1
+                collisions += attempts[i]
+        with self.lock:
+            self.inserts += count - failures
+            self.failures += failures
+            self.collisions += collisions
+            for i in range(count):
+                self.attempts_histogram[attempts[i]] = self.attempts_histogram.get(attempts[i], 0) + 1
+        if self.listener is not None:
+            self.listener(collisions, failures, attempts)
+        return keys
+
+    def stats(self):
+        """Return dict with counters."""
+        with self.lock:
+            return {
+                "inserts": self.inserts,
+                "failures": self.failures,
+                "collisions": self.collisions,
+                "collision_rate": self.collisions / max(1, self.inserts + self.collisions),
+                "attempts": dict(self.attempts_histogram)
+            }
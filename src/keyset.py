@@ -0,0 +1,148 @@
+import base64
+import datetime
+import json
+import re
+
+
+SORT_TERM_RE = re.compile(
+    r'^\s*(\w+)(?:\s+(ASC|DESC))?(?:\s+NULLS\s+(FIRST|LAST))?\s*$', re.IGNORECASE
+)
+
+
+class KeysetPagination:
+    """Cursor based pagination of a query ordered by a configurable sort order.
+
+    The sort order is a comma separated list of column names with optional
+    ASC/DESC and NULLS FIRST/LAST, e.g. 'date DESC, description'. The unique
+    key column is appended as tie-breaker. A cursor encodes the sort values
+    of the last row of a page, the next page is selected with a WHERE clause
+    on these values instead of an OFFSET, so the cost of a page does not
+    grow with its position.
+    """
+
+    def __init__(self, sort_order, key_column="key"):
+        """Constructor
+
+        Raises ValueError if a sort term is not a plain column.
+
+        :param str sort_order: Sort order of the query
+        :param str key_column: Unique key column used as tie-breaker
+        """
+        # terms = [(<column>, <descending>, <nulls first>)]
+        self.terms = []
+        for term in sort_order.split(","):
+            match = SORT_TERM_RE.match(term)
+            if not match:
+                raise ValueError("Unsupported sort term '%s'" % term.strip())
+            column, direction, nulls = match.groups()
+            descending = (direction or "ASC").upper() == "DESC"
+            # PostgreSQL default: NULLS LAST for ASC, NULLS FIRST for DESC
+            nulls_first = nulls.upper() == "FIRST" if nulls else descending
+            self.terms.append((column, descending, nulls_first))
+        if key_column not in [term[0] for term in self.terms]:
+            self.terms.append((key_column, False, False))
+
+    def select_columns(self, table_alias=None):
+        """Return SQL select list of the sort values as _sort<i> columns.
+
+        :param str table_alias: Optional table alias to qualify the columns
+        """
+        prefix = table_alias + "." if table_alias else ""
+        return ", ".join(
+            "%s%s AS _sort%d" % (prefix, term[0], i) for i, term in enumerate(self.terms)
+        )
+
+    def order_by(self, table_alias=None):
+        """Return SQL ORDER BY expression.
+
+        :param str table_alias: Optional table alias to qualify the columns
+        """
+        prefix = table_alias + "." if table_alias else ""
+        return ", ".join(
+            "%s%s %s NULLS %s" % (
+                prefix, column, "DESC" if descending else "ASC",
+                "FIRST" if nulls_first else "LAST"
+            )
+            for column, descending, nulls_first in self.terms
+        )
+
+    def where(self, cursor, table_alias=None):
+        """Return SQL condition and params selecting the rows after a cursor.
+
+        Raises ValueError for an invalid cursor.
+
+        :param str cursor: Cursor returned by cursor()
+        :param str table_alias: Optional table alias to qualify the columns
+        """
+        values = self.decode(cursor)
+        prefix = table_alias + "." if table_alias else ""
+        params = {}
+        disjuncts = []
+        equals = []
+        for i, (column, descending, nulls_first) in enumerate(self.terms):
+            column = prefix + column
+            value = values[i]
+            param = "_after%d" % i
+            if value is None:
+                after = "%s IS NOT NULL" % column if nulls_first else None
+                equal = "%s IS NULL" % column
+            else:
+                params[param] = value
+                after = "%s %s :%s" % (column, "<" if descending else ">", param)
+                if not nulls_first:
+                    after = "(%s OR %s IS NULL)" % (after, column)
+                equal = "%s = :%s" % (column, param)
+            if after:
+                disjuncts.append("(%s)" % " AND ".join(equals + [after]))
+            equals.append(equal)
+        return "(%s)" % (" OR ".join(disjuncts) or "FALSE"), params
+
+    def cursor(self, row):
+        """Return cursor for the _sort<i> columns of a row.
+
+        :param RowMapping row: Result row
+        """
+        values = []
+        for i in range(len(self.terms)):
+            value = row["_sort%d" % i]
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                value = value.isoformat()
+            values.append(value)
+        return base64.urlsafe_b64encode(
+            json.dumps(values, separators=(',', ':')).encode('utf-8')
+        ).decode('ascii').rstrip('=')
+
+    def decode(self, cursor):
+        """Return sort values of a cursor.
+
+        :param str cursor: Cursor returned by cursor()
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if not isinstance(values, list) or len(values) != len(self.terms):
+            raise ValueError("Invalid cursor")
+        return values
+
+    def compare(self, a, b):
+        """Compare sort values in sort order, e.g. for sorting in memory.
+
+        Returns a negative number if a sorts before b, 0 if equal, else a
+        positive number.
+
+        :param list a: Sort values as returned by decode()
+        :param list b: Sort values as returned by decode()
+        """
+        for (column, descending, nulls_first), value_a, value_b in zip(self.terms, a, b):
+            if isinstance(value_a, (datetime.date, datetime.datetime)):
+                value_a = value_a.isoformat()
+            if isinstance(value_b, (datetime.date, datetime.datetime)):
+                value_b = value_b.isoformat()
+            if value_a == value_b:
+                continue
+            if value_a is None or value_b is None:
+                return -1 if (value_a is None) == nulls_first else 1
+            result = -1 if value_a < value_b else 1
+            return -result if descending else result
+        return 0
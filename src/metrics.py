@@ -0,0 +1,359 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 10)
+
+
+class Metrics:
+    """Counters, histograms and gauges in Prometheus text exposition format.
+
+    Each process keeps its own values. If a directory is set, e.g. for
+    multiple uWSGI worker processes, each process writes a snapshot of its
+    values to a file in this directory, at most once per sync interval,
+    within a sync interval after its last update and on exit. Rendering
+    sums up the counters and histograms of all files. Gauges are reported
+    per process and skipped if the process has exited or its snapshot is
+    stale. Snapshots of exited processes are merged into a single file.
+
+    The directory should be emptied when the service is (re)started.
+    """
+
+    def __init__(self, directory=None, sync_interval=1.0, stale_after=60):
+        """Constructor
+
+        :param str directory: Optional directory for per-process snapshots
+        :param float sync_interval: Min interval in seconds between
+                                    snapshots of a process
+        :param float stale_after: Age in seconds after which gauges of a
+                                  process snapshot are skipped
+        """
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.stale_after = stale_after
+
+        # definitions[<name>] = (<type>, <help>, <buckets>)
+        self.definitions = {}
+        # counters[(<name>, <labels>)] = <value>
+        self.counters = {}
+        # histograms[(<name>, <labels>)] = [<bucket counts>..., <sum>, <count>]
+        self.histograms = {}
+        # callables returning lists of (<name>, <labels dict>, <value>)
+        self.collectors = []
+        # monotonic time of the last snapshot, None if not written yet
+        self.last_sync = None
+        # timer of a deferred sync
+        self.sync_timer = None
+        # process ID and start time in the snapshot file name, as process
+        # IDs may be reused
+        self.pid = None
+        self.started = None
+        self.lock = threading.Lock()
+        if directory:
+            atexit.register(self.sync_on_exit)
+
+    def counter(self, name, help):
+        """Define a counter.
+
+        :param str name: Metric name
+        :param str help: Description
+        """
+        self.definitions[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        """Define a histogram.
+
+        :param str name: Metric name
+        :param str help: Description
+        :param tuple buckets: Upper bounds of buckets
+        """
+        self.definitions[name] = ("histogram", help, tuple(buckets))
+
+    def gauge(self, name, help):
+        """Define a gauge, whose values are returned by collectors.
+
+        :param str name: Metric name
+        :param str help: Description
+        """
+        self.definitions[name] = ("gauge", help, None)
+
+    def inc(self, name, labels, value=1):
+        """Increment counter.
+
+        :param str name: Metric name
+        :param dict labels: Label values
+        :param float value: Increment
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """Add observation to histogram.
+
+        :param str name: Metric name
+        :param dict labels: Label values
+        :param float value: Observed value
+        """
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def instrument_engine(self, engine, name):
+        """Record query durations per statement of a SQLAlchemy engine.
+
+        The statement label is taken from the 'statement_name' execution
+        option, e.g. set on prebuilt statements.
+
+        :param Engine engine: DB engine
+        :param str name: Metric name
+        """
+        if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            return
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            start = getattr(context, "_metrics_start", None)
+            if start is not None:
+                self.observe(name, {
+                    "statement": context.execution_options.get("statement_name", "other")
+                }, time.perf_counter() - start)
+
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    def snapshot(self):
+        """Return values of this process as JSON serializable dict."""
+        gauges = []
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.append([name, sorted(labels.items()), value])
+            except Exception:
+                pass
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, labels, values] for (name, labels), values in self.histograms.items()],
+                "gauges": gauges
+            }
+
+    def sync(self, force=False):
+        """Write snapshot of this process, if due, else schedule it.
+
+        :param bool force: Write even if the sync interval has not elapsed
+        """
+        if not self.directory:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if self.pid != os.getpid():
+                # new or forked process, without the timer thread of its parent
+                self.pid = os.getpid()
+                self.started = time.time_ns()
+                self.sync_timer = None
+            if not force and self.last_sync is not None and now - self.last_sync < self.sync_interval:
+                if self.sync_timer is None:
+                    # write the last values of a process which becomes idle
+                    self.sync_timer = threading.Timer(
+                        self.sync_interval - (now - self.last_sync), self.sync, kwargs={"force": True}
+                    )
+                    self.sync_timer.daemon = True
+                    self.sync_timer.start()
+                return
+            self.last_sync = now
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+            path = os.path.join(self.directory, "metrics_%d_%d.json" % (self.pid, self.started))
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(tmp_path, "w") as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(tmp_path, path)
+
+    def sync_on_exit(self):
+        """Write snapshot of this process on exit."""
+        try:
+            self.sync(force=True)
+        except OSError:
+            # e.g. directory removed on shutdown
+            pass
+
+    def merge_exited(self):
+        """Merge snapshots of exited processes into a single file.
+
+        Counters and histograms of exited processes are kept, so that the
+        sums do not decrease, gauges are dropped.
+        """
+        with open(os.path.join(self.directory, "metrics.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = [
+                path for path in glob.glob(os.path.join(self.directory, "metrics_*_*.json"))
+                if not process_alive(int(os.path.basename(path).split("_")[1]))
+            ]
+            if not exited:
+                return
+            path = os.path.join(self.directory, "metrics_exited.json")
+            snapshots = []
+            for snapshot_path in [path] + exited:
+                try:
+                    with open(snapshot_path) as fh:
+                        snapshots.append(json.load(fh))
+                except FileNotFoundError:
+                    pass
+                except ValueError:
+                    # incomplete snapshot, e.g. of a killed process
+                    pass
+            counters, histograms = merge_snapshots(snapshots)
+            with open(path + ".tmp", "w") as fh:
+                json.dump({
+                    "time": time.time(),
+                    "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                    "histograms": [[name, labels, values] for (name, labels), values in histograms.items()],
+                    "gauges": []
+                }, fh)
+            os.replace(path + ".tmp", path)
+            for snapshot_path in exited:
+                os.remove(snapshot_path)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        if self.directory:
+            self.sync(force=True)
+            self.merge_exited()
+            snapshots = {}
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                try:
+                    with open(path) as fh:
+                        snapshots[path] = json.load(fh)
+                except Exception:
+                    # removed or being replaced
+                    pass
+        else:
+            snapshots = {"": self.snapshot()}
+
+        counters, histograms = merge_snapshots(snapshots.values())
+        gauges = {}
+        now = time.time()
+        for path, snapshot in snapshots.items():
+            if now - snapshot["time"] > self.stale_after:
+                continue
+            pid = os.path.basename(path).split("_")[1] if path else str(os.getpid())
+            for name, labels, value in snapshot["gauges"]:
+                key = (name, tuple(map(tuple, labels)) + (("pid", pid),))
+                gauges[key] = value
+
+        lines = []
+        for name, (metric_type, help, buckets) in sorted(self.definitions.items()):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            if metric_type == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+            elif metric_type == "gauge":
+                for (metric, labels), value in sorted(gauges.items()):
+                    if metric == name:
+                        lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+            else:
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), values[:-2] + [values[-1]]):
+                        if bound == "+Inf":
+                            cumulative = count
+                        else:
+                            cumulative += count
+                        lines.append("%s_bucket%s %s" % (
+                            name, format_labels(labels + (("le", format_value(bound)),)),
+                            format_value(cumulative)
+                        ))
+                    lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(values[-2])))
+                    lines.append("%s_count%s %s" % (name, format_labels(labels), format_value(values[-1])))
+        return "\n".join(lines) + "\n"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def process_alive(pid):
+    """Return whether a process exists.
+
+    :param int pid: Process ID
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process of another user
+        pass
+    return True
+
+
+def merge_snapshots(snapshots):
+    """Return sums of counters and histograms of snapshots as dicts by
+    (<name>, <labels>).
+
+    :param iterable snapshots: Snapshots as returned by Metrics.snapshot()
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = list(values)
+    return counters, histograms
+
+
+def format_labels(labels):
+    """Return label set in exposition format.
+
+    :param tuple labels: Pairs of label name and value
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    """Return number in exposition format.
+
+    :param float value: Value
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
@@ -0,0 +1,577 @@
+"""Command line tools for the QWC Permalink Service.
+
+Usage:
+
+    python src/permalink_cli.py [--tenant <tenant>] <command> [<args>]
+
+Commands:
+
+    purge-expired       Delete expired permalinks and archive stale permalinks
+    recode              Re-encode stored payloads with a storage codec
+    export              Export rows as NDJSON
+    import              Import rows from NDJSON
+    create-partitions   Create monthly partitions of the permalinks table
+"""
+import argparse
+import datetime
+import io
+import logging
+import os
+import sys
+import time
+
+from qwc_services_core.runtime_config import RuntimeConfig
+from sqlalchemy.sql import text as sql_text
+
+import json_codec
+from bookmark_delta import BookmarkDeltas
+from db_connection import db_conn, db_engine
+from expiry_sweeper import ExpirySweeper
+from key_allocator import KeyAllocator
+from storage import create_storage
+from storage_codec import StorageCodec
+
+
+# TABLES[<name>] = (<config option>, <default table in qwc config schema>)
+TABLES = {
+    'permalinks': ('permalinks_table', 'permalinks'),
+    'user_permalinks': ('user_permalink_table', 'user_permalinks'),
+    'user_bookmarks': ('user_bookmark_table', 'user_bookmarks'),
+    'user_visibility_presets': ('user_visibility_presets_table', 'user_visibility_presets')
+}
+
+
+def table_name(config, qwc_config_schema, name):
+    """Return configured table for table name in TABLES."""
+    option, default = TABLES[name]
+    return config.get(option, qwc_config_schema + '.' + default)
+
+
+def table_columns(connection, table):
+    """Return list of column names of a table."""
+    return list(connection.execute(sql_text(
+        "SELECT * FROM {table} LIMIT 0".format(table=table)
+    )).keys())
+
+
+def log_progress(logger, table, action, rows, start):
+    """Log number of processed rows and throughput."""
+    elapsed = time.perf_counter() - start
+    logger.info("%s: %s %d rows in %.1fs (%.0f rows/s)" % (
+        table, action, rows, elapsed, rows / elapsed if elapsed > 0 else 0
+    ))
+
+
+def export_rows(args, config, logger):
+    """Export rows of a tenant as NDJSON, one JSON object per row.
+
+    Rows are streamed with a server-side cursor. Each object has the table
+    name in TABLES as "table", the decoded payload as "data" and the
+    further columns, except the tenant specific user_id and base_id. Delta
+    encoded bookmark payloads are exported reconstructed.
+    """
+    db, qwc_config_schema, users_table = db_conn(config)
+    deltas = BookmarkDeltas(
+        create_storage(config, db_engine, KeyAllocator(), logger), StorageCodec(), logger
+    )
+    out = open(args.output, 'wb') if args.output != '-' else sys.stdout.buffer
+
+    try:
+        for name in args.tables or TABLES:
+            table = table_name(config, qwc_config_schema, name)
+            with db.connect() as connection:
+                columns = [
+                    column for column in table_columns(connection, table)
+                    if column not in ('user_id', 'base_id')
+                ]
+                conditions = []
+                params = {}
+                if args.since:
+                    conditions.append("date >= :since")
+                    params["since"] = args.since
+                if args.until:
+                    conditions.append("date < :until")
+                    params["until"] = args.until
+                if 'expires' in columns:
+                    if args.expires_before:
+                        conditions.append("expires < :expires_before")
+                        params["expires_before"] = args.expires_before
+                    if args.exclude_expired:
+                        conditions.append("(expires IS NULL OR expires >= CURRENT_DATE)")
+                sql = sql_text("""
+                    SELECT {columns} FROM {table}
+                    {conditions}
+                """.format(
+                    columns=", ".join(columns), table=table,
+                    conditions="WHERE " + " AND ".join(conditions) if conditions else ""
+                ))
+                result = connection.execution_options(
+                    stream_results=True, yield_per=args.batch_size
+                ).execute(sql, params).mappings()
+
+                start = time.perf_counter()
+                exported = 0
+                for row in result:
+                    values = {"table": name}
+                    for column in columns:
+                        value = row[column]
+                        if column == 'data':
+                            continue
+                        elif column == 'key' and value is not None:
+                            value = value.rstrip(' ')
+                        elif isinstance(value, datetime.date):
+                            value = value.isoformat()
+                        values[column] = value
+                    # NOTE: embed stored JSON document without parsing it
+                    doc = deltas.decode_bytes(row["data"]) if row["data"] is not None else None
+                    if doc is None:
+                        doc = b'null'
+                    out.write(json_codec.dumps(values)[:-1] + b',"data":' + doc + b'}\n')
+                    exported += 1
+                    if exported % args.batch_size == 0:
+                        log_progress(logger, table, "exported", exported, start)
+                log_progress(logger, table, "exported", exported, start)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+def copy_value(value):
+    """Return value in COPY text format."""
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class Importer:
+    """Import rows of a table in batches.
+
+    Each batch is copied into a temporary table, from which rows are
+    inserted. Rows with the same key and payload as an existing row are
+    skipped. Rows whose key collides with an existing row are re-keyed
+    with new random keys. User permalinks of existing users are skipped.
+
+    Requires the psycopg2 driver, whose cursors copy rows with
+    copy_expert().
+    """
+
+    def __init__(self, db, name, table, users_table, codec, key_allocator, key_map, logger):
+        """Constructor
+
+        :param Engine db: DB engine
+        :param str name: Table name in TABLES
+        :param str table: Configured table
+        :param str users_table: Users table for user IDs, or None
+        :param StorageCodec codec: Storage codec for payloads
+        :param KeyAllocator key_allocator: Allocator for new keys
+        :param file key_map: Optional file for NDJSON of re-keyed rows
+        :param Logger logger: Logger
+        """
+        self.db = db
+        self.name = name
+        self.table = table
+        self.codec = codec
+        self.key_allocator = key_allocator
+        self.key_map = key_map
+        self.logger = logger
+
+        with db.connect() as connection:
+            self.columns = table_columns(connection, table)
+        self.users_table = users_table if 'user_id' in self.columns else None
+        self.keyed = 'key' in self.columns
+        # columns identifying a row
+        if self.keyed:
+            self.match = ['key'] + (['username'] if 'username' in self.columns else [])
+        else:
+            self.match = ['username']
+
+        self.rows = []
+        self.start = time.perf_counter()
+        self.processed = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.rekeyed = 0
+        self.failed = 0
+
+    def add(self, row, batch_size):
+        """Add row of NDJSON, import pending rows if batch is full."""
+        self.rows.append(row)
+        if len(self.rows) >= batch_size:
+            self.flush()
+
+    def flush(self):
+        """Import pending rows."""
+        if not self.rows:
+            return
+        columns = [
+            column for column in self.columns
+            if column not in ('user_id', 'base_id') and any(column in row for row in self.rows)
+        ]
+        for column in self.match + ['data']:
+            if column not in columns:
+                columns.append(column)
+        buffer = io.StringIO()
+        for row in self.rows:
+            if self.keyed and not row.get('key'):
+                row['key'] = self.key_allocator.generate()
+            values = []
+            for column in columns:
+                value = row.get(column)
+                if column == 'data' and value is not None:
+                    value = self.codec.encode_json(json_codec.dumps(value))
+                values.append(copy_value(value))
+            if self.keyed:
+                values.append(copy_value(row.get('key')))
+            buffer.write("\t".join(values) + "\n")
+        buffer.seek(0)
+
+        table = self.table
+
+        def match(a, b):
+            return " AND ".join("%s.%s = %s.%s" % (a, c, b, c) for c in self.match)
+
+        with self.db.begin() as connection:
+            connection.execute(sql_text("""
+                CREATE TEMP TABLE import_rows (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP
+            """.format(table=table)))
+            if self.keyed:
+                connection.execute(sql_text("ALTER TABLE import_rows ADD COLUMN import_key text"))
+            cursor = connection.connection.cursor()
+            cursor.copy_expert("COPY import_rows (%s) FROM STDIN" % ", ".join(
+                columns + (['import_key'] if self.keyed else [])
+            ), buffer)
+            if self.users_table:
+                connection.execute(sql_text("""
+                    UPDATE import_rows r SET user_id = u.id
+                    FROM {users_table} u WHERE u.name = r.username
+                """.format(users_table=self.users_table)))
+                columns = columns + ['user_id']
+
+            # skip already imported rows
+            self.skipped += connection.execute(sql_text("""
+                DELETE FROM import_rows r USING {table} t
+                WHERE {match} AND t.data IS NOT DISTINCT FROM r.data
+            """.format(table=table, match=match('t', 'r')))).rowcount
+
+            insert_sql = sql_text("""
+                WITH inserted AS (
+                    INSERT INTO {table} ({columns})
+                    SELECT {columns} FROM import_rows
+                    ON CONFLICT DO NOTHING
+                    RETURNING {match_columns}
+                )
+                DELETE FROM import_rows r USING inserted i
+                WHERE {match}
+                {returning}
+            """.format(
+                table=table, columns=", ".join(columns), match_columns=", ".join(self.match),
+                match=match('i', 'r'),
+                returning="RETURNING r.import_key, r.key" if self.keyed else ""
+            ))
+            self.insert(connection, insert_sql)
+
+            attempts = 0
+            while self.keyed and attempts < self.key_allocator.max_attempts:
+                collided = connection.execute(sql_text(
+                    "SELECT ctid FROM import_rows"
+                )).scalars().all()
+                if not collided:
+                    break
+                attempts += 1
+                connection.execute(sql_text("""
+                    UPDATE import_rows r SET key = n.key
+                    FROM unnest(CAST(:ctids AS tid[]), CAST(:keys AS text[])) AS n(ctid, key)
+                    WHERE r.ctid = n.ctid
+                """), {
+                    "ctids": collided,
+                    "keys": [self.key_allocator.generate() for ctid in collided]
+                })
+                self.insert(connection, insert_sql)
+
+            remaining = connection.execute(sql_text("SELECT count(*) FROM import_rows")).scalar()
+            if self.keyed:
+                self.failed += remaining
+            else:
+                # existing user permalinks
+                self.skipped += remaining
+
+        self.processed += len(self.rows)
+        self.rows = []
+        log_progress(self.logger, table, "processed", self.processed, self.start)
+
+    def insert(self, connection, insert_sql):
+        """Insert rows of the temporary table and count them."""
+        result = connection.execute(insert_sql)
+        if not self.keyed:
+            self.inserted += result.rowcount
+            return
+        for import_key, key in result:
+            self.inserted += 1
+            if import_key != key.rstrip(' '):
+                self.rekeyed += 1
+                self.logger.debug("%s: re-keyed %s as %s" % (self.table, import_key, key))
+                if self.key_map:
+                    self.key_map.write(json_codec.dumps({
+                        "table": self.name, "key": import_key, "new_key": key.rstrip(' ')
+                    }) + b'\n')
+
+    def summary(self):
+        """Log result of the import."""
+        self.logger.info("%s: %d inserted, %d re-keyed, %d skipped, %d failed" % (
+            self.table, self.inserted, self.rekeyed, self.skipped, self.failed
+        ))
+
+
+def import_rows(args, config, logger):
+    """Import NDJSON rows as exported by export_rows into a tenant."""
+    db, qwc_config_schema, users_table = db_conn(config)
+    if db.dialect.driver != 'psycopg2':
+        logger.error(
+            "Import requires the psycopg2 driver for COPY, the db_url uses '%s'" %
+            db.dialect.driver
+        )
+        return 1
+    codec = StorageCodec(
+        config.get('storage_codec', 'json'),
+        config.get('storage_codec_min_size', 1024),
+        logger
+    )
+    key_allocator = KeyAllocator(
+        config.get('key_length', 9),
+        config.get('key_alphabet', 'hex')
+    )
+    key_map = open(args.key_map, 'wb') if args.key_map else None
+    src = open(args.input, 'rb') if args.input != '-' else sys.stdin.buffer
+
+    # importers[<table name>] = <Importer>
+    importers = {}
+    try:
+        for line in src:
+            if not line.strip():
+                continue
+            row = json_codec.loads(line)
+            name = row.get("table")
+            if name not in TABLES:
+                logger.warning("Skipping row of unknown table %s" % name)
+                continue
+            if args.tables and name not in args.tables:
+                continue
+            importer = importers.get(name)
+            if importer is None:
+                importer = importers[name] = Importer(
+                    db, name, table_name(config, qwc_config_schema, name), users_table,
+                    codec, key_allocator, key_map, logger
+                )
+            importer.add(row, args.batch_size)
+        for importer in importers.values():
+            importer.flush()
+            importer.summary()
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+        if key_map:
+            key_map.close()
+    return 1 if any(importer.failed for importer in importers.values()) else 0
+
+
+def purge_expired(args, config, logger):
+    """Purge expired permalinks of a tenant."""
+    storage = create_storage(config, db_engine, KeyAllocator(), logger)
+    batch_size = args.batch_size or config.get('expiry_sweep_batch_size', 1000)
+
+    sweeper = ExpirySweeper(logger, batch_size=batch_size)
+    purged = sweeper.purge(storage)
+    return 0 if purged is not None else 1
+
+
+def partition_name(table, month):
+    """Return name of the partition of a table for a month."""
+    suffix = "_y%04dm%02d" % (month.year, month.month)
+    if table.endswith('"'):
+        return table[:-1] + suffix + '"'
+    return table + suffix
+
+
+def create_partitions(args, config, logger):
+    """Create missing monthly partitions of the partitioned permalinks table,
+    starting with the current month."""
+    db, qwc_config_schema, users_table = db_conn(config)
+    table = table_name(config, qwc_config_schema, 'permalinks')
+
+    month = datetime.date.today().replace(day=1)
+    with db.begin() as connection:
+        for i in range(args.months):
+            next_month = (month + datetime.timedelta(days=31)).replace(day=1)
+            partition = partition_name(table, month)
+            connection.execute(sql_text("""
+                CREATE TABLE IF NOT EXISTS {partition}
+                PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')
+            """.format(
+                partition=partition, table=table,
+                start=month.isoformat(), end=next_month.isoformat()
+            )))
+            logger.info("%s: partition %s for %s to %s" % (table, partition, month, next_month))
+            month = next_month
+    return 0
+
+
+def recode(args, config, logger):
+    """Re-encode stored payloads of a tenant in batches."""
+    db, qwc_config_schema, users_table = db_conn(config)
+    codec = StorageCodec(
+        args.codec or config.get('storage_codec', 'json'),
+        config.get('storage_codec_min_size', 1024),
+        logger
+    )
+
+    for name in args.tables or TABLES:
+        table = table_name(config, qwc_config_schema, name)
+        # NOTE: rows updated concurrently get a new ctid and are skipped
+        select_sql = sql_text("""
+            SELECT ctid, data FROM {table}
+            WHERE ctid > CAST(:last AS tid) AND data IS NOT NULL
+            ORDER BY ctid
+            LIMIT :batch_size
+        """.format(table=table))
+        update_sql = sql_text("""
+            UPDATE {table} SET data = :data
+            WHERE ctid = CAST(:ctid AS tid)
+        """.format(table=table))
+
+        start = time.perf_counter()
+        last = '(0,0)'
+        scanned = 0
+        recoded = 0
+        while True:
+            with db.begin() as connection:
+                rows = connection.execute(
+                    select_sql, {"last": last, "batch_size": args.batch_size}
+                ).all()
+                if not rows:
+                    break
+                updates = [
+                    {"ctid": row.ctid, "data": codec.encode(StorageCodec.decode(row.data))}
+                    for row in rows if not codec.is_encoded(row.data)
+                ]
+                if updates:
+                    connection.execute(update_sql, updates)
+            last = rows[-1].ctid
+            scanned += len(rows)
+            recoded += len(updates)
+            logger.info("%s: scanned %d rows, re-encoded %d rows" % (table, scanned, recoded))
+
+        logger.info("%s: re-encoded %d of %d rows with codec '%s' in %.3fs" % (
+            table, recoded, scanned, codec.codec, time.perf_counter() - start
+        ))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Command line tools for the QWC Permalink Service"
+    )
+    parser.add_argument(
+        '--tenant', default=os.environ.get('DEFAULT_TENANT', 'default'),
+        help="Tenant ID (default: %(default)s)"
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    purge_parser = subparsers.add_parser(
+        'purge-expired', help="Delete expired permalinks and archive stale permalinks"
+    )
+    purge_parser.add_argument(
+        '--batch-size', type=int,
+        help="Max number of rows deleted or archived per statement "
+             "(default: expiry_sweep_batch_size from config)"
+    )
+    purge_parser.set_defaults(func=purge_expired)
+
+    recode_parser = subparsers.add_parser(
+        'recode', help="Re-encode stored payloads with a storage codec"
+    )
+    recode_parser.add_argument(
+        '--codec', choices=['json', 'zlib', 'zstd'],
+        help="Target codec (default: storage_codec from config)"
+    )
+    recode_parser.add_argument(
+        '--table', dest='tables', action='append', choices=list(TABLES),
+        help="Table to re-encode, can be repeated (default: all tables)"
+    )
+    recode_parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help="Number of rows per transaction (default: %(default)s)"
+    )
+    recode_parser.set_defaults(func=recode)
+
+    export_parser = subparsers.add_parser('export', help="Export rows as NDJSON")
+    export_parser.add_argument(
+        '--output', default='-', help="Output file (default: stdout)"
+    )
+    export_parser.add_argument(
+        '--table', dest='tables', action='append', choices=list(TABLES),
+        help="Table to export, can be repeated (default: all tables)"
+    )
+    export_parser.add_argument(
+        '--since', type=datetime.date.fromisoformat,
+        help="Only rows created on or after this date (YYYY-MM-DD)"
+    )
+    export_parser.add_argument(
+        '--until', type=datetime.date.fromisoformat,
+        help="Only rows created before this date (YYYY-MM-DD)"
+    )
+    export_parser.add_argument(
+        '--expires-before', type=datetime.date.fromisoformat,
+        help="Only permalinks expiring before this date (YYYY-MM-DD)"
+    )
+    export_parser.add_argument(
+        '--exclude-expired', action='store_true',
+        help="Skip permalinks past their expiry date"
+    )
+    export_parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help="Number of rows fetched per round trip (default: %(default)s)"
+    )
+    export_parser.set_defaults(func=export_rows)
+
+    import_parser = subparsers.add_parser('import', help="Import rows from NDJSON")
+    import_parser.add_argument(
+        '--input', default='-', help="Input file (default: stdin)"
+    )
+    import_parser.add_argument(
+        '--table', dest='tables', action='append', choices=list(TABLES),
+        help="Table to import, can be repeated (default: all tables)"
+    )
+    import_parser.add_argument(
+        '--key-map',
+        help="Output file for NDJSON of re-keyed rows with their old and new key"
+    )
+    import_parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help="Number of rows per transaction (default: %(default)s)"
+    )
+    import_parser.set_defaults(func=import_rows)
+
+    partitions_parser = subparsers.add_parser(
+        'create-partitions', help="Create monthly partitions of the permalinks table"
+    )
+    partitions_parser.add_argument(
+        '--months', type=int, default=12,
+        help="Number of months starting with the current month (default: %(default)s)"
+    )
+    partitions_parser.set_defaults(func=create_partitions)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    logger = logging.getLogger("permalink_cli")
+    config = RuntimeConfig("permalink", logger).tenant_config(args.tenant)
+
+    return args.func(args, config, logger)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from qwc_services_core.auth import get_groups, get_username
+from qwc_services_core.permissions_reader import PermissionsReader
+
+from caches import TTLCache
+from request_profiler import phase
+
+
+class PermissionsCache:
+    """Shared permissions of a tenant with memoized per-identity lookups.
+
+    The permissions are loaded once and reloaded after a time-to-live.
+    Changes of the permissions file are detected by the tenant handler,
+    which discards the registered cache if the file has been modified.
+    """
+
+    def __init__(self, tenant, logger, ttl=300, maxsize=1000):
+        """Constructor
+
+        :param str tenant: Tenant ID
+        :param Logger logger: Application logger
+        :param float ttl: Time in seconds after which permissions are
+                          reloaded (0 disables reloading)
+        :param int maxsize: Max number of memoized identities
+        """
+        self.tenant = tenant
+        self.logger = logger
+        self.ttl = ttl
+        self.reader = PermissionsReader(tenant, logger)
+        self.loaded_at = time.monotonic()
+        # generation of loaded permissions, part of memoized keys
+        self.generation = 0
+        self.lookups = TTLCache(maxsize, ttl or float('inf'))
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        """Return reader and generation, reloading permissions if expired."""
+        with self.lock:
+            if self.ttl and time.monotonic() - self.loaded_at >= self.ttl:
+                try:
+                    self.reader = PermissionsReader(self.tenant, self.logger)
+                    self.generation += 1
+                    self.reloads += 1
+                    self.lookups.clear()
+                except Exception as e:
+                    # keep previous permissions
+                    self.logger.warning("Could not reload permissions: %s" % e)
+                self.loaded_at = time.monotonic()
+            return self.reader, self.generation
+
+    def capabilities(self, identity):
+        """Return set of permitted capabilities of identity.
+
+        :param obj identity: User identity
+        """
+        with phase('permissions'):
+            reader, generation = self.current()
+            key = (
+                generation, 'capabilities', get_username(identity),
+                tuple(sorted(set(get_groups(identity) or [])))
+            )
+            capabilities = self.lookups.get(key)
+            if capabilities is None:
+                capabilities = frozenset(
+                    reader.resource_permissions('capabilities', identity)
+                )
+                self.lookups.set(key, capabilities)
+            return capabilities
+
+    def user_groups(self, username):
+        """Return set of groups of a user.
+
+        :param str username: User name
+        """
+        with phase('permissions'):
+            reader, generation = self.current()
+            key = (generation, 'user_groups', username)
+            groups = self.lookups.get(key)
+            if groups is None:
+                groups = frozenset(
+                    reader.permissions['user_groups'].get(username, []) or []
+                )
+                self.lookups.set(key, groups)
+            return groups
+
+    def stats(self):
+        """Return dict with lookup counters."""
+        return self.lookups.stats() | {
+            "generation": self.generation,
+            "reloads": self.reloads
+        }
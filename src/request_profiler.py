@@ -0,0 +1,247 @@
+import contextlib
+import contextvars
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+
+from flask_restx import reqparse
+from sqlalchemy import event
+
+
+# timings of the current request, None if not timed
+current = contextvars.ContextVar('request_timings', default=None)
+
+# context manager of phases of requests which are not timed
+NO_PHASE = contextlib.nullcontext()
+
+
+class RequestTimings:
+    """Durations of the phases of a request."""
+
+    def __init__(self, sampled):
+        """Constructor
+
+        :param bool sampled: Whether the request is sampled, i.e. gets a
+                             Server-Timing header and optionally a profile
+        """
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        # phases[<name>] = [<total duration in seconds>, <count>]
+        self.phases = {}
+        # cProfile profile of a sampled request
+        self.profile = None
+
+    def add(self, name, duration):
+        """Add duration of a phase.
+
+        :param str name: Phase name
+        :param float duration: Duration in seconds
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [duration, 1]
+        else:
+            phase[0] += duration
+            phase[1] += 1
+
+
+class Phase:
+    """Context manager adding its duration to the timings of a request."""
+
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+def phase(name):
+    """Return context manager timing a phase of the current request.
+
+    :param str name: Phase name, e.g. 'auth', 'tenant', 'permissions' or
+                     'json'
+    """
+    timings = current.get()
+    if timings is None:
+        return NO_PHASE
+    return Phase(timings, name)
+
+
+class TimedRequestParser(reqparse.RequestParser):
+    """Request parser timing parse_args() as 'args' phase."""
+
+    def parse_args(self, *args, **kwargs):
+        with phase('args'):
+            return super().parse_args(*args, **kwargs)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current.get() is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_profile_start", None)
+    timings = current.get()
+    if start is not None and timings is not None:
+        timings.add('sql', time.perf_counter() - start)
+
+
+def instrument_engine(engine):
+    """Time queries of a SQLAlchemy engine as 'sql' phase.
+
+    :param Engine engine: DB engine, or sync engine of an async engine
+    """
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class RequestProfiler:
+    """Opt-in timing of the phases of requests.
+
+    Requests are timed if sampled, i.e. with a probability of sample_rate
+    or if the request header PROFILE_HEADER matches the header token, or
+    if slow requests are logged. Sampled requests get a Server-Timing
+    response header with the duration of each phase and, if a profile
+    directory is set, are run with cProfile, with the stats written to
+    the directory. Requests slower than slow_threshold are logged with
+    their timings as JSON.
+
+    Time outside of the timed phases is reported as 'other'.
+    """
+
+    # request header enabling profiling
+    PROFILE_HEADER = 'X-Profile'
+
+    def __init__(self, logger, sample_rate=0, header_token=None,
+                 slow_threshold=0, profile_dir=None):
+        """Constructor
+
+        :param Logger logger: Application logger
+        :param float sample_rate: Fraction of requests which are sampled
+        :param str header_token: Value of the X-Profile header sampling a
+                                 request, None to ignore the header
+        :param float slow_threshold: Min duration in seconds of requests
+                                     logged as slow (0 disables)
+        :param str profile_dir: Optional directory for cProfile stats of
+                                sampled requests
+        """
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.header_token = header_token
+        self.slow_threshold = slow_threshold
+        self.profile_dir = profile_dir
+        self.enabled = bool(sample_rate or header_token or slow_threshold)
+        # only one cProfile profiler can be active at a time
+        self.profile_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, logger):
+        """Return profiler configured by the environment variables
+        PROFILE_SAMPLE_RATE, PROFILE_HEADER_TOKEN, SLOW_REQUEST_THRESHOLD
+        and PROFILE_DIR.
+
+        :param Logger logger: Application logger
+        """
+        return cls(
+            logger,
+            float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+            os.environ.get('PROFILE_HEADER_TOKEN') or None,
+            float(os.environ.get('SLOW_REQUEST_THRESHOLD', 0)),
+            os.environ.get('PROFILE_DIR') or None
+        )
+
+    def start(self, headers):
+        """Start timing the current request if enabled.
+
+        :param Headers headers: Request headers
+        """
+        if not self.enabled:
+            return
+        sampled = (
+            (self.sample_rate and random.random() < self.sample_rate) or
+            (self.header_token is not None and headers.get(self.PROFILE_HEADER) == self.header_token)
+        )
+        if not sampled and not self.slow_threshold:
+            return
+        timings = RequestTimings(bool(sampled))
+        if sampled and self.profile_dir and self.profile_lock.acquire(blocking=False):
+            timings.profile = cProfile.Profile()
+            try:
+                timings.profile.enable()
+            except Exception:
+                timings.profile = None
+                self.profile_lock.release()
+        current.set(timings)
+
+    def finish(self, response, name, labels):
+        """Stop timing the current request, add Server-Timing header if
+        sampled and log it if slow.
+
+        :param Response response: Response
+        :param str name: Request name for the profile file, e.g. route
+        :param dict labels: Fields of the slow request log
+        """
+        timings = current.get()
+        if timings is None:
+            return response
+        current.set(None)
+        duration = time.perf_counter() - timings.start
+        if timings.profile is not None:
+            timings.profile.disable()
+            self.profile_lock.release()
+            self.dump_profile(timings.profile, name)
+
+        phases = dict(timings.phases)
+        phases['other'] = [max(0, duration - sum(phase[0] for phase in phases.values())), 1]
+        if timings.sampled:
+            response.headers['Server-Timing'] = ", ".join([
+                "%s;dur=%.3f" % (phase_name, phase[0] * 1000)
+                for phase_name, phase in phases.items()
+            ] + ["total;dur=%.3f" % (duration * 1000)])
+        if self.slow_threshold and duration >= self.slow_threshold:
+            self.logger.warning("Slow request: %s" % json.dumps(labels | {
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 3),
+                "phases_ms": {
+                    phase_name: round(phase[0] * 1000, 3) for phase_name, phase in phases.items()
+                },
+                "counts": {phase_name: phase[1] for phase_name, phase in timings.phases.items()}
+            }, sort_keys=True))
+        return response
+
+    def abort(self):
+        """Stop timing the current request without reporting it, e.g. on
+        teardown after an unhandled exception."""
+        timings = current.get()
+        if timings is None:
+            return
+        current.set(None)
+        if timings.profile is not None:
+            timings.profile.disable()
+            self.profile_lock.release()
+
+    def dump_profile(self, profile, name):
+        """Write cProfile stats to the profile directory.
+
+        :param Profile profile: Profile of a request
+        :param str name: Request name
+        """
+        path = os.path.join(self.profile_dir, "%s-%d-%d.prof" % (
+            name, os.getpid(), time.time_ns()
+        ))
+        try:
+            profile.dump_stats(path)
+        except Exception as e:
+            self.logger.warning("Could not write profile %s: %s" % (path, e))
@@ -1,25 +1,33 @@
-from flask import Flask, request, jsonify, make_response
-from flask_restx import Resource, reqparse
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
+from flask_jwt_extended import verify_jwt_in_request
+from flask_restx import Resource
 import datetime
+import functools
 import hashlib
 import os
-import random
-import json
+import re
 import time
-from urllib.parse import urlparse, parse_qsl
-from sqlalchemy.sql import text as sql_text
+from urllib.parse import urlencode, urlparse, parse_qsl
 
 from qwc_services_core.api import Api, CaseInsensitiveArgument
-from qwc_services_core.auth import auth_manager, optional_auth, get_identity, get_username
-from qwc_services_core.database import DatabaseEngine
-from qwc_services_core.permissions_reader import PermissionsReader
+from qwc_services_core.auth import auth_manager, get_identity, get_username
 from qwc_services_core.tenant_handler import (
     TenantHandler, TenantPrefixMiddleware, TenantSessionInterface)
 from qwc_services_core.runtime_config import RuntimeConfig
 
+import json_codec
+from db_connection import db_engine
+from health_check import pool_status
+from metrics import Metrics, ATTEMPT_BUCKETS, BATCH_BUCKETS, QUERY_BUCKETS, SIZE_BUCKETS
+import request_profiler
+from request_profiler import RequestProfiler, TimedRequestParser
+from storage_codec import StorageCodec
+from tenant_context import TenantContext
+
 
 # Flask application
 app = Flask(__name__)
+app.json = json_codec.JSONProvider(app)
 api = Api(app, version='1.0', title='Permalink API',
           description='API for QWC Permalink service',
           default_label='Permalink operations', doc='/api/')
@@ -35,37 +43,392 @@ app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
 app.session_interface = TenantSessionInterface()
 
 config_handler = RuntimeConfig("permalink", app.logger)
-db_engine = DatabaseEngine()
+
+# Metrics, shared by worker processes via PROMETHEUS_MULTIPROC_DIR
+metrics = Metrics(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+metrics.counter('qwc_permalink_requests_total', "Number of requests by route, method, tenant and status")
+metrics.histogram('qwc_permalink_request_duration_seconds', "Request duration by route, method and tenant")
+metrics.histogram('qwc_permalink_request_payload_bytes', "Request body size by route and method", SIZE_BUCKETS)
+metrics.histogram('qwc_permalink_response_payload_bytes', "Response body size by route and method", SIZE_BUCKETS)
+metrics.histogram('qwc_permalink_db_query_duration_seconds', "DB query duration by statement", QUERY_BUCKETS)
+metrics.counter('qwc_permalink_key_collisions_total', "Number of key collisions on insert by tenant")
+metrics.counter('qwc_permalink_key_failures_total', "Number of rows without free key after max attempts by tenant")
+metrics.histogram('qwc_permalink_key_attempts', "Number of key attempts per inserted row by tenant", ATTEMPT_BUCKETS)
+metrics.histogram('qwc_permalink_group_commit_batch_size', "Number of permalinks per group commit by tenant", BATCH_BUCKETS)
+metrics.histogram('qwc_permalink_group_commit_wait_seconds', "Time a group commit batch was kept open by tenant", QUERY_BUCKETS)
+metrics.counter('qwc_permalink_expired_purged_total', "Number of permalinks deleted past their expiry date by tenant")
+metrics.counter('qwc_permalink_archived_total', "Number of permalinks moved to the archive table by tenant")
+metrics.histogram('qwc_permalink_expiry_sweep_duration_seconds', "Duration of purges of expired and stale permalinks by tenant")
+metrics.counter('qwc_permalink_db_reads_total', "Number of DB reads by tenant and role")
+metrics.counter('qwc_permalink_replica_failures_total', "Number of failed reads on the read-only DB by tenant")
+metrics.counter('qwc_permalink_negative_cache_hits_total', "Number of lookups of unknown keys answered without DB query by tenant and table")
+metrics.gauge('qwc_permalink_resolve_cache_hits', "Number of resolve cache hits of the process by tenant")
+metrics.gauge('qwc_permalink_resolve_cache_misses', "Number of resolve cache misses of the process by tenant")
+metrics.gauge('qwc_permalink_resolve_cache_size', "Number of permalinks in the resolve cache of the process by tenant")
+metrics.gauge('qwc_permalink_db_pool_size', "Size of the DB connection pool by tenant and role")
+metrics.gauge('qwc_permalink_db_pool_checked_out', "Number of DB connections in use by tenant and role")
+metrics.gauge('qwc_permalink_db_pool_overflow', "Number of DB connections in overflow of the pool by tenant and role")
+
+
+def tenant_contexts():
+    """ Return list of (tenant, context) of the loaded tenant contexts """
+    handlers = tenant_handler.handler_cache.get('context', {})
+    return [(tenant, handler['handler']) for tenant, handler in list(handlers.items())]
+
+def db_pool_stats():
+    """ Return pool stats of the DB engines of the loaded tenants by role for metrics """
+    stats = []
+    for tenant, ctx in tenant_contexts():
+        for role, status in db_pools(ctx).items():
+            if status["size"] is None:
+                continue
+            labels = {"tenant": tenant, "role": role}
+            stats.append(('qwc_permalink_db_pool_size', labels, status["size"]))
+            stats.append(('qwc_permalink_db_pool_checked_out', labels, status["checked_out"]))
+            stats.append(('qwc_permalink_db_pool_overflow', labels, status["overflow"]))
+    return stats
+
+def tenant_stats():
+    """ Return stats of the helpers of the loaded tenants for metrics """
+    stats = []
+    for tenant, ctx in tenant_contexts():
+        labels = {"tenant": tenant}
+        helpers = ctx.stats()
+        resolve_cache = helpers["resolve_cache"]
+        stats.append(('qwc_permalink_resolve_cache_hits', labels, resolve_cache["hits"]))
+        stats.append(('qwc_permalink_resolve_cache_misses', labels, resolve_cache["misses"]))
+        stats.append(('qwc_permalink_resolve_cache_size', labels, resolve_cache.get(
+            "size", resolve_cache.get("local_size")
+        )))
+    return stats
+
+metrics.collectors.append(db_pool_stats)
+metrics.collectors.append(tenant_stats)
+
+# Opt-in timing of request phases, configured by environment variables
+profiler = RequestProfiler.from_env(app.logger)
+
+
+def optional_auth(fn):
+    """ Optional JWT authentication view decorator, timing JWT verification """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with request_profiler.phase('auth'):
+            verify_jwt_in_request(optional=True)
+        return fn(*args, **kwargs)
+    return wrapper
 
 
 # request parser
-createpermalink_parser = reqparse.RequestParser(argument_class=CaseInsensitiveArgument)
+createpermalink_parser = TimedRequestParser(argument_class=CaseInsensitiveArgument)
 createpermalink_parser.add_argument('url', required=False)
 createpermalink_parser.add_argument('permitted_group', required=False)
 
-resolvepermalink_parser = reqparse.RequestParser(argument_class=CaseInsensitiveArgument)
+createpermalinks_parser = TimedRequestParser(argument_class=CaseInsensitiveArgument)
+createpermalinks_parser.add_argument('url', required=False, location='args')
+createpermalinks_parser.add_argument('permitted_group', required=False, location='args')
+
+resolvepermalink_parser = TimedRequestParser(argument_class=CaseInsensitiveArgument)
 resolvepermalink_parser.add_argument('key', required=True)
 
-userbookmark_parser = reqparse.RequestParser(argument_class=CaseInsensitiveArgument)
+bookmarkslist_parser = TimedRequestParser(argument_class=CaseInsensitiveArgument)
+bookmarkslist_parser.add_argument('limit', type=int, required=False, location='args')
+bookmarkslist_parser.add_argument('after', required=False, location='args')
+bookmarkslist_parser.add_argument('stream', required=False, location='args')
+
+userbookmark_parser = TimedRequestParser(argument_class=CaseInsensitiveArgument)
 userbookmark_parser.add_argument('theme_id', required=False)
 userbookmark_parser.add_argument('url', required=False)
 userbookmark_parser.add_argument('description')
 userbookmark_parser.add_argument('public', required=False)
 
-def db_conn(config):
-    db_url = config.get('db_url', 'postgresql:///?service=qwc_configdb')
-    qwc_config_schema = config.get('qwc_config_schema', 'qwc_config')
-    db = db_engine.db_engine(db_url)
+def tenant_context():
+    """ Return the context of the current tenant """
+    with request_profiler.phase('tenant'):
+        return load_tenant_context()
+
+def load_tenant_context():
+    """ Return the context of the current tenant, creating it if needed """
+    tenant = tenant_handler.tenant()
+    ctx = tenant_handler.handler('permalink', 'context', tenant)
+    if ctx is None:
+        ctx = tenant_handler.register_handler('context', tenant, TenantContext(
+            tenant, config_handler.tenant_config(tenant), db_engine, app.logger
+        ))
+        for engine in (ctx.db, getattr(ctx.storage, 'db_readonly', None)):
+            if engine is not None:
+                metrics.instrument_engine(engine, 'qwc_permalink_db_query_duration_seconds')
+                if profiler.enabled:
+                    request_profiler.instrument_engine(engine)
+
+        def key_allocation(collisions, failures, attempts):
+            if collisions:
+                metrics.inc('qwc_permalink_key_collisions_total', {"tenant": tenant}, collisions)
+            if failures:
+                metrics.inc('qwc_permalink_key_failures_total', {"tenant": tenant}, failures)
+            for row_attempts in attempts:
+                metrics.observe('qwc_permalink_key_attempts', {"tenant": tenant}, row_attempts)
+        ctx.key_allocator.listener = key_allocation
+
+        def group_commit(batch_size, wait):
+            metrics.observe('qwc_permalink_group_commit_batch_size', {"tenant": tenant}, batch_size)
+            metrics.observe('qwc_permalink_group_commit_wait_seconds', {"tenant": tenant}, wait)
+        if ctx.group_commit is not None:
+            ctx.group_commit.listener = group_commit
+
+        def short_circuited(table):
+            metrics.inc('qwc_permalink_negative_cache_hits_total', {"tenant": tenant, "table": table})
+        ctx.negative_cache.listener = short_circuited
+
+        def expiry_sweep(purged, archived, duration):
+            metrics.inc('qwc_permalink_expired_purged_total', {"tenant": tenant}, purged)
+            metrics.inc('qwc_permalink_archived_total', {"tenant": tenant}, archived)
+            metrics.observe('qwc_permalink_expiry_sweep_duration_seconds', {"tenant": tenant}, duration)
+        ctx.expiry_sweeper.listener = expiry_sweep
+
+        def storage_read(counter):
+            if counter == 'replica_failures':
+                metrics.inc('qwc_permalink_replica_failures_total', {"tenant": tenant})
+            else:
+                metrics.inc('qwc_permalink_db_reads_total', {
+                    "tenant": tenant, "role": "replica" if counter == 'replica_reads' else "primary"
+                })
+        ctx.storage.listener = storage_read
+    return ctx
+
+ALLOW_PUBLIC_BOOKMARKS = os.environ.get("ALLOW_PUBLIC_BOOKMARKS", "False").lower() == "true"
+
+def private_cache_control(cache_control):
+    """ Return Cache-Control value restricted to private caches """
+    if "public" in cache_control:
+        return cache_control.replace("public", "private")
+    elif "private" not in cache_control:
+        return "private, " + cache_control
+    return cache_control
+
+
+def conditional_response(data, cache_control, etag=None):
+    """ Return JSON response with ETag and Cache-Control headers
+
+    Returns 304 Not Modified if the ETag matches If-None-Match.
 
-    store_bookmarks_by_userid = config.get('store_bookmarks_by_userid', True)
-    if store_bookmarks_by_userid:
-        users_table = f'"{qwc_config_schema}"."users"'
+    :param obj data: Response data, or JSON document as bytes
+    :param str cache_control: Cache-Control header value
+    :param str etag: ETag, computed from the response body if not set
+    """
+    if isinstance(data, bytes):
+        response = app.response_class(data, mimetype=app.json.mimetype)
     else:
-        users_table = None
+        response = jsonify(data)
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+
+def store_permalinks(ctx, items, permitted_group):
+    """ Store permalink payloads, return list of (key, expires) per item """
+    config = ctx.config
+    default_expiry_period = config.get('default_expiry_period', None)
+    dedup_permalinks = config.get('dedup_permalinks', False)
+
+    date = datetime.date.today().strftime(r"%Y-%m-%d")
+    expires = None
+    if default_expiry_period:
+        delta = datetime.timedelta(days=default_expiry_period)
+        expires = (datetime.date.today() + delta).strftime(r"%Y-%m-%d")
+
+    codec = ctx.storage_codec
+    raws = [json_codec.dumps(data) for data in items]
+    datastrs = [codec.encode_json(raw) for raw in raws]
+    hashes = None
+    if dedup_permalinks:
+        # Hash of canonical JSON to look up identical payloads
+        hashes = [hashlib.sha256(raw).hexdigest() for raw in raws]
+
+    storage = ctx.storage
+    if ctx.group_commit is not None and len(items) == 1:
+        # NOTE: batches of permalinks are already stored with a single statement
+        storage = ctx.group_commit
+    try:
+        results = storage.store_permalinks(datastrs, hashes, date, expires, permitted_group)
+    except Exception as e:
+        app.logger.debug("Query failed: %s" % str(e))
+        results = [(None, expires)] * len(items)
+    app.logger.debug("Key allocator stats: %s" % ctx.key_allocator.stats())
+
+    for key, key_expires in results:
+        if key:
+            # Drop any stale entry of a purged permalink with the same key,
+            # or of a reused permalink with extended expiry
+            ctx.resolve_cache.invalidate(key)
+            ctx.negative_cache.add_existing('permalinks', key)
+
+    # Delete permalinks past expiry date in the background
+    ctx.expiry_sweeper.schedule(ctx.storage)
+
+    return results
+
+
+def cached_permalinks(ctx, keys):
+    """ Return dict of cached permalink entries by key and list of keys to look up """
+    today = datetime.date.today()
+    cache = ctx.resolve_cache
+    negative = ctx.negative_cache
+
+    entries = {}
+    lookup = []
+    for key in keys:
+        if key in entries or key in lookup:
+            continue
+        entry = cache.get(key)
+        if entry and entry["expires"] and entry["expires"] < today:
+            cache.invalidate(key)
+            entry = None
+        if entry is not None:
+            entries[key] = entry
+        elif negative.known_missing('permalinks', key):
+            app.logger.debug("Permalink %s is known not to exist" % key)
+        else:
+            lookup.append(key)
+    app.logger.debug("Resolve cache stats: %s" % cache.stats())
+    return entries, lookup
+
+
+def response_body(doc):
+    """ Return response body for a stored permalink or bookmark document
+
+    The stored document is returned as is, unless the legacy permalinkParams
+    need to be merged into the query.
+
+    :param bytes doc: Stored JSON document
+    """
+    if b'"permalinkParams"' not in doc:
+        return doc
+    data = json_codec.loads(doc)
+
+    # Backward compatibility
+    if "permalinkParams" in data.get("state", {}):
+        data["query"] = data.get("query") | data["state"]["permalinkParams"]
+        return json_codec.dumps(data)
+    return doc
+
+
+def add_stored_permalinks(ctx, entries, lookup, rows):
+    """ Add entries of stored permalinks of looked up keys and cache them
+
+    :param TenantContext ctx: Tenant context
+    :param dict entries: Permalink entries by key
+    :param list lookup: Looked up keys
+    :param dict rows: Stored permalinks by key, as returned by the storage
+    """
+    cache = ctx.resolve_cache
+    for key in lookup:
+        row = rows.get(key.rstrip(' '))
+        if row is not None:
+            entries[key] = {
+                "body": response_body(StorageCodec.decode_bytes(row["data"])),
+                "permitted_group": row["permitted_group"],
+                "expires": row["expires"],
+                "etag": hashlib.sha256(row["data"].encode('utf-8')).hexdigest()[0:32]
+            }
+            cache.set(key, entries[key])
+        else:
+            ctx.negative_cache.add_missing('permalinks', key)
 
-    return db, qwc_config_schema, users_table
 
-ALLOW_PUBLIC_BOOKMARKS = os.environ.get("ALLOW_PUBLIC_BOOKMARKS", "False").lower() == "true"
+def resolve_permalinks(ctx, keys):
+    """ Return list of cached or stored permalink entries per key, None if not found """
+    entries, lookup = cached_permalinks(ctx, keys)
+    if lookup:
+        try:
+            add_stored_permalinks(ctx, entries, lookup, ctx.storage.get_permalinks(lookup))
+        except Exception as e:
+            app.logger.debug("Query failed: %s" % str(e))
+    ctx.storage.record_access(list(entries))
+
+    return [entries.get(key) for key in keys]
+
+
+def user_groups(ctx):
+    """ Return the groups of the current user """
+    username = get_username(get_identity())
+    return ctx.permissions.user_groups(username)
+
+
+def permalink_response_body(key, entry, groups):
+    """ Return response body for a resolved permalink entry
+
+    :param str key: Permalink key
+    :param obj entry: Resolved entry or None
+    :param list groups: Groups of the current user, if entry is restricted
+    """
+    if not entry:
+        return b'{}'
+
+    permitted_group = entry["permitted_group"]
+    if permitted_group:
+        app.logger.debug("Permalink %s is restricted to group %s" % (key, permitted_group))
+        if permitted_group not in groups:
+            app.logger.debug("User %s is not in group %s, returning empty response" % (
+                get_username(get_identity()), permitted_group
+            ))
+            return b'{}'
+
+    return entry["body"]
+
+
+def resolve_response(ctx, key, entry):
+    """ Return response for a resolved permalink entry
+
+    :param TenantContext ctx: Tenant context
+    :param str key: Permalink key
+    :param obj entry: Resolved entry or None
+    """
+    groups = user_groups(ctx) if entry and entry["permitted_group"] else []
+    body = permalink_response_body(key, entry, groups)
+    if body == b'{}':
+        return jsonify({})
+
+    cache_control = ctx.config.get('permalink_cache_control', 'public, max-age=3600')
+    if entry["permitted_group"]:
+        cache_control = private_cache_control(cache_control)
+    if entry["expires"]:
+        # Do not cache beyond expiry date
+        expiry = datetime.datetime.combine(
+            entry["expires"] + datetime.timedelta(days=1), datetime.time()
+        )
+        max_age = max(0, int((expiry - datetime.datetime.now()).total_seconds()))
+        cache_control = re.sub(
+            r'max-age=(\d+)',
+            lambda m: "max-age=%d" % min(int(m.group(1)), max_age),
+            cache_control
+        )
+    return conditional_response(body, cache_control, entry["etag"])
+
+
+def resolve_batch_keys(ctx):
+    """ Return permalink keys of a batch resolve request payload """
+    keys = request.json
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        api.abort(400, "Payload is not a list of keys")
+    if len(keys) > ctx.config.get('max_batch_size', 1000):
+        api.abort(400, "Too many items")
+    return keys
+
+
+def resolve_batch_response(ctx, keys, entries):
+    """ Return response for resolved permalink entries per key """
+    restricted = any(entry and entry["permitted_group"] for entry in entries)
+    groups = user_groups(ctx) if restricted else []
+    body = b','.join(
+        permalink_response_body(key, entry, groups)
+        for key, entry in zip(keys, entries)
+    )
+    return app.response_class(b'[' + body + b']', mimetype=app.json.mimetype)
+
 
 @api.route('/createpermalink')
 class CreatePermalink(Resource):
@@ -79,11 +442,7 @@ class CreatePermalink(Resource):
     def post(self):
         """ Create a permalink """
         args = createpermalink_parser.parse_args()
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        permalinks_table = config.get('permalinks_table', qwc_config_schema + '.permalinks')
-        default_expiry_period = config.get('default_expiry_period', None)
+        ctx = tenant_context()
 
         state = request.json
         if "url" in state:
@@ -101,49 +460,12 @@ class CreatePermalink(Resource):
         permitted_group = args.get('permitted_group', None)
 
         # Insert into database
-        datastr = json.dumps(data)
-        hexdigest = hashlib.sha224((datastr + str(time.time())).encode('utf-8')).hexdigest()[0:9]
-        date = datetime.date.today().strftime(r"%Y-%m-%d")
-        expires = None
-        if default_expiry_period:
-            delta = datetime.timedelta(days=default_expiry_period)
-            expires = (datetime.date.today() + delta).strftime(r"%Y-%m-%d")
-
-        sql = sql_text("""
-            INSERT INTO {table} (key, data, date, expires, permitted_group)
-            VALUES (:key, :data, :date, :expires, :permitted_group)
-        """.format(table=permalinks_table))
-        app.logger.debug(f"query: {sql}")
-
-        attempts = 0
-        while attempts < 100:
-            params = {"key": hexdigest, "data": datastr, "date": date, "expires": expires, "permitted_group": permitted_group}
-            app.logger.debug("trying with params: %s" % (params | {"data": "<data>"}))
-            try:
-                with db.begin() as connection:
-                    connection.execute(sql, params)
-                break
-            except Exception as e:
-                app.logger.debug("Query failed: %s" % str(e))
-                pass
-            hexdigest = hashlib.sha224((datastr + str(random.random())).encode('utf-8')).hexdigest()[0:9]
-            attempts += 1
-
-        # Delete permalinks past expiry date
-        sql = sql_text("""
-            DELETE FROM {table}
-            WHERE expires < CURRENT_DATE
-        """.format(table=permalinks_table))
-        try:
-            with db.begin() as connection:
-                connection.execute(sql)
-        except:
-            pass
+        key, expires = store_permalinks(ctx, [data], permitted_group)[0]
 
         # Return
-        if attempts < 100:
+        if key:
             result = {
-                "permalink": parts.scheme + "://" + parts.netloc + parts.path + "?k=" + hexdigest,
+                "permalink": parts.scheme + "://" + parts.netloc + parts.path + "?k=" + key,
                 "expires": expires
             }
         else:
@@ -151,6 +473,65 @@ class CreatePermalink(Resource):
         return jsonify(**result)
 
 
+@api.route('/createpermalinks')
+class CreatePermalinks(Resource):
+
+    @api.doc('createpermalinks')
+    @api.param('url', 'The URL for which to generate permalinks, if not specified per item', 'query')
+    @api.param('permitted_group', 'Optional, group to which to restrict the permalinks', 'query')
+    @api.param('payload', 'A json array of documents with the states to store in the permalinks', 'body')
+    @api.expect(createpermalinks_parser)
+    @optional_auth
+    def post(self):
+        """ Create multiple permalinks
+
+        Returns a list with the result for each item of the payload.
+        """
+        args = createpermalinks_parser.parse_args()
+        ctx = tenant_context()
+        config = ctx.config
+
+        states = request.json
+        if not isinstance(states, list):
+            api.abort(400, "Payload is not a list")
+        if len(states) > config.get('max_batch_size', 1000):
+            api.abort(400, "Too many items")
+
+        items = []
+        urls = []
+        for state in states:
+            if not isinstance(state, dict):
+                api.abort(400, "Item is not an object")
+            if "url" in state:
+                parts = urlparse(state["url"])
+                del state["url"]
+            elif args["url"]:
+                parts = urlparse(args["url"])
+            else:
+                api.abort(400, "No URL specified")
+            urls.append(parts)
+            items.append({
+                "query": dict(parse_qsl(parts.query, True)),
+                "state": state
+            })
+        permitted_group = args.get('permitted_group', None)
+
+        # Insert into database
+        results = store_permalinks(ctx, items, permitted_group)
+
+        # Return
+        response = []
+        for parts, (key, expires) in zip(urls, results):
+            if key:
+                response.append({
+                    "permalink": parts.scheme + "://" + parts.netloc + parts.path + "?k=" + key,
+                    "expires": expires
+                })
+            else:
+                response.append({"message": "Failed to generate compact permalink"})
+        return jsonify(response)
+
+
 @api.route('/resolvepermalink')
 class ResolvePermalink(Resource):
     @api.doc('resolvepermalink')
@@ -160,42 +541,30 @@ class ResolvePermalink(Resource):
     def get(self):
         """ Resolve a permalink """
         args = resolvepermalink_parser.parse_args()
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        permalinks_table = config.get('permalinks_table', qwc_config_schema + '.permalinks')
+        ctx = tenant_context()
 
         key = args['key']
-        data = {}
-        permitted_group = None
-
-        sql = sql_text("""
-            SELECT data, permitted_group
-            FROM {table}
-            WHERE key = :key AND (expires IS NULL OR expires >= CURRENT_DATE)
-        """.format(table=permalinks_table))
-        try:
-            with db.connect() as connection:
-                result = connection.execute(sql, {"key": key}).mappings().first()
-                data = json.loads(result["data"])
-                permitted_group = result["permitted_group"]
-        except:
-            pass
+        entry = resolve_permalinks(ctx, [key])[0]
+        return resolve_response(ctx, key, entry)
 
-        # Backward compatibility
-        if "permalinkParams" in data.get("state", {}):
-            data["query"] = data.get("query") | data["state"]["permalinkParams"]
 
-        if permitted_group:
-            app.logger.debug("Permalink %s is restricted to group %s" % (key, permitted_group))
-            username = get_username(get_identity())
-            tenant = tenant_handler.tenant()
-            reader = PermissionsReader(tenant, app.logger)
-            groups = reader.permissions['user_groups'].get(username, [])
-            if permitted_group not in groups:
-                app.logger.debug("User %s is not in group %s, returning empty response" % (username, permitted_group))
-                return jsonify({})
-        return jsonify(data)
+@api.route('/resolvepermalinks')
+class ResolvePermalinks(Resource):
+    @api.doc('resolvepermalinks')
+    @api.param('payload', 'A json array with the permalink keys to resolve', 'body')
+    @optional_auth
+    def post(self):
+        """ Resolve multiple permalinks
+
+        Returns a list with the resolved data for each key of the payload,
+        or an empty object if the permalink does not exist or is not
+        permitted.
+        """
+        ctx = tenant_context()
+
+        keys = resolve_batch_keys(ctx)
+        entries = resolve_permalinks(ctx, keys)
+        return resolve_batch_response(ctx, keys, entries)
 
 
 @api.route('/userpermalink')
@@ -208,19 +577,10 @@ class UserPermalink(Resource):
         if not username:
             return jsonify({})
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        user_permalink_table = config.get('user_permalink_table', qwc_config_schema + '.user_permalinks')
+        ctx = tenant_context()
 
-        sql = sql_text("""
-            SELECT data
-            FROM {table}
-            WHERE username = :user
-        """.format(table=user_permalink_table))
         try:
-            with db.connect() as connection:
-                data = json.loads(connection.execute(sql, {"user": username}).mappings().first()["data"])
+            data = StorageCodec.decode(ctx.storage.get_user_permalink(username))
         except:
             data = {}
 
@@ -241,10 +601,7 @@ class UserPermalink(Resource):
         if not username:
             return jsonify({"success": False})
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        user_permalink_table = config.get('user_permalink_table', qwc_config_schema + '.user_permalinks')
+        ctx = tenant_context()
 
         args = createpermalink_parser.parse_args()
         state = request.json
@@ -262,30 +619,85 @@ class UserPermalink(Resource):
         }
 
         # Insert into databse
-        datastr = json.dumps(data)
+        datastr = ctx.storage_codec.encode(data)
         date = datetime.date.today().strftime(r"%Y-%m-%d")
-        sql = sql_text("""
-            INSERT INTO {table} (username, data, date)
-            VALUES (:user, :data, :date)
-            ON CONFLICT (username)
-            DO
-            UPDATE
-            SET data = :data, date = :date
-        """.format(table=user_permalink_table))
 
         try:
-            with db.begin() as connection:
-                connection.execute(sql, {"user": username, "data": datastr, "date": date})
+            ctx.storage.set_user_permalink(username, datastr, date)
         except Exception as e:
             app.logger.debug("Query failed: %s" % str(e))
             return jsonify({"success": False})
 
         return jsonify({"success": True})
 
+def bookmarks_list_args(ctx):
+    """ Return limit, cursor and stream flag of a bookmarks list request """
+    args = bookmarkslist_parser.parse_args()
+    limit = args['limit']
+    if limit is not None and limit < 1:
+        api.abort(400, "Invalid limit")
+    keyset = ctx.storage.keyset
+    if args['after'] and not keyset:
+        api.abort(400, "Cursor pagination is not supported for bookmarks_sort_order")
+    if args['after']:
+        try:
+            keyset.decode(args['after'])
+        except ValueError:
+            api.abort(400, "Invalid cursor")
+    stream = (args['stream'] or "").lower() in ["1", "true"]
+    return limit, args['after'], stream
+
+
+def bookmarks_cache_control(ctx):
+    """ Return Cache-Control value of bookmark lists """
+    return private_cache_control(
+        ctx.config.get('bookmark_cache_control', 'private, no-cache')
+    )
+
+
+def bookmark_item(row):
+    """ Return list item of a bookmark row """
+    return {
+        'key': row["key"],
+        'description': row["description"],
+        'date': row["date"],
+        'theme_id': row["theme_id"],
+        'public': bool(row["public"]),
+        'own': bool(row["own"])
+    }
+
+
+def bookmarks_list_response(ctx, rows, limit):
+    """ Return bookmarks list response, with Link header if there are more rows
+
+    :param TenantContext ctx: Tenant context
+    :param list rows: Bookmark rows, with one more row than limit if there
+                      is a next page
+    :param int limit: Max number of bookmarks, or None
+    """
+    keyset = ctx.storage.keyset
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        # cursor of the last row of this page
+        rows = rows[0:limit]
+        next_cursor = keyset.cursor(rows[-1]) if keyset and rows else None
+    data = [bookmark_item(row) for row in rows]
+    response = conditional_response(data, bookmarks_cache_control(ctx))
+    if next_cursor:
+        response.headers['Link'] = '<%s?%s>; rel="next"' % (
+            request.base_url, urlencode({"limit": limit, "after": next_cursor})
+        )
+    return response
+
+
 @api.route("/bookmarks/")
 @api.route("/visibility_presets/")
 class UserBookmarksList(Resource):
     @api.doc('getbookmarks')
+    @api.param('limit', 'Max number of bookmarks / visibility presets to return', 'query')
+    @api.param('after', 'Cursor from the Link header of the previous page', 'query')
+    @api.param('stream', 'Whether to stream the JSON array (no ETag and Link header)', 'query')
+    @api.expect(bookmarkslist_parser)
     @optional_auth
     def get(self):
         """ Get the list of bookmarks or visibility presets """
@@ -293,49 +705,40 @@ class UserBookmarksList(Resource):
 
         endpoint = request.path.split("/")[1]
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        if endpoint == "bookmarks":
-            user_bookmark_table = config.get('user_bookmark_table', qwc_config_schema + '.user_bookmarks')
-        else:
-            user_bookmark_table = config.get('user_visibility_presets_table', qwc_config_schema + '.user_visibility_presets')
-        sort_order = config.get('bookmarks_sort_order', 'date DESC, description')
+        ctx = tenant_context()
+        storage = ctx.storage
+        limit, after, stream = bookmarks_list_args(ctx)
+
+        def rows():
+            # fetch one more row to detect next page
+            return storage.list_bookmarks(
+                endpoint, username, after, limit + 1 if limit is not None else None, stream
+            )
+
+        if stream:
+            def generate():
+                yield "["
+                count = 0
+                try:
+                    for row in rows():
+                        if limit is not None and count >= limit:
+                            break
+                        yield ("," if count else "") + app.json.dumps(bookmark_item(row))
+                        count += 1
+                except Exception as e:
+                    app.logger.debug("Query failed: %s" % str(e))
+                yield "]"
+
+            response = Response(stream_with_context(generate()), mimetype='application/json')
+            response.headers['Cache-Control'] = bookmarks_cache_control(ctx)
+            return response
 
-        if users_table:
-            sql = sql_text("""
-                WITH "user" AS (
-                    SELECT id FROM {users_table} WHERE name=:username
-                )
-                SELECT data, key, description, to_char(date, 'YYYY-MM-DD') as date, theme_id, public, COALESCE(user_id = (SELECT id FROM "user"), FALSE) as own
-                FROM {table}
-                WHERE user_id = (SELECT id FROM "user") OR public = TRUE
-                ORDER BY {sort_order}
-            """.format(users_table=users_table, table=user_bookmark_table, sort_order=sort_order))
-        else:
-            sql = sql_text("""
-                SELECT data, key, description, to_char(date, 'YYYY-MM-DD') as date, theme_id, public, (username = :username) as own
-                FROM {table}
-                WHERE username = :username OR public = TRUE
-                ORDER BY {sort_order}
-            """.format(table=user_bookmark_table, sort_order=sort_order))
         try:
-            data = []
-            with db.connect() as connection:
-                result = connection.execute(sql, {"username": username}).mappings()
-                for row in result:
-                    data.append({
-                        'key': row.key,
-                        'description': row.description,
-                        'date': row.date,
-                        'theme_id': row.theme_id,
-                        'public': row.public,
-                        'own': row.own
-                    })
+            result = rows()
         except Exception as e:
             app.logger.debug("Query failed: %s" % str(e))
-            data = []
-        return jsonify(data)
+            result = []
+        return bookmarks_list_response(ctx, result, limit)
 
     @api.doc('addbookmark')
     @api.param('url', 'The URL for which to generate a bookmark', 'query')
@@ -357,14 +760,8 @@ class UserBookmarksList(Resource):
 
         endpoint = request.path.split("/")[1]
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        if endpoint == "bookmarks":
-            user_bookmark_table = config.get('user_bookmark_table', qwc_config_schema + '.user_bookmarks')
-        else:
-            user_bookmark_table = config.get('user_visibility_presets_table', qwc_config_schema + '.user_visibility_presets')
-        
+        ctx = tenant_context()
+
         args = userbookmark_parser.parse_args()
         if endpoint == "bookmarks":
             state = request.json
@@ -385,51 +782,55 @@ class UserBookmarksList(Resource):
         theme_id = args['theme_id']
 
         # Insert into database
-        datastr = json.dumps(data)
-        hexdigest = hashlib.sha224((datastr + str(time.time())).encode('utf-8')).hexdigest()[0:9]
         date = datetime.date.today().strftime(r"%Y-%m-%d")
-      
+
         description = args['description']
-        permitted_capabilities = PermissionsReader(tenant, app.logger).resource_permissions(
-            'capabilities', get_identity()
-        )
+        permitted_capabilities = ctx.permissions.capabilities(get_identity())
         public = 'public_bookmarks' in permitted_capabilities and (args['public'] or 'False').lower() in ['true', '1']
-        if users_table:
-            sql = sql_text("""
-                WITH "user" AS (
-                    SELECT id FROM {users_table} WHERE name=:username
-                )
-                INSERT INTO {table} (user_id, username, data, key, date, description, theme_id, public)
-                VALUES ((SELECT id FROM "user"), :username, :data, :key, :date, :description, :theme_id, :public)
-            """.format(users_table=users_table, table=user_bookmark_table))
+        key = None
+        try:
+            datastr = ctx.bookmark_deltas.encode(endpoint, username, theme_id, data, date)
+            key = ctx.storage.insert_bookmark(
+                endpoint, username, datastr, date, description, theme_id, public
+            )
+        except Exception as e:
+            app.logger.debug("Query failed: %s" % str(e))
+
+        if key:
+            ctx.negative_cache.add_existing(endpoint, key, (username,))
         else:
-            sql = sql_text("""
-                INSERT INTO {table} (username, data, key, date, description, theme_id, public)
-                VALUES (:username, :data, :key, :date, :description, :theme_id, :public)
-                ON CONFLICT (username,key) WHERE username = :username
-                DO
-                UPDATE
-                SET data = :data, date = :date, description = :description, theme_id = :theme_id, public = :public
-            """.format(table=user_bookmark_table))
-
-        attempts = 0
-        while attempts < 100:
-            try:
-                with db.begin() as connection:
-                    connection.execute(sql, {
-                        "username": username, "data": datastr, "key": hexdigest, "date": date, "description": description, "theme_id": theme_id, "public": public
-                    })
-                    break
-            except Exception as e:
-                app.logger.debug("Query failed: %s" % str(e))
-                pass
-            hexdigest = hashlib.sha224((datastr + str(random.random())).encode('utf-8')).hexdigest()[0:9]
-            attempts += 1
-
-        if attempts >= 100:
-            app.logger.debug("More than 100 failed attempts to store bookmark")
-        success = attempts < 100
-        return jsonify({"success": success, "key": hexdigest if success else None})
+            app.logger.debug("Failed to allocate a key for the bookmark")
+        return jsonify({"success": key is not None, "key": key})
+
+def bookmark_response(ctx, endpoint, key, username, row):
+    """ Return response for a stored bookmark or visibility preset
+
+    :param TenantContext ctx: Tenant context
+    :param str endpoint: 'bookmarks' or 'visibility_presets'
+    :param str key: Bookmark key
+    :param str username: User name
+    :param obj row: Stored bookmark, None if not found
+    """
+    if row is None:
+        ctx.negative_cache.add_missing(endpoint, key, username)
+        return jsonify({})
+
+    doc = ctx.bookmark_deltas.decode_bytes(row["data"])
+    if doc is None:
+        return jsonify({})
+    if endpoint == "visibility_presets":
+        body = b'{"theme_id":%s,"visibility_preset":%s}' % (
+            json_codec.dumps(row["theme_id"]), doc
+        )
+    else:
+        body = response_body(doc)
+        if body == b'{}':
+            return jsonify({})
+    cache_control = ctx.config.get('bookmark_cache_control', 'private, no-cache')
+    if not row["public"]:
+        cache_control = private_cache_control(cache_control)
+    return conditional_response(body, cache_control)
+
 
 @api.route("/bookmarks/<key>")
 @api.route("/visibility_presets/<key>")
@@ -442,44 +843,17 @@ class UserBookmark(Resource):
 
         endpoint = request.path.split("/")[1]
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        if endpoint == "bookmarks":
-            user_bookmark_table = config.get('user_bookmark_table', qwc_config_schema + '.user_bookmarks')
-        else:
-            user_bookmark_table = config.get('user_visibility_presets_table', qwc_config_schema + '.user_visibility_presets')
+        ctx = tenant_context()
 
-        if users_table:
-            sql = sql_text("""
-                WITH "user" AS (
-                    SELECT id FROM {users_table} WHERE name=:username
-                )
-                SELECT data, theme_id
-                FROM {table}
-                WHERE (user_id = (SELECT id FROM "user") OR public = TRUE) AND key = :key
-            """.format(users_table=users_table, table=user_bookmark_table))
-        else:
-            sql = sql_text("""
-                SELECT data, theme_id
-                FROM {table}
-                WHERE (username = :username OR public = TRUE) and key = :key
-            """.format(table=user_bookmark_table))
+        if ctx.negative_cache.known_missing(endpoint, key, username):
+            app.logger.debug("Bookmark %s is known not to exist" % key)
+            return jsonify({})
         try:
-            with db.connect() as connection:
-                row = connection.execute(sql, {"username": username, "key": key}).mappings().first()
-                data = json.loads(row["data"])
-                if endpoint == "visibility_presets":
-                    data = {"visibility_preset": data, "theme_id": row["theme_id"]}
+            row = ctx.storage.get_bookmark(endpoint, username, key)
         except Exception as e:
             app.logger.debug("Query failed: %s" % str(e))
-            data = {}
-
-        # Backward compatibility
-        if "permalinkParams" in data.get("state", {}):
-            data["query"] = data.get("query") | data["state"]["permalinkParams"]
-
-        return jsonify(data)
+            return jsonify({})
+        return bookmark_response(ctx, endpoint, key, username, row)
 
     @api.doc('deletebookmark')
     @optional_auth
@@ -494,37 +868,14 @@ class UserBookmark(Resource):
         
         endpoint = request.path.split("/")[1]
 
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        if endpoint == "bookmarks":
-            user_bookmark_table = config.get('user_bookmark_table', qwc_config_schema + '.user_bookmarks')
-        else:
-            user_bookmark_table = config.get('user_visibility_presets_table', qwc_config_schema + '.user_visibility_presets')
+        ctx = tenant_context()
 
-        permitted_capabilities = PermissionsReader(tenant, app.logger).resource_permissions(
-            'capabilities', get_identity()
-        )
-        public_cond_sql = "OR public = TRUE" if 'public_bookmarks' in permitted_capabilities else ""
+        permitted_capabilities = ctx.permissions.capabilities(get_identity())
+        public_permitted = 'public_bookmarks' in permitted_capabilities
 
         # Delete into databse
-        if users_table:
-            sql = sql_text("""
-                WITH "user" AS (
-                    SELECT id FROM {users_table} WHERE name=:username
-                )
-                DELETE FROM {table}
-                WHERE key = :key AND (user_id = (SELECT id FROM "user") {public_cond_sql})
-            """.format(users_table=users_table, table=user_bookmark_table, public_cond_sql=public_cond_sql))
-        else:
-            sql = sql_text("""
-                DELETE FROM {table}
-                WHERE key = :key AND (username = :username {public_cond_sql})
-            """.format(table=user_bookmark_table, public_cond_sql=public_cond_sql))
-
         try:
-            with db.begin() as connection:
-                connection.execute(sql, {"key": key, "username": username})
+            ctx.storage.delete_bookmark(endpoint, username, key, public_permitted)
         except Exception as e:
             app.logger.debug("Query failed: %s" % str(e))
 
@@ -549,28 +900,18 @@ class UserBookmark(Resource):
 
         endpoint = request.path.split("/")[1]
         
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        if endpoint == "bookmarks":
-            user_bookmark_table = config.get('user_bookmark_table', qwc_config_schema + '.user_bookmarks')
-        else:
-            user_bookmark_table = config.get('user_visibility_presets_table', qwc_config_schema + '.user_visibility_presets')
+        ctx = tenant_context()
 
         args = userbookmark_parser.parse_args()
 
-        permitted_capabilities = PermissionsReader(tenant, app.logger).resource_permissions(
-            'capabilities', get_identity()
-        )
-        public_cond_sql = "OR public = TRUE" if 'public_bookmarks' in permitted_capabilities else ""
+        permitted_capabilities = ctx.permissions.capabilities(get_identity())
+        public_permitted = 'public_bookmarks' in permitted_capabilities
 
-        set_sql = "date = :date"
         set_params = {
-            "key": key,
-            "username": username,
             "date": datetime.date.today().strftime(r"%Y-%m-%d")
         }
         # Data
+        data = None
         if request.is_json:
             if endpoint == "bookmarks":
                 state = request.json
@@ -582,56 +923,91 @@ class UserBookmark(Resource):
                 else:
                     api.abort(400, "No URL specified")
 
-                set_params["data"] = json.dumps({
+                data = {
                     "query": query,
                     "state": state
-                })
-                set_sql += ", data = :data"
+                }
             else:
-                set_params["data"] = json.dumps(request.json)
-                set_sql += ", data = :data"
+                data = request.json
 
         # Description
         if args['description'] is not None:
             set_params["description"] = args['description']
-            set_sql += ", description = :description"
 
         # Theme Id
         if args['theme_id'] is not None:
             set_params['theme_id'] = args['theme_id']
-            set_sql += ", theme_id = :theme_id"
 
         # Public
         if 'public_bookmarks' in permitted_capabilities and args['public'] is not None:
             set_params['public'] = args['public'].lower() in ['true', '1']
-            set_sql += ", public = :public"
 
 
-        if users_table:
-            sql = sql_text("""
-                WITH "user" AS (
-                    SELECT id FROM {users_table} WHERE name=:username
-                )
-                UPDATE {table}
-                SET username = :username, {set_sql}
-                WHERE key = :key AND (user_id = (SELECT id FROM "user") {public_cond_sql})
-            """.format(users_table=users_table, table=user_bookmark_table, set_sql=set_sql, public_cond_sql=public_cond_sql))
-        else:
-            sql = sql_text("""
-                UPDATE {table}
-                SET {set_sql}
-                WHERE key = :key AND (username = :username {public_cond_sql})
-            """.format(table=user_bookmark_table, set_sql=set_sql, public_cond_sql=public_cond_sql))
-
         try:
-            with db.begin() as connection:
-                result = connection.execute(sql, set_params)
-                return jsonify({"success": result.rowcount == 1})
+            if data is not None:
+                theme_id = args['theme_id']
+                if theme_id is None and ctx.bookmark_deltas.enabled:
+                    # encode against the base of the stored theme
+                    row = ctx.storage.get_bookmark(endpoint, username, key)
+                    theme_id = row["theme_id"] if row is not None else None
+                set_params["data"] = ctx.bookmark_deltas.encode(
+                    endpoint, username, theme_id, data, set_params["date"]
+                )
+            updated = ctx.storage.update_bookmark(
+                endpoint, username, key, set_params, public_permitted
+            )
+            if updated:
+                ctx.negative_cache.add_existing(endpoint, key, (username,))
+            return jsonify({"success": updated})
         except Exception as e:
             app.logger.debug("Query failed: %s" % str(e))
             return jsonify({"success": False})
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    profiler.start(request.headers)
+
+
+@app.after_request
+def record_request_metrics(response):
+    if not request.url_rule:
+        route = "unmatched"
+    else:
+        route = request.url_rule.rule.split("/")[1] or "root"
+    if route == "metrics" or not hasattr(g, 'request_start'):
+        return profiler.finish(response, route, {})
+    labels = {"route": route, "method": request.method}
+    duration = time.perf_counter() - g.request_start
+    tenant = tenant_handler.tenant()
+    profiler.finish(response, route, labels | {"tenant": tenant, "path": request.path})
+    metrics.inc('qwc_permalink_requests_total', labels | {
+        "tenant": tenant, "status": str(response.status_code)
+    })
+    metrics.observe('qwc_permalink_request_duration_seconds', labels | {"tenant": tenant}, duration)
+    if request.content_length:
+        metrics.observe('qwc_permalink_request_payload_bytes', labels, request.content_length)
+    if not response.is_streamed:
+        metrics.observe('qwc_permalink_response_payload_bytes', labels, response.content_length or 0)
+    if not g.get('defer_metrics_sync'):
+        # async handlers write the snapshot in a worker thread
+        metrics.sync()
+    return response
+
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    # e.g. after an unhandled exception
+    profiler.abort()
+
+
+""" metrics endpoint """
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 """ readyness probe endpoint """
 @app.route("/ready", methods=['GET'])
 def ready():
@@ -639,19 +1015,48 @@ def ready():
 
 
 """ liveness probe endpoint """
+def db_pools(ctx):
+    """ Return dict of pool status of the DB engines of a tenant by role """
+    engines = {"primary": ctx.db, "replica": getattr(ctx.storage, 'db_readonly', None)}
+    return {
+        role: pool_status(engine) for role, engine in engines.items() if engine is not None
+    }
+
+
 @app.route("/healthz", methods=['GET'])
 def healthz():
     try:
-        tenant = tenant_handler.tenant()
-        config = config_handler.tenant_config(tenant)
-        db, qwc_config_schema, users_table = db_conn(config)
-        with db.connect() as connection:
-            connection.execute(sql_text("SELECT 1"))
+        ctx = tenant_context()
     except Exception as e:
         return make_response(jsonify(
             {"status": "FAIL", "cause": str(e)}), 500)
 
-    return jsonify({"status": "OK"})
+    # cached result, refreshed in the background
+    status = ctx.health_check.status()
+    status["pools"] = db_pools(ctx)
+    return make_response(jsonify(status), 200 if status["status"] == "OK" else 500)
+
+
+@app.route("/healthz/deep", methods=['GET'])
+def healthz_deep():
+    try:
+        ctx = tenant_context()
+        ctx.storage.check()
+        tables = ctx.storage.check_tables(ctx.bookmark_deltas.enabled)
+    except Exception as e:
+        return make_response(jsonify(
+            {"status": "FAIL", "cause": str(e)}), 500)
+
+    # missing indexes are reported, but only slow down queries
+    failed = any(
+        problems.get("missing") or problems.get("missing_columns")
+        for problems in tables.values()
+    )
+    return make_response(jsonify({
+        "status": "FAIL" if failed else "OK",
+        "tables": tables,
+        "pools": db_pools(ctx)
+    }), 500 if failed else 200)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,501 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+from caches import TTLCache
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+# slot header: seqlock counter, key length, key hash, expiry time,
+# last use time, value length, reserved
+SLOT_HEADER = struct.Struct('<IIQddII')
+# offset of last use time in slot header
+USED_OFFSET = 24
+
+
+def key_hash(key):
+    """Return 64 bit hash of key bytes, stable across processes."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def encode_value(value):
+    """Return bytes of a cached value.
+
+    Values are bytes, or JSON data which may contain bytes and dates, e.g.
+    resolve cache entries. Bytes in JSON data are appended raw after the
+    JSON document and referenced by offset and length. Object keys
+    starting with '$' are escaped with another '$', so they cannot be
+    mistaken for encoded bytes or dates.
+
+    NOTE: values are never pickled, as anyone able to write the shared
+          table could run code in the service on unpickling
+
+    :param obj value: Value
+    """
+    if isinstance(value, bytes):
+        return b'B' + value
+    blobs = []
+    size = 0
+
+    def tag(obj):
+        nonlocal size
+        if isinstance(obj, dict):
+            return {
+                "$" + key if isinstance(key, str) and key.startswith("$") else key: tag(item)
+                for key, item in obj.items()
+            }
+        if isinstance(obj, (list, tuple)):
+            return [tag(item) for item in obj]
+        if isinstance(obj, bytes):
+            blobs.append(obj)
+            size += len(obj)
+            return {"$bytes": [size - len(obj), len(obj)]}
+        if isinstance(obj, datetime.datetime):
+            return {"$datetime": obj.isoformat()}
+        if isinstance(obj, datetime.date):
+            return {"$date": obj.isoformat()}
+        return obj
+
+    doc = json.dumps(tag(value), separators=(',', ':')).encode('utf-8')
+    return b'J' + struct.pack('<I', len(doc)) + doc + b''.join(blobs)
+
+
+def decode_value(data):
+    """Return cached value of bytes returned by encode_value().
+
+    :param bytes data: Encoded value
+    """
+    if data[0:1] == b'B':
+        return bytes(data[1:])
+    if data[0:1] != b'J':
+        raise ValueError("Unknown value encoding")
+    doc_len = struct.unpack_from('<I', data, 1)[0]
+    blobs = data[5 + doc_len:]
+
+    def object_hook(obj):
+        if len(obj) == 1:
+            if "$bytes" in obj:
+                offset, length = obj["$bytes"]
+                return bytes(blobs[offset:offset + length])
+            if "$date" in obj:
+                return datetime.date.fromisoformat(obj["$date"])
+            if "$datetime" in obj:
+                return datetime.datetime.fromisoformat(obj["$datetime"])
+        if any(key.startswith("$") for key in obj):
+            # unescape keys
+            return {key[1:] if key.startswith("$") else key: item for key, item in obj.items()}
+        return obj
+
+    return json.loads(bytes(data[5:5 + doc_len]), object_hook=object_hook)
+
+
+def private_dir(parent):
+    """Return directory in parent only accessible by the current user,
+    creating it if missing.
+
+    Raises if the directory exists, but is not a directory owned by the
+    user and inaccessible to others, e.g. created by another user of a
+    shared tmpfs.
+
+    :param str parent: Parent directory, e.g. /dev/shm
+    """
+    path = os.path.join(parent, 'qwc-permalink-%d' % os.geteuid())
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+        raise PermissionError("%s is not a private directory of the current user" % path)
+    return path
+
+
+class MmapTable:
+    """Fixed-size hash table in a memory-mapped file shared by all
+    processes on a host, e.g. on tmpfs.
+
+    The table is split into buckets of ways slots. Each key maps to a
+    bucket and is stored in a free, expired or else the least recently
+    used slot of it. Writes take one of stripes locks, both per thread and
+    per process (fcntl byte range lock). Reads are lock-free: a seqlock
+    counter per slot, which is odd while the slot is written, detects torn
+    reads.
+    """
+
+    def __init__(self, path, slots=8192, slot_size=4096, ways=8, stripes=64):
+        """Constructor
+
+        :param str path: Path of table file, created if missing
+        :param int slots: Number of slots
+        :param int slot_size: Size of a slot in bytes, including header
+                              and key
+        :param int ways: Number of slots per bucket
+        :param int stripes: Number of write locks
+        """
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.stripes = stripes
+        size = self.buckets * ways * slot_size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+                raise PermissionError(
+                    "%s is not a file of the current user inaccessible to others" % path
+                )
+            if info.st_size < size:
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.locks = [threading.Lock() for i in range(stripes)]
+
+        # counters of this process
+        self.evictions = 0
+        self.too_large = 0
+
+    def slot_offsets(self, h):
+        """Return offsets of the slots of the bucket of a key hash."""
+        start = (h % self.buckets) * self.ways * self.slot_size
+        return range(start, start + self.ways * self.slot_size, self.slot_size)
+
+    def find(self, offsets, key, h):
+        """Return offset of slot with key, or None. Call with stripe lock."""
+        buf = self.mmap
+        for offset in offsets:
+            seq, key_len, slot_hash = SLOT_HEADER.unpack_from(buf, offset)[0:3]
+            if slot_hash == h and key_len == len(key):
+                start = offset + SLOT_HEADER.size
+                if buf[start:start + key_len] == key:
+                    return offset
+        return None
+
+    def get(self, key):
+        """Return value bytes of key, or None if missing or expired.
+
+        :param bytes key: Key
+        """
+        h = key_hash(key)
+        buf = self.mmap
+        now = time.time()
+        for offset in self.slot_offsets(h):
+            seq, key_len, slot_hash, expires, used, value_len, _ = SLOT_HEADER.unpack_from(buf, offset)
+            if slot_hash != h or key_len != len(key) or seq % 2:
+                continue
+            start = offset + SLOT_HEADER.size
+            data = buf[start:start + key_len + value_len]
+            if SLOT_HEADER.unpack_from(buf, offset)[0] != seq:
+                # written concurrently
+                return None
+            if data[0:key_len] != key:
+                continue
+            if expires < now:
+                return None
+            struct.pack_into('<d', buf, offset + USED_OFFSET, now)
+            return data[key_len:]
+        return None
+
+    def write(self, offset, key, value, h, expires):
+        """Write slot. Call with stripe lock."""
+        buf = self.mmap
+        seq = SLOT_HEADER.unpack_from(buf, offset)[0]
+        # odd sequence number marks slot as being written
+        struct.pack_into('<I', buf, offset, (seq + 1) & 0xffffffff)
+        start = offset + SLOT_HEADER.size
+        buf[start:start + len(key) + len(value)] = key + value
+        SLOT_HEADER.pack_into(
+            buf, offset, (seq + 1) & 0xffffffff, len(key), h, expires, time.time(), len(value), 0
+        )
+        struct.pack_into('<I', buf, offset, (seq + 2) & 0xffffffff)
+
+    def set(self, key, value, ttl):
+        """Store value bytes under key, return False if too large.
+
+        :param bytes key: Key
+        :param bytes value: Value
+        :param float ttl: Time-to-live in seconds
+        """
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            self.too_large += 1
+            return False
+        h = key_hash(key)
+        offsets = self.slot_offsets(h)
+        now = time.time()
+        with self.locked(h):
+            offset = self.find(offsets, key, h)
+            if offset is None:
+                # free or expired slot, else least recently used slot
+                victim = None
+                victim_used = None
+                for slot in offsets:
+                    seq, key_len, slot_hash, expires, used = SLOT_HEADER.unpack_from(self.mmap, slot)[0:5]
+                    if key_len == 0 or expires < now:
+                        victim = slot
+                        break
+                    if victim is None or used < victim_used:
+                        victim, victim_used = slot, used
+                else:
+                    self.evictions += 1
+                offset = victim
+            self.write(offset, key, value, h, now + ttl)
+        return True
+
+    def invalidate(self, key):
+        """Remove key.
+
+        :param bytes key: Key
+        """
+        h = key_hash(key)
+        with self.locked(h):
+            offset = self.find(self.slot_offsets(h), key, h)
+            if offset is not None:
+                self.write(offset, b'', b'', 0, 0)
+
+    def clear(self, prefix):
+        """Remove all keys starting with prefix.
+
+        :param bytes prefix: Key prefix
+        """
+        buf = self.mmap
+        for offset in range(0, len(buf), self.slot_size):
+            key_len, h = SLOT_HEADER.unpack_from(buf, offset)[1:3]
+            start = offset + SLOT_HEADER.size
+            if key_len < len(prefix) or buf[start:start + len(prefix)] != prefix:
+                continue
+            with self.locked(h):
+                if SLOT_HEADER.unpack_from(buf, offset)[2] == h:
+                    self.write(offset, b'', b'', 0, 0)
+
+    def locked(self, h):
+        """Return context manager holding the stripe lock of the bucket of
+        a key hash."""
+        return StripeLock(self, (h % self.buckets) % self.stripes)
+
+    def stats(self):
+        """Return dict with table size and counters of this process."""
+        return {
+            "backend": "mmap",
+            "path": self.path,
+            "size": len(self.mmap),
+            "evictions": self.evictions,
+            "too_large": self.too_large
+        }
+
+
+class StripeLock:
+    """Lock of a stripe of an MmapTable, for threads and processes."""
+
+    def __init__(self, table, stripe):
+        self.table = table
+        self.stripe = stripe
+
+    def __enter__(self):
+        self.table.locks[self.stripe].acquire()
+        fcntl.lockf(self.table.fd, fcntl.LOCK_EX, 1, self.stripe)
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.table.fd, fcntl.LOCK_UN, 1, self.stripe)
+        self.table.locks[self.stripe].release()
+
+
+class UwsgiTable:
+    """Table in a uWSGI cache, e.g. configured with
+    --cache2 name=qwc-permalink,items=10000,blocksize=4096,purge_lru=1
+    """
+
+    def __init__(self, name):
+        """Constructor
+
+        :param str name: uWSGI cache name
+        """
+        self.name = name
+        self.too_large = 0
+
+    def get(self, key):
+        data = uwsgi.cache_get(key, self.name)
+        if data is None:
+            return None
+        expires = struct.unpack_from('<d', data)[0]
+        if expires < time.time():
+            return None
+        return data[8:]
+
+    def set(self, key, value, ttl):
+        # NOTE: uWSGI cache expiry has a granularity of seconds, store
+        #       expiry time with the value
+        if not uwsgi.cache_update(
+            key, struct.pack('<d', time.time() + ttl) + value, max(1, int(ttl) + 1), self.name
+        ):
+            self.too_large += 1
+            return False
+        return True
+
+    def invalidate(self, key):
+        uwsgi.cache_del(key, self.name)
+
+    def clear(self, prefix):
+        # NOTE: uWSGI caches cannot be iterated, entries expire
+        pass
+
+    def stats(self):
+        return {"backend": "uwsgi", "name": self.name, "too_large": self.too_large}
+
+
+class SharedCache:
+    """TTLCache shared by all worker processes on a host.
+
+    Values are encoded with encode_value() and stored in a shared table
+    under the tenant, cache name and key, or a hash of long keys. Values
+    too large for the table are cached in a cache of this process.
+    """
+
+    def __init__(self, table, namespace, maxsize=1000, ttl=300):
+        """Constructor
+
+        :param MmapTable|UwsgiTable table: Shared table
+        :param str namespace: Key prefix, e.g. tenant and cache name
+        :param int maxsize: Max number of entries of the process cache
+        :param float ttl: Default time-to-live of an entry in seconds
+        """
+        self.table = table
+        self.prefix = namespace.encode('utf-8') + b'\0'
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def table_key(self, key):
+        """Return key in shared table."""
+        key = str(key).encode('utf-8')
+        if len(key) > 64:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+        return self.prefix + key
+
+    def get(self, key, default=None):
+        """See TTLCache.get()"""
+        data = self.table.get(self.table_key(key))
+        if data is not None:
+            try:
+                value = decode_value(data)
+                with self.lock:
+                    self.hits += 1
+                return value
+            except (ValueError, struct.error):
+                # e.g. written by an incompatible version, treat as miss
+                pass
+        value = self.local.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        """See TTLCache.set()"""
+        ttl = self.ttl if ttl is None else ttl
+        if not self.table.set(self.table_key(key), encode_value(value), ttl):
+            self.local.set(key, value, ttl)
+
+    def invalidate(self, key):
+        """See TTLCache.invalidate()"""
+        self.table.invalidate(self.table_key(key))
+        self.local.invalidate(key)
+
+    def clear(self):
+        """See TTLCache.clear()"""
+        self.table.clear(self.prefix)
+        self.local.clear()
+
+    def stats(self):
+        """Return dict with hit/miss counters of this process."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "local_size": len(self.local.entries),
+                "table": self.table.stats()
+            }
+
+
+# tables[(<backend>, <path or name>, <process ID>)] = <table>
+tables = {}
+tables_lock = threading.Lock()
+
+
+def shared_table(config, logger):
+    """Return shared table configured by shared_cache, or None if disabled
+    or not available.
+
+    :param RuntimeConfig config: Tenant config
+    :param Logger logger: Application logger
+    """
+    backend = config.get('shared_cache')
+    if not backend:
+        return None
+    if backend == 'uwsgi':
+        name = config.get('shared_cache_uwsgi_name', 'qwc-permalink')
+        if uwsgi is None or not hasattr(uwsgi, 'cache_update'):
+            logger.warning("uWSGI cache API is not available, using per-process caches")
+            return None
+        key = (backend, name, os.getpid())
+    else:
+        slots = config.get('shared_cache_slots', 8192)
+        slot_size = config.get('shared_cache_slot_size', 4096)
+        directory = config.get('shared_cache_dir', '/dev/shm')
+        path = os.path.join(
+            directory, 'qwc-permalink-%d' % os.geteuid(),
+            'cache-%dx%d' % (slots, slot_size)
+        )
+        key = (backend, path, os.getpid())
+
+    with tables_lock:
+        table = tables.get(key)
+        if table is None:
+            try:
+                if backend == 'uwsgi':
+                    table = UwsgiTable(name)
+                else:
+                    private_dir(directory)
+                    table = MmapTable(path, slots, slot_size)
+            except Exception as e:
+                logger.warning("Shared cache is not available, using per-process caches: %s" % e)
+                return None
+            tables[key] = table
+    return table
+
+
+def cache_factory(config, tenant, logger):
+    """Return function(<name>, <maxsize>, <ttl>) returning a shared cache
+    of a tenant, or a TTLCache if shared caching is disabled or not
+    available.
+
+    :param RuntimeConfig config: Tenant config
+    :param str tenant: Tenant ID
+    :param Logger logger: Application logger
+    """
+    table = shared_table(config, logger)
+
+    def create_cache(name, maxsize, ttl):
+        if table is None:
+            return TTLCache(maxsize, ttl)
+        return SharedCache(table, "%s:%s" % (tenant, name), maxsize, ttl)
+
+    return create_cache
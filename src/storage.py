@@ -0,0 +1,1665 @@
+import datetime
+import functools
+import threading
+import time
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import bindparam, text as sql_text
+
+from caches import TTLCache
+from keyset import KeysetPagination
+from storage_codec import StorageCodec
+
+
+# bookmark kinds by endpoint
+BOOKMARK_KINDS = ('bookmarks', 'visibility_presets')
+
+
+def iso_date(value):
+    """Return date of a date or ISO date string, or None.
+
+    :param obj value: Date, ISO date string or None
+    """
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value[0:10])
+    return value
+
+
+class Storage:
+    """Persistence of permalinks, user permalinks, bookmarks and visibility
+    presets.
+
+    Payloads are passed as stored text (see StorageCodec), dates as ISO
+    date strings. Bookmarks and visibility presets are addressed by kind
+    ('bookmarks' or 'visibility_presets'), key namespaces for caches by
+    kind or 'permalinks'.
+
+    Methods raise on storage errors.
+    """
+
+    def __init__(self, config, key_allocator, logger):
+        """Constructor
+
+        :param RuntimeConfig config: Tenant config
+        :param KeyAllocator key_allocator: Allocator for new keys
+        :param Logger logger: Application logger
+        """
+        self.config = config
+        self.key_allocator = key_allocator
+        self.logger = logger
+        # no DB engine
+        self.db = None
+        # optional callable(<counter>) called for each DB read, with
+        # 'replica_reads', 'primary_reads' or 'replica_failures'
+        self.listener = None
+
+        self.sort_order = config.get('bookmarks_sort_order', 'date DESC, description')
+        try:
+            self.keyset = KeysetPagination(self.sort_order)
+        except ValueError as e:
+            # sort order with expressions, no cursor pagination
+            logger.debug("No cursor pagination for bookmarks: %s" % str(e))
+            self.keyset = None
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        """Store permalinks, return list of (key, expires) per payload.
+
+        If hashes are set, an existing permalink with identical payload
+        hash, permitted group and expiry policy is reused, extending its
+        expiry date if needed. The key is None if no key could be allocated.
+
+        :param list datas: Stored payload texts
+        :param list hashes: Payload hashes, or None
+        :param str date: Creation date
+        :param str expires: Expiry date, or None
+        :param str permitted_group: Group to which permalinks are restricted
+        """
+        raise NotImplementedError
+
+    def get_permalinks(self, keys):
+        """Return dict with stored permalinks of keys which exist and have
+        not expired, as {<key>: {"data", "permitted_group", "expires"}}.
+
+        :param list keys: Permalink keys
+        """
+        raise NotImplementedError
+
+    def keys(self, kind, since=None):
+        """Return iterable of existing keys.
+
+        :param str kind: 'permalinks', 'bookmarks' or 'visibility_presets'
+        :param date since: Only keys created since this date, if set
+        """
+        raise NotImplementedError
+
+    def purge_expired_permalinks(self, batch_size):
+        """Delete permalinks past their expiry date, return number of
+        deleted rows, or None if already being purged elsewhere.
+
+        :param int batch_size: Max number of rows deleted per statement
+        """
+        raise NotImplementedError
+
+    def archive_permalinks(self, batch_size):
+        """Move permalinks which have not been resolved recently to the
+        archive, return number of moved rows, or None if already being
+        archived elsewhere.
+
+        :param int batch_size: Max number of rows moved per transaction
+        """
+        return 0
+
+    def record_access(self, keys):
+        """Record resolves of permalinks, e.g. for archiving.
+
+        :param list keys: Keys of resolved permalinks
+        """
+        pass
+
+    def get_user_permalink(self, username):
+        """Return stored payload of user permalink, or None.
+
+        :param str username: User name
+        """
+        raise NotImplementedError
+
+    def set_user_permalink(self, username, data, date):
+        """Store user permalink.
+
+        :param str username: User name
+        :param str data: Stored payload text
+        :param str date: Date
+        """
+        raise NotImplementedError
+
+    def list_bookmarks(self, kind, username, after=None, limit=None, stream=False):
+        """Return iterable of own and public bookmarks in configured sort
+        order, as mappings with key, description, date, theme_id, public,
+        own and the keyset sort values _sort<i>.
+
+        Raises ValueError for an invalid cursor.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str after: Cursor of the last bookmark of the previous page
+        :param int limit: Max number of bookmarks plus one
+        :param bool stream: Whether to fetch rows incrementally
+        """
+        raise NotImplementedError
+
+    def get_bookmark(self, kind, username, key):
+        """Return own or public bookmark as {"data", "theme_id", "public"},
+        or None.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str key: Bookmark key
+        """
+        raise NotImplementedError
+
+    def insert_bookmark(self, kind, username, data, date, description, theme_id, public):
+        """Store new bookmark, return its key, or None if no key could be
+        allocated.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str data: Stored payload text
+        :param str date: Date
+        :param str description: Description
+        :param str theme_id: Theme ID
+        :param bool public: Whether the bookmark is public
+        """
+        raise NotImplementedError
+
+    def update_bookmark(self, kind, username, key, values, public_permitted):
+        """Update bookmark, return whether it was updated.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str key: Bookmark key
+        :param dict values: New values of date, data, description,
+                            theme_id and public
+        :param bool public_permitted: Whether public bookmarks of other
+                                      users may be updated
+        """
+        raise NotImplementedError
+
+    def delete_bookmark(self, kind, username, key, public_permitted):
+        """Delete bookmark, return whether it was deleted.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str key: Bookmark key
+        :param bool public_permitted: Whether public bookmarks of other
+                                      users may be deleted
+        """
+        raise NotImplementedError
+
+    def latest_bookmark_base(self, kind, username, theme_id):
+        """Return (<base ID>, <stored payload>) of the latest bookmark base
+        of a user and theme, or None.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str theme_id: Theme ID, '' for bookmarks without theme
+        """
+        raise NotImplementedError
+
+    def insert_bookmark_base(self, kind, username, theme_id, data, date):
+        """Store bookmark base, return its ID.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str theme_id: Theme ID, '' for bookmarks without theme
+        :param str data: Stored payload
+        :param str date: Current date
+        """
+        raise NotImplementedError
+
+    def get_bookmark_base(self, base_id):
+        """Return stored payload of a bookmark base, or None.
+
+        :param int base_id: Base ID
+        """
+        raise NotImplementedError
+
+    def purge_bookmark_bases(self, kind, username, theme_id):
+        """Delete bookmark bases of a user and theme which are not
+        referenced by any bookmark, except the latest two. Return number of
+        deleted bases.
+
+        References are looked up in the bookmarks of all users, as public
+        bookmarks edited by other users are encoded against the base of
+        the editor.
+
+        :param str kind: Bookmark kind
+        :param str username: User name
+        :param str theme_id: Theme ID, '' for bookmarks without theme
+        """
+        raise NotImplementedError
+
+    def check(self):
+        """Raise if the storage is not available."""
+        pass
+
+    def check_tables(self, bookmark_bases=False):
+        """Return dict with problems of the tables by table kind, with
+        missing columns, which fail the check, and missing indexes.
+
+        :param bool bookmark_bases: Whether to check the bookmark bases table
+        """
+        return {}
+
+    def stats(self):
+        """Return dict with stats of the storage."""
+        return {"backend": self.__class__.__name__}
+
+
+class PostgresStorage(Storage):
+    """Storage in the PostgreSQL tables of the QWC ConfigDB.
+
+    Statements are built on first use and reused afterwards. With
+    store_bookmarks_by_userid, bookmarks are stored with the ID of the user
+    in the users table, which is cached per user.
+
+    With a read-only DB engine, e.g. of a replica, permalinks, user
+    permalinks and bookmarks are read from it. Reads fall back to the
+    primary DB on errors, and single rows not found on the replica are
+    looked up on the primary. Reads of a user's bookmarks and of created
+    permalinks are sent to the primary for read_your_writes_window seconds
+    after the write in this process.
+
+    With permalinks_archive_table, permalinks not resolved within
+    archive_after_days are moved to the archive table with compressed
+    payloads. Resolves look up missing permalinks in the archive and move
+    them back if archive_promote is set. Resolves are recorded in the
+    last_access column, in batches every access_flush_interval seconds.
+
+    With permalinks_partitioned, the permalinks table is partitioned by
+    date, and keys are checked for uniqueness across partitions on insert.
+
+    With bookmark_delta_encoding, the ID of the base of delta encoded
+    bookmark payloads is stored in the indexed base_id column of the
+    bookmark tables, which is used to find unreferenced bases.
+    """
+
+    def __init__(self, db, config, key_allocator, logger, db_readonly=None):
+        """Constructor
+
+        :param Engine db: DB engine
+        :param RuntimeConfig config: Tenant config
+        :param KeyAllocator key_allocator: Allocator for new keys
+        :param Logger logger: Application logger
+        :param Engine db_readonly: Optional DB engine for reads
+        """
+        super().__init__(config, key_allocator, logger)
+        self.db = db
+        self.db_readonly = db_readonly
+        # recent_writes[('user', <username>) or ('permalinks', <key>)] = True
+        self.recent_writes = TTLCache(
+            config.get('read_your_writes_cache_size', 10000),
+            config.get('read_your_writes_window', 10)
+        )
+        self.partitioned = config.get('permalinks_partitioned', False)
+        self.archive_table = config.get('permalinks_archive_table')
+        self.archive_after_days = config.get('archive_after_days', 365)
+        self.archive_promote = config.get('archive_promote', True)
+        self.archive_codec = StorageCodec(
+            config.get('archive_codec', 'zlib'),
+            config.get('storage_codec_min_size', 1024),
+            logger
+        )
+        self.dedup = config.get('dedup_permalinks', False)
+        self.bookmark_base_ids = config.get('bookmark_delta_encoding', False)
+        # keys of resolved permalinks not yet recorded
+        self.accessed = set()
+        self.access_flush_interval = config.get('access_flush_interval', 60)
+        self.access_flushed = time.monotonic()
+
+        # counters
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.replica_failures = 0
+        self.archive_reads = 0
+        self.promoted = 0
+        self.access_updates = 0
+
+        schema = config.get('qwc_config_schema', 'qwc_config')
+        if config.get('store_bookmarks_by_userid', True):
+            self.users_table = f'"{schema}"."users"'
+        else:
+            self.users_table = None
+        # tables[<kind>] = <table>
+        self.tables = {
+            'permalinks': config.get('permalinks_table', schema + '.permalinks'),
+            'user_permalinks': config.get('user_permalink_table', schema + '.user_permalinks'),
+            'bookmarks': config.get('user_bookmark_table', schema + '.user_bookmarks'),
+            'visibility_presets': config.get(
+                'user_visibility_presets_table', schema + '.user_visibility_presets'
+            ),
+            'bookmark_bases': config.get('user_bookmark_bases_table', schema + '.user_bookmark_bases')
+        }
+
+        # user_ids[<username>] = <ID in users table>
+        self.user_ids = TTLCache(
+            config.get('user_id_cache_size', 10000),
+            config.get('user_id_cache_ttl', 300)
+        )
+        # statements[<name>] = <TextClause>
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def statement(self, name, build):
+        """Return prebuilt statement, building it on first use.
+
+        The first item of the name is set as 'statement_name' execution
+        option, e.g. for query metrics.
+
+        :param tuple name: Statement name, including any variant
+        :param callable build: Function returning the TextClause
+        """
+        sql = self.statements.get(name)
+        if sql is None:
+            sql = build().execution_options(statement_name=name[0])
+            with self.lock:
+                sql = self.statements.setdefault(name, sql)
+        return sql
+
+    def count_read(self, counter):
+        """Increment a read counter.
+
+        :param str counter: 'replica_reads', 'primary_reads' or
+                            'replica_failures'
+        """
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        if self.listener is not None:
+            self.listener(counter)
+
+    def read(self, query, recent=(), retry_missing=False):
+        """Return result of a read query, run on the read-only DB if set.
+
+        :param callable query: Function(<Connection>) returning the result
+        :param list recent: Keys in recent_writes of written data which is
+                            read from the primary DB within the window
+        :param bool retry_missing: Whether to repeat the query on the
+                                   primary DB if the result is empty
+        """
+        if self.db_readonly is not None and not any(
+            self.recent_writes.get(key) for key in recent
+        ):
+            try:
+                with self.db_readonly.connect() as connection:
+                    result = query(connection)
+                self.count_read('replica_reads')
+                if result or not retry_missing:
+                    return result
+            except SQLAlchemyError as e:
+                self.logger.warning("Query on read-only DB failed, using primary DB: %s" % e)
+                self.count_read('replica_failures')
+        self.count_read('primary_reads')
+        with self.db.connect() as connection:
+            return query(connection)
+
+    def written(self, keys):
+        """Route reads of written data to the primary DB within the
+        read_your_writes_window.
+
+        :param list keys: Keys in recent_writes of written data
+        """
+        if self.db_readonly is not None:
+            for key in keys:
+                self.recent_writes.set(key, True)
+
+    def user_id_sql(self):
+        """Return statement selecting the ID of a user in the users table."""
+        return self.statement(('user_id',), lambda: sql_text("""
+            SELECT id FROM {users_table} WHERE name = :username
+        """.format(users_table=self.users_table)))
+
+    def user_id(self, connection, username):
+        """Return the cached ID of a user in the users table, None if unknown.
+
+        :param Connection connection: DB connection
+        :param str username: User name
+        """
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            user_id = connection.execute(self.user_id_sql(), {"username": username}).scalar()
+            if user_id is not None:
+                self.user_ids.set(username, user_id)
+        return user_id
+
+    def user_params(self, connection, username):
+        """Return statement params identifying the user.
+
+        :param Connection connection: DB connection
+        :param str username: User name
+        """
+        params = {"username": username}
+        if self.users_table:
+            params["user_id"] = self.user_id(connection, username)
+        return params
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        table = self.tables['permalinks']
+        params = {"date": date, "expires": expires, "permitted_group": permitted_group}
+        results = [(None, expires)] * len(datas)
+        # pending[<data hash or item index>] = [<item index>]
+        pending = {}
+        if hashes:
+            for i, data_hash in enumerate(hashes):
+                pending.setdefault(data_hash, []).append(i)
+            # Reuse permalinks with same payload, permitted group and expiry policy
+            dedup_sql = self.statement(('dedup_permalinks', bool(expires)), lambda: sql_text("""
+                SELECT DISTINCT ON (data_hash) key, data_hash, expires
+                FROM {table}
+                WHERE data_hash IN :hashes AND permitted_group IS NOT DISTINCT FROM :permitted_group
+                    AND {expiry_cond}
+                ORDER BY data_hash, expires DESC
+            """.format(
+                table=table,
+                expiry_cond="expires >= CURRENT_DATE" if expires else "expires IS NULL"
+            )).bindparams(bindparam("hashes", expanding=True)))
+            extend_sql = self.statement(('extend_permalinks',), lambda: sql_text("""
+                UPDATE {table} SET expires = :expires
+                WHERE key IN :keys AND expires < :expires
+            """.format(table=table)).bindparams(bindparam("keys", expanding=True)))
+            sql = self.statement(('insert_permalinks', True), lambda: sql_text("""
+                INSERT INTO {table} (key, data, date, expires, permitted_group, data_hash)
+                SELECT key, data, :date, :expires, :permitted_group, data_hash
+                FROM unnest(CAST(:keys AS {key_type}[]), CAST(:datas AS text[]), CAST(:hashes AS text[])) AS rows(key, data, data_hash)
+                {free_keys}
+                ON CONFLICT DO NOTHING
+                RETURNING key
+            """.format(table=table, **self.free_keys_sql())))
+        else:
+            for i in range(len(datas)):
+                pending[i] = [i]
+            sql = self.statement(('insert_permalinks', False), lambda: sql_text("""
+                INSERT INTO {table} (key, data, date, expires, permitted_group)
+                SELECT key, data, :date, :expires, :permitted_group
+                FROM unnest(CAST(:keys AS {key_type}[]), CAST(:datas AS text[])) AS rows(key, data)
+                {free_keys}
+                ON CONFLICT DO NOTHING
+                RETURNING key
+            """.format(table=table, **self.free_keys_sql())))
+
+        with self.db.begin() as connection:
+            if hashes:
+                existing = connection.execute(
+                    dedup_sql, params | {"hashes": list(pending)}
+                ).mappings().all()
+                extended = [row["key"] for row in existing if expires and row["expires"] < datetime.date.fromisoformat(expires)]
+                if extended:
+                    connection.execute(extend_sql, {"keys": extended, "expires": expires})
+                for row in existing:
+                    key = row["key"].rstrip(' ')
+                    row_expires = expires if row["key"] in extended or not row["expires"] else row["expires"].strftime(r"%Y-%m-%d")
+                    self.logger.debug("Reusing permalink %s with identical payload" % key)
+                    for i in pending.pop(row["data_hash"]):
+                        results[i] = (key, row_expires)
+
+            if pending:
+                columns = {"datas": [datas[indices[0]] for indices in pending.values()]}
+                if hashes:
+                    columns["hashes"] = list(pending)
+                keys = self.key_allocator.insert_many(connection, sql, params, columns)
+                for key, indices in zip(keys, pending.values()):
+                    for i in indices:
+                        results[i] = (key, expires)
+        self.written([('permalinks', key) for key, key_expires in results if key])
+        return results
+
+    def free_keys_sql(self):
+        """Return dict with the key type for the unnest() of new keys and a
+        WHERE clause excluding keys which are not free, if ON CONFLICT does
+        not detect them.
+
+        Keys of archived permalinks and, with a partitioned table, of other
+        partitions are not covered by the unique index of the table.
+        """
+        table = self.tables['permalinks']
+        conditions = []
+        if self.partitioned:
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM {table} p WHERE p.key = rows.key)".format(table=table)
+            )
+        if self.archive_table:
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM {table} a WHERE a.key = rows.key)".format(
+                    table=self.archive_table
+                )
+            )
+        if not conditions:
+            return {"key_type": "text", "free_keys": ""}
+        return {"key_type": self.key_type(), "free_keys": "WHERE " + " AND ".join(conditions)}
+
+    def key_type(self):
+        """Return type of the key column of the permalinks table.
+
+        Keys are compared with this type, to use the index of the key column.
+        """
+        with self.db.connect() as connection:
+            return connection.execute(sql_text("""
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = CAST(:table AS regclass) AND attname = 'key'
+            """), {"table": self.tables['permalinks']}).scalar()
+
+    def get_permalinks_sql(self):
+        """Return statement selecting permalinks of :keys which have not
+        expired."""
+        return self.statement(('resolve_permalinks',), lambda: sql_text("""
+            SELECT key, data, permitted_group, expires
+            FROM {table}
+            WHERE key IN :keys AND (expires IS NULL OR expires >= CURRENT_DATE)
+        """.format(table=self.tables['permalinks'])).bindparams(bindparam("keys", expanding=True)))
+
+    def get_permalinks(self, keys):
+        result = self.read(
+            lambda connection: connection.execute(
+                self.get_permalinks_sql(), {"keys": keys}
+            ).mappings().all(),
+            [('permalinks', key) for key in keys], len(keys) == 1
+        )
+        entries = self.permalink_entries(result)
+        if self.archive_table:
+            missing = [key for key in keys if key.rstrip(' ') not in entries]
+            if missing:
+                entries.update(self.get_archived_permalinks(missing))
+        return entries
+
+    def get_archived_permalinks(self, keys):
+        """Return dict with archived permalinks of keys which exist and have
+        not expired, moving them back to the permalinks table if
+        archive_promote is set.
+
+        :param list keys: Permalink keys
+        """
+        sql = self.statement(('resolve_archived_permalinks',), lambda: sql_text("""
+            SELECT key, data, permitted_group, expires
+            FROM {table}
+            WHERE key IN :keys AND (expires IS NULL OR expires >= CURRENT_DATE)
+        """.format(table=self.archive_table)).bindparams(bindparam("keys", expanding=True)))
+        entries = self.permalink_entries(self.read(
+            lambda connection: connection.execute(sql, {"keys": keys}).mappings().all(),
+            [('permalinks', key) for key in keys], len(keys) == 1
+        ))
+        with self.lock:
+            self.archive_reads += 1
+        if entries and self.archive_promote:
+            try:
+                self.promote_permalinks(list(entries))
+            except SQLAlchemyError as e:
+                self.logger.warning("Failed to move archived permalinks back: %s" % e)
+        return entries
+
+    def permalink_columns(self):
+        """Return columns of the permalinks and the archive table."""
+        columns = ["key", "data", "date", "expires", "permitted_group", "last_access"]
+        if self.dedup:
+            columns.append("data_hash")
+        return ", ".join(columns)
+
+    def promote_permalinks(self, keys):
+        """Move archived permalinks back to the permalinks table.
+
+        :param list keys: Keys of archived permalinks
+        """
+        sql = self.statement(('promote_permalinks',), lambda: sql_text("""
+            WITH moved AS (
+                DELETE FROM {archive_table} a
+                WHERE key IN :keys AND NOT EXISTS (
+                    SELECT 1 FROM {table} p WHERE p.key = a.key
+                )
+                RETURNING {columns}
+            )
+            INSERT INTO {table} ({columns})
+            SELECT {columns} FROM moved
+        """.format(
+            table=self.tables['permalinks'], archive_table=self.archive_table,
+            columns=self.permalink_columns()
+        )).bindparams(bindparam("keys", expanding=True)))
+        with self.db.begin() as connection:
+            promoted = connection.execute(sql, {"keys": keys}).rowcount
+        with self.lock:
+            self.promoted += promoted
+        self.logger.debug("Moved %d archived permalinks back" % promoted)
+
+    def record_access(self, keys):
+        if not self.archive_table or not keys:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.accessed.update(keys)
+            if now - self.access_flushed < self.access_flush_interval:
+                return
+            self.access_flushed = now
+            keys = self.accessed
+            self.accessed = set()
+        threading.Thread(target=self.flush_access, args=(keys,), daemon=True).start()
+
+    def flush_access(self, keys, batch_size=1000):
+        """Set last access date of resolved permalinks.
+
+        The date is updated at most once a day per permalink.
+
+        :param set keys: Keys of resolved permalinks
+        :param int batch_size: Max number of keys per statement
+        """
+        sql = self.statement(('record_access',), lambda: sql_text("""
+            UPDATE {table} SET last_access = CURRENT_DATE
+            WHERE key IN :keys AND (last_access IS NULL OR last_access < CURRENT_DATE)
+        """.format(table=self.tables['permalinks'])).bindparams(bindparam("keys", expanding=True)))
+        keys = list(keys)
+        updated = 0
+        try:
+            for i in range(0, len(keys), batch_size):
+                with self.db.begin() as connection:
+                    updated += connection.execute(sql, {"keys": keys[i:i + batch_size]}).rowcount
+        except SQLAlchemyError as e:
+            self.logger.warning("Failed to record access of permalinks: %s" % e)
+        with self.lock:
+            self.access_updates += updated
+
+    @staticmethod
+    def permalink_entries(result):
+        """Return dict of stored permalinks by key of result rows.
+
+        :param list result: Rows of get_permalinks_sql()
+        """
+        return {
+            row["key"].rstrip(' '): {
+                "data": row["data"],
+                "permitted_group": row["permitted_group"],
+                "expires": iso_date(row["expires"])
+            }
+            for row in result
+        }
+
+    def keys(self, kind, since=None):
+        table = self.tables[kind]
+        if since is None:
+            sql = self.statement(('keys', kind), lambda: sql_text(
+                "SELECT key FROM {table}".format(table=table)
+            ))
+        else:
+            sql = self.statement(('keys_since', kind), lambda: sql_text(
+                "SELECT key FROM {table} WHERE date >= :since".format(table=table)
+            ))
+        with self.db.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                sql, {"since": since}
+            )
+            for row in result:
+                yield row.key
+        if kind == 'permalinks' and self.archive_table:
+            sql = self.statement(('archived_keys',), lambda: sql_text(
+                "SELECT key FROM {table}".format(table=self.archive_table)
+            ))
+            with self.db.connect() as connection:
+                result = connection.execution_options(stream_results=True).execute(sql)
+                for row in result:
+                    yield row.key
+
+    def run_exclusive(self, lock_name, run_batch, batch_size):
+        """Run batches until a batch processes fewer than batch_size rows,
+        return total number of processed rows, or None if already running.
+
+        A session-level advisory lock ensures that only one process across
+        all workers and hosts sharing the DB runs at a time. Each batch is
+        committed separately.
+
+        :param str lock_name: Name of advisory lock
+        :param callable run_batch: Function(<Connection>) returning number
+                                   of processed rows
+        :param int batch_size: Max number of rows per batch
+        """
+        processed = 0
+        with self.db.connect() as connection:
+            locked = connection.execute(
+                sql_text("SELECT pg_try_advisory_lock(hashtext(:name))"),
+                {"name": lock_name}
+            ).scalar()
+            connection.commit()
+            if not locked:
+                return None
+            try:
+                while True:
+                    rowcount = run_batch(connection)
+                    connection.commit()
+                    processed += rowcount
+                    if rowcount < batch_size:
+                        break
+            finally:
+                connection.rollback()
+                connection.execute(
+                    sql_text("SELECT pg_advisory_unlock(hashtext(:name))"),
+                    {"name": lock_name}
+                )
+                connection.commit()
+        return processed
+
+    def purge_expired_permalinks(self, batch_size):
+        table = self.tables['permalinks']
+        tables = [table]
+        if self.archive_table:
+            tables.append(self.archive_table)
+
+        def purge_sql(table):
+            # NOTE: ctids are not unique across partitions
+            row_id = "key" if self.partitioned and table == self.tables['permalinks'] else "ctid"
+            return sql_text("""
+                DELETE FROM {table}
+                WHERE {row_id} = ANY(ARRAY(
+                    SELECT {row_id} FROM {table}
+                    WHERE expires < CURRENT_DATE
+                    LIMIT :batch_size
+                ))
+            """.format(table=table, row_id=row_id))
+
+        purged = None
+        for table in tables:
+            sql = self.statement(('purge_permalinks', table), lambda: purge_sql(table))
+            rowcount = self.run_exclusive(
+                "qwc-permalink-service:purge:%s" % table,
+                lambda connection: connection.execute(sql, {"batch_size": batch_size}).rowcount,
+                batch_size
+            )
+            if rowcount is not None:
+                purged = (purged or 0) + rowcount
+        return purged
+
+    def archive_permalinks(self, batch_size):
+        if not self.archive_table:
+            return 0
+        table = self.tables['permalinks']
+        select_sql = self.statement(('select_archivable_permalinks',), lambda: sql_text("""
+            SELECT key, data FROM {table}
+            WHERE COALESCE(last_access, date) < CURRENT_DATE - CAST(:days AS integer)
+                AND (expires IS NULL OR expires >= CURRENT_DATE)
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        """.format(table=table)))
+        columns = self.permalink_columns()
+        archive_sql = self.statement(('archive_permalinks',), lambda: sql_text("""
+            WITH archived AS (
+                INSERT INTO {archive_table} ({columns})
+                SELECT {values}
+                FROM {table} p
+                JOIN unnest(CAST(:keys AS {key_type}[]), CAST(:datas AS text[])) AS rows(key, data)
+                    ON p.key = rows.key
+                ON CONFLICT DO NOTHING
+                RETURNING key
+            )
+            DELETE FROM {table} WHERE key IN (SELECT key FROM archived)
+        """.format(
+            table=table, archive_table=self.archive_table, columns=columns,
+            values=", ".join(
+                "rows.data" if column == "data" else "p." + column
+                for column in columns.split(", ")
+            ),
+            key_type=self.key_type()
+        )))
+
+        def archive_batch(connection):
+            rows = connection.execute(
+                select_sql, {"days": self.archive_after_days, "batch_size": batch_size}
+            ).all()
+            if not rows:
+                return 0
+            datas = [
+                row.data if row.data is None or self.archive_codec.is_encoded(row.data)
+                else self.archive_codec.encode_json(StorageCodec.decode_bytes(row.data))
+                for row in rows
+            ]
+            # NOTE: rows whose key is already archived are kept, and end
+            #       the run, as they would be selected again
+            archived = connection.execute(
+                archive_sql, {"keys": [row.key for row in rows], "datas": datas}
+            ).rowcount
+            if archived < len(rows):
+                self.logger.warning(
+                    "Kept %d permalinks whose keys are already archived" % (len(rows) - archived)
+                )
+            return archived
+
+        return self.run_exclusive(
+            "qwc-permalink-service:archive:%s" % table, archive_batch, batch_size
+        )
+
+    def get_user_permalink_sql(self):
+        """Return statement selecting the user permalink of :user."""
+        return self.statement(('get_user_permalink',), lambda: sql_text("""
+            SELECT data
+            FROM {table}
+            WHERE username = :user
+        """.format(table=self.tables['user_permalinks'])))
+
+    def get_user_permalink(self, username):
+        return self.read(
+            lambda connection: connection.execute(
+                self.get_user_permalink_sql(), {"user": username}
+            ).scalar(),
+            [('user', username)], True
+        )
+
+    def set_user_permalink(self, username, data, date):
+        sql = self.statement(('set_user_permalink',), lambda: sql_text("""
+            INSERT INTO {table} (username, data, date)
+            VALUES (:user, :data, :date)
+            ON CONFLICT (username)
+            DO
+            UPDATE
+            SET data = :data, date = :date
+        """.format(table=self.tables['user_permalinks'])))
+        with self.db.begin() as connection:
+            connection.execute(sql, {"user": username, "data": data, "date": date})
+        self.written([('user', username)])
+
+    def date_text(self, column):
+        """Return SQL expression of a date column as ISO date string.
+
+        :param str column: Date column
+        """
+        return "to_char(%s, 'YYYY-MM-DD')" % column
+
+    def list_bookmarks_sql(self, kind, after=None, limit=None):
+        """Return statement listing own and public bookmarks and its params,
+        without the params identifying the user.
+
+        Raises ValueError for an invalid cursor.
+
+        :param str kind: Bookmark kind
+        :param str after: Cursor of the last bookmark of the previous page
+        :param int limit: Max number of bookmarks
+        """
+        table = self.tables[kind]
+        keyset = self.keyset
+        params = {}
+        conditions = []
+        if after:
+            if not keyset:
+                raise ValueError("Cursor pagination is not supported for bookmarks_sort_order")
+            condition, after_params = keyset.where(after, "b")
+            conditions.append(condition)
+            params.update(after_params)
+        if limit is not None:
+            params["limit"] = limit
+
+        def build_sql():
+            if keyset:
+                sort_columns = ", " + keyset.select_columns("b")
+                order_by = keyset.order_by("b")
+            else:
+                sort_columns = ""
+                order_by = self.sort_order
+            if self.users_table:
+                # columns of the list and of the sort order, without data
+                columns = ["key", "description", "date", "theme_id", "public", "username", "user_id"]
+                if keyset:
+                    columns += [term[0] for term in keyset.terms if term[0] not in columns]
+                # NOTE: separate queries for own and public bookmarks,
+                #       which can use separate indexes
+                return sql_text("""
+                    SELECT key, description, {date} as date, theme_id, public, own{sort_columns}
+                    FROM (
+                        SELECT {columns}, TRUE AS own FROM {table}
+                        WHERE user_id = :user_id
+                        UNION ALL
+                        SELECT {columns}, FALSE AS own FROM {table}
+                        WHERE public = TRUE AND NOT COALESCE(user_id = :user_id, FALSE)
+                    ) b
+                    {conditions}
+                    ORDER BY {order_by}
+                    {limit}
+                """.format(
+                    table=table, columns=", ".join(columns), date=self.date_text("date"),
+                    sort_columns=sort_columns, order_by=order_by,
+                    conditions="WHERE " + " AND ".join(conditions) if conditions else "",
+                    limit="LIMIT :limit" if limit is not None else ""
+                ))
+            else:
+                return sql_text("""
+                    SELECT key, description, {date} as date, theme_id, public, (username = :username) as own{sort_columns}
+                    FROM {table} b
+                    WHERE (username = :username OR public = TRUE){conditions}
+                    ORDER BY {order_by}
+                    {limit}
+                """.format(
+                    table=table, date=self.date_text("date"),
+                    sort_columns=sort_columns, order_by=order_by,
+                    conditions="".join(" AND " + c for c in conditions),
+                    limit="LIMIT :limit" if limit is not None else ""
+                ))
+
+        # NOTE: the cursor condition only varies with the NULL values of the cursor
+        sql = self.statement(
+            ('list_bookmarks', kind, tuple(conditions), limit is not None), build_sql
+        )
+        return sql, params
+
+    def list_bookmarks(self, kind, username, after=None, limit=None, stream=False):
+        sql, params = self.list_bookmarks_sql(kind, after, limit)
+        if stream:
+            return self.stream_bookmarks(sql, params, username)
+        return self.read(
+            lambda connection: connection.execute(
+                sql, params | self.user_params(connection, username)
+            ).mappings().all(),
+            [('user', username)]
+        )
+
+    def stream_bookmarks(self, sql, params, username):
+        """Yield rows of bookmark list query, fetched incrementally.
+
+        Falls back to the primary DB only on errors before the first row.
+
+        :param TextClause sql: Bookmark list query
+        :param dict params: Statement params without user params
+        :param str username: User name
+        """
+        def execute(connection):
+            return connection.execution_options(
+                stream_results=True, yield_per=500
+            ).execute(sql, params | self.user_params(connection, username)).mappings()
+
+        connection = None
+        result = None
+        if self.db_readonly is not None and not self.recent_writes.get(('user', username)):
+            try:
+                connection = self.db_readonly.connect()
+                result = execute(connection)
+                self.count_read('replica_reads')
+            except SQLAlchemyError as e:
+                self.logger.warning("Query on read-only DB failed, using primary DB: %s" % e)
+                self.count_read('replica_failures')
+                if connection is not None:
+                    connection.close()
+        if result is None:
+            connection = self.db.connect()
+            self.count_read('primary_reads')
+        with connection:
+            if result is None:
+                result = execute(connection)
+            for row in result:
+                yield row
+
+    def get_bookmark_sql(self, kind):
+        """Return statement selecting an own or public bookmark.
+
+        :param str kind: Bookmark kind
+        """
+        table = self.tables[kind]
+        if self.users_table:
+            return self.statement(('get_bookmark', kind), lambda: sql_text("""
+                SELECT data, theme_id, public
+                FROM {table}
+                WHERE (user_id = :user_id OR public = TRUE) AND key = :key
+            """.format(table=table)))
+        else:
+            return self.statement(('get_bookmark', kind), lambda: sql_text("""
+                SELECT data, theme_id, public
+                FROM {table}
+                WHERE (username = :username OR public = TRUE) and key = :key
+            """.format(table=table)))
+
+    def get_bookmark(self, kind, username, key):
+        return self.read(
+            lambda connection: connection.execute(
+                self.get_bookmark_sql(kind), self.user_params(connection, username) | {"key": key}
+            ).mappings().first(),
+            [('user', username)], True
+        )
+
+    def bookmark_values(self, values):
+        """Return bookmark column values with the base ID of delta encoded
+        payloads, if stored.
+
+        :param dict values: Column values
+        """
+        if self.bookmark_base_ids and "data" in values:
+            return values | {"base_id": StorageCodec.delta_base_id(values["data"])}
+        return values
+
+    def insert_bookmark(self, kind, username, data, date, description, theme_id, public):
+        table = self.tables[kind]
+        base_id, base_param = (", base_id", ", :base_id") if self.bookmark_base_ids else ("", "")
+        if self.users_table:
+            sql = self.statement(('insert_bookmark', kind, base_id), lambda: sql_text("""
+                INSERT INTO {table} (user_id, username, data, key, date, description, theme_id, public{base_id})
+                VALUES (:user_id, :username, :data, :key, :date, :description, :theme_id, :public{base_param})
+                ON CONFLICT DO NOTHING
+                RETURNING key
+            """.format(table=table, base_id=base_id, base_param=base_param)))
+        else:
+            sql = self.statement(('insert_bookmark', kind, base_id), lambda: sql_text("""
+                INSERT INTO {table} (username, data, key, date, description, theme_id, public{base_id})
+                VALUES (:username, :data, :key, :date, :description, :theme_id, :public{base_param})
+                ON CONFLICT DO NOTHING
+                RETURNING key
+            """.format(table=table, base_id=base_id, base_param=base_param)))
+        with self.db.begin() as connection:
+            params = self.user_params(connection, username) | self.bookmark_values({
+                "data": data, "date": date, "description": description,
+                "theme_id": theme_id, "public": public
+            })
+            key = self.key_allocator.insert(connection, sql, params)
+        self.written([('user', username)])
+        return key
+
+    def update_bookmark(self, kind, username, key, values, public_permitted):
+        table = self.tables[kind]
+        values = self.bookmark_values(values)
+        set_sql = ", ".join("%s = :%s" % (column, column) for column in values)
+        public_cond_sql = "OR public = TRUE" if public_permitted else ""
+        if self.users_table:
+            sql = self.statement(('update_bookmark', kind, set_sql, public_cond_sql), lambda: sql_text("""
+                UPDATE {table}
+                SET username = :username, {set_sql}
+                WHERE key = :key AND (user_id = :user_id {public_cond_sql})
+            """.format(table=table, set_sql=set_sql, public_cond_sql=public_cond_sql)))
+        else:
+            sql = self.statement(('update_bookmark', kind, set_sql, public_cond_sql), lambda: sql_text("""
+                UPDATE {table}
+                SET {set_sql}
+                WHERE key = :key AND (username = :username {public_cond_sql})
+            """.format(table=table, set_sql=set_sql, public_cond_sql=public_cond_sql)))
+        with self.db.begin() as connection:
+            params = self.user_params(connection, username) | values | {"key": key}
+            result = connection.execute(sql, params)
+        self.written([('user', username)])
+        if result.rowcount != 1:
+            # user ID may be stale
+            self.user_ids.invalidate(username)
+        return result.rowcount == 1
+
+    def delete_bookmark(self, kind, username, key, public_permitted):
+        table = self.tables[kind]
+        public_cond_sql = "OR public = TRUE" if public_permitted else ""
+        if self.users_table:
+            sql = self.statement(('delete_bookmark', kind, public_cond_sql), lambda: sql_text("""
+                DELETE FROM {table}
+                WHERE key = :key AND (user_id = :user_id {public_cond_sql})
+            """.format(table=table, public_cond_sql=public_cond_sql)))
+        else:
+            sql = self.statement(('delete_bookmark', kind, public_cond_sql), lambda: sql_text("""
+                DELETE FROM {table}
+                WHERE key = :key AND (username = :username {public_cond_sql})
+            """.format(table=table, public_cond_sql=public_cond_sql)))
+        with self.db.begin() as connection:
+            params = self.user_params(connection, username) | {"key": key}
+            result = connection.execute(sql, params)
+        self.written([('user', username)])
+        if result.rowcount == 0:
+            # user ID may be stale
+            self.user_ids.invalidate(username)
+        return result.rowcount > 0
+
+    def latest_bookmark_base(self, kind, username, theme_id):
+        sql = self.statement(('latest_bookmark_base',), lambda: sql_text("""
+            SELECT id, data FROM {table}
+            WHERE kind = :kind AND username = :username AND theme_id = :theme_id
+            ORDER BY id DESC
+            LIMIT 1
+        """.format(table=self.tables['bookmark_bases'])))
+        with self.db.connect() as connection:
+            row = connection.execute(
+                sql, {"kind": kind, "username": username, "theme_id": theme_id}
+            ).first()
+        return tuple(row) if row else None
+
+    def insert_bookmark_base(self, kind, username, theme_id, data, date):
+        sql = self.statement(('insert_bookmark_base',), lambda: sql_text("""
+            INSERT INTO {table} (kind, username, theme_id, data, date)
+            VALUES (:kind, :username, :theme_id, :data, :date)
+            RETURNING id
+        """.format(table=self.tables['bookmark_bases'])))
+        with self.db.begin() as connection:
+            base_id = connection.execute(sql, {
+                "kind": kind, "username": username, "theme_id": theme_id,
+                "data": data, "date": date
+            }).scalar()
+        self.written([('bookmark_bases', base_id)])
+        return base_id
+
+    def get_bookmark_base(self, base_id):
+        sql = self.statement(('get_bookmark_base',), lambda: sql_text(
+            "SELECT data FROM {table} WHERE id = :id".format(table=self.tables['bookmark_bases'])
+        ))
+        return self.read(
+            lambda connection: connection.execute(sql, {"id": base_id}).scalar(),
+            [('bookmark_bases', base_id)], True
+        )
+
+    def purge_bookmark_bases(self, kind, username, theme_id):
+        # NOTE: the previous base is kept for concurrent requests which
+        #       encoded a payload against it before the rebase
+        sql = self.statement(('purge_bookmark_bases', kind), lambda: sql_text("""
+            DELETE FROM {table}
+            WHERE kind = :kind AND username = :username AND theme_id = :theme_id
+                AND id < (
+                    SELECT id FROM {table}
+                    WHERE kind = :kind AND username = :username AND theme_id = :theme_id
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET 1
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM {bookmarks_table} b WHERE b.base_id = {table}.id
+                )
+        """.format(table=self.tables['bookmark_bases'], bookmarks_table=self.tables[kind])))
+        with self.db.begin() as connection:
+            return connection.execute(sql, {
+                "kind": kind, "username": username, "theme_id": theme_id
+            }).rowcount
+
+    def check(self):
+        with self.db.connect() as connection:
+            connection.execute(sql_text("SELECT 1"))
+
+    def table_requirements(self, bookmark_bases):
+        """Return dict with (<table>, <columns>, <indexed columns>,
+        <unique indexed columns>) by table kind.
+
+        Indexed columns need an index or primary key starting with them.
+
+        :param bool bookmark_bases: Whether to include the bookmark bases table
+        """
+        permalink_columns = ["key", "data", "date", "expires", "permitted_group"]
+        if self.dedup:
+            permalink_columns.append("data_hash")
+        if self.archive_table:
+            permalink_columns.append("last_access")
+        permalink_indexes = ["data_hash"] if self.dedup else []
+        # NOTE: keys of partitioned tables are unique per partition only
+        permalink_unique = [] if self.partitioned else ["key"]
+        user_column = "user_id" if self.users_table else "username"
+        requirements = {
+            'permalinks': (
+                self.tables['permalinks'], permalink_columns,
+                permalink_indexes + (["key"] if self.partitioned else []), permalink_unique
+            ),
+            'user_permalinks': (
+                self.tables['user_permalinks'], ["username", "data", "date"], [], ["username"]
+            )
+        }
+        for kind in BOOKMARK_KINDS:
+            columns = ["username", "data", "key", "date", "description", "theme_id", "public"]
+            if self.users_table:
+                columns.append("user_id")
+            indexed = [user_column]
+            if bookmark_bases:
+                columns.append("base_id")
+                indexed.append("base_id")
+            requirements[kind] = (self.tables[kind], columns, indexed, [])
+        if self.archive_table:
+            requirements['permalinks_archive'] = (
+                self.archive_table, ["key", "data", "date", "expires", "permitted_group", "last_access"],
+                [], ["key"]
+            )
+        if bookmark_bases:
+            requirements['bookmark_bases'] = (
+                self.tables['bookmark_bases'],
+                ["id", "kind", "username", "theme_id", "data", "date"], ["username"], ["id"]
+            )
+        return requirements
+
+    def check_tables(self, bookmark_bases=False):
+        problems = {}
+        with self.db.connect() as connection:
+            inspector = inspect(connection)
+            for kind, (table, columns, indexed, unique) in self.table_requirements(bookmark_bases).items():
+                *schema, name = [part.strip('"') for part in table.split('.')]
+                schema = schema[0] if schema else None
+                if not inspector.has_table(name, schema):
+                    problems[kind] = {"missing": True}
+                    continue
+                existing = {column["name"] for column in inspector.get_columns(name, schema)}
+                # leading_columns[<column>] = <whether unique>
+                leading_columns = {}
+                primary_key = inspector.get_pk_constraint(name, schema)["constrained_columns"]
+                indexes = [
+                    (index["column_names"], index["unique"])
+                    for index in inspector.get_indexes(name, schema)
+                ] + [
+                    (constraint["column_names"], True)
+                    for constraint in inspector.get_unique_constraints(name, schema)
+                ] + [(primary_key, True)]
+                for index_columns, index_unique in indexes:
+                    if index_columns and index_columns[0]:
+                        # unique if unique on the leading column only
+                        leading_columns[index_columns[0]] = leading_columns.get(
+                            index_columns[0], False
+                        ) or (index_unique and len(index_columns) == 1)
+                missing_columns = [column for column in columns if column not in existing]
+                missing_indexes = [
+                    column for column in indexed if column not in leading_columns
+                ] + [
+                    "%s (unique)" % column for column in unique
+                    if not leading_columns.get(column)
+                ]
+                if missing_columns or missing_indexes:
+                    problems[kind] = {
+                        "missing_columns": missing_columns,
+                        "missing_indexes": missing_indexes
+                    }
+        return problems
+
+    def stats(self):
+        stats = super().stats() | {
+            "statements": len(self.statements),
+            "user_ids": self.user_ids.stats()
+        }
+        if self.db_readonly is not None:
+            with self.lock:
+                stats["reads"] = {
+                    "replica": self.replica_reads,
+                    "primary": self.primary_reads,
+                    "replica_failures": self.replica_failures
+                }
+        if self.archive_table:
+            with self.lock:
+                stats["archive"] = {
+                    "reads": self.archive_reads,
+                    "promoted": self.promoted,
+                    "access_updates": self.access_updates,
+                    "pending_accesses": len(self.accessed)
+                }
+        return stats
+
+
+class SQLiteStorage(PostgresStorage):
+    """Storage in an SQLite database, e.g. for benchmarks and tests without
+    a ConfigDB.
+
+    Tables are created if missing. Bookmarks are stored by username.
+    Archiving and partitioning are not supported.
+    """
+
+    def __init__(self, db, config, key_allocator, logger):
+        """Constructor
+
+        :param Engine db: DB engine
+        :param RuntimeConfig config: Tenant config
+        :param KeyAllocator key_allocator: Allocator for new keys
+        :param Logger logger: Application logger
+        """
+        super().__init__(db, config, key_allocator, logger)
+        self.users_table = None
+        self.partitioned = False
+        self.archive_table = None
+        self.bookmark_base_ids = True
+        # use configured table names without schema
+        self.tables = {
+            kind: table.split('.')[-1] for kind, table in self.tables.items()
+        }
+        self.create_tables()
+
+    def create_tables(self):
+        """Create tables if missing."""
+        with self.db.begin() as connection:
+            connection.execute(sql_text("""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    key varchar(10) PRIMARY KEY, data text, date date, expires date,
+                    permitted_group varchar, data_hash varchar(64)
+                )
+            """.format(table=self.tables['permalinks'])))
+            connection.execute(sql_text(
+                "CREATE INDEX IF NOT EXISTS {table}_data_hash_idx ON {table} (data_hash)".format(
+                    table=self.tables['permalinks']
+                )
+            ))
+            connection.execute(sql_text("""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    username varchar PRIMARY KEY, data text, date date
+                )
+            """.format(table=self.tables['user_permalinks'])))
+            connection.execute(sql_text("""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id integer PRIMARY KEY, kind varchar NOT NULL, username varchar NOT NULL,
+                    theme_id varchar NOT NULL, data text, date date
+                )
+            """.format(table=self.tables['bookmark_bases'])))
+            for kind in BOOKMARK_KINDS:
+                connection.execute(sql_text("""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        username varchar NOT NULL, data text, key varchar(10) NOT NULL,
+                        date date, description text, theme_id varchar,
+                        public boolean DEFAULT FALSE, base_id integer, PRIMARY KEY (username, key)
+                    )
+                """.format(table=self.tables[kind])))
+                columns = {column["name"] for column in inspect(connection).get_columns(self.tables[kind])}
+                if "base_id" not in columns:
+                    # table created before delta encoded payloads were indexed
+                    connection.execute(sql_text(
+                        "ALTER TABLE {table} ADD COLUMN base_id integer".format(table=self.tables[kind])
+                    ))
+                    connection.execute(sql_text("""
+                        UPDATE {table} SET base_id = CAST(substr(data, 4, instr(substr(data, 4), ':') - 1) AS integer)
+                        WHERE data LIKE 'd1:%'
+                    """.format(table=self.tables[kind])))
+                connection.execute(sql_text(
+                    "CREATE INDEX IF NOT EXISTS {table}_key_idx ON {table} (key)".format(
+                        table=self.tables[kind]
+                    )
+                ))
+                connection.execute(sql_text(
+                    "CREATE INDEX IF NOT EXISTS {table}_base_id_idx ON {table} (base_id)".format(
+                        table=self.tables[kind]
+                    )
+                ))
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        table = self.tables['permalinks']
+        results = [(None, expires)] * len(datas)
+        params = {"date": date, "expires": expires, "permitted_group": permitted_group}
+        # pending[<data hash or item index>] = [<item index>]
+        pending = {}
+        for i in range(len(datas)):
+            pending.setdefault(hashes[i] if hashes else i, []).append(i)
+
+        sql = self.statement(('insert_permalink',), lambda: sql_text("""
+            INSERT INTO {table} (key, data, date, expires, permitted_group, data_hash)
+            VALUES (:key, :data, :date, :expires, :permitted_group, :data_hash)
+            ON CONFLICT DO NOTHING
+            RETURNING key
+        """.format(table=table)))
+        with self.db.begin() as connection:
+            if hashes:
+                # Reuse permalinks with same payload, permitted group and expiry policy
+                dedup_sql = self.statement(('dedup_permalinks', bool(expires)), lambda: sql_text("""
+                    SELECT key, data_hash, expires
+                    FROM {table}
+                    WHERE data_hash IN :hashes AND permitted_group IS NOT DISTINCT FROM :permitted_group
+                        AND {expiry_cond}
+                    ORDER BY data_hash, expires
+                """.format(
+                    table=table,
+                    expiry_cond="expires >= CURRENT_DATE" if expires else "expires IS NULL"
+                )).bindparams(bindparam("hashes", expanding=True)))
+                extend_sql = self.statement(('extend_permalinks',), lambda: sql_text("""
+                    UPDATE {table} SET expires = :expires
+                    WHERE key = :key AND expires < :expires
+                """.format(table=table)))
+                existing = {}
+                for row in connection.execute(dedup_sql, params | {"hashes": list(pending)}).mappings():
+                    # keep latest expiry per hash
+                    existing[row["data_hash"]] = row
+                for data_hash, row in existing.items():
+                    row_expires = row["expires"]
+                    if expires and (row_expires or "") < expires:
+                        connection.execute(extend_sql, {"key": row["key"], "expires": expires})
+                        row_expires = expires
+                    for i in pending.pop(data_hash):
+                        results[i] = (row["key"], row_expires)
+
+            for data_hash, indices in pending.items():
+                key = self.key_allocator.insert(connection, sql, params | {
+                    "data": datas[indices[0]], "data_hash": data_hash if hashes else None
+                })
+                for i in indices:
+                    results[i] = (key, expires)
+        self.written([('permalinks', key) for key, key_expires in results if key])
+        return results
+
+    def purge_expired_permalinks(self, batch_size):
+        sql = self.statement(('purge_permalinks',), lambda: sql_text("""
+            DELETE FROM {table}
+            WHERE rowid IN (
+                SELECT rowid FROM {table}
+                WHERE expires < CURRENT_DATE
+                LIMIT :batch_size
+            )
+        """.format(table=self.tables['permalinks'])))
+        purged = 0
+        while True:
+            with self.db.begin() as connection:
+                rowcount = connection.execute(sql, {"batch_size": batch_size}).rowcount
+            purged += rowcount
+            if rowcount < batch_size:
+                return purged
+
+    def date_text(self, column):
+        # dates are stored as ISO date strings
+        return column
+
+
+class MemoryStorage(Storage):
+    """Storage in memory of the current process, e.g. for benchmarks and
+    tests without a DB.
+
+    Contents are lost on restart and not shared between processes.
+    """
+
+    def __init__(self, config, key_allocator, logger):
+        """Constructor
+
+        :param RuntimeConfig config: Tenant config
+        :param KeyAllocator key_allocator: Allocator for new keys
+        :param Logger logger: Application logger
+        """
+        super().__init__(config, key_allocator, logger)
+        # permalinks[<key>] = {"data", "date", "expires", "permitted_group", "data_hash"}
+        self.permalinks = {}
+        # user_permalinks[<username>] = {"data", "date"}
+        self.user_permalinks = {}
+        # bookmarks[<kind>][<key>] = {"username", "data", "key", "date", ...}
+        self.bookmarks = {kind: {} for kind in BOOKMARK_KINDS}
+        # bookmark_bases[<base ID>] = {"kind", "username", "theme_id", "data", "date"}
+        self.bookmark_bases = {}
+        self.lock = threading.Lock()
+        if self.keyset is None:
+            self.keyset = KeysetPagination('date DESC, description')
+
+    def allocate(self, rows, row):
+        """Store row under new key, return key or None.
+
+        :param dict rows: Rows by key
+        :param dict row: Row without key
+        """
+        allocator = self.key_allocator
+        for attempt in range(allocator.max_attempts):
+            key = allocator.generate()
+            if key not in rows:
+                rows[key] = row | {"key": key}
+                return key
+        return None
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        today = datetime.date.today().isoformat()
+        results = []
+        with self.lock:
+            # existing[<data hash>] = <key>
+            existing = {}
+            if hashes:
+                for key, row in self.permalinks.items():
+                    if (
+                        row["data_hash"] in hashes and row["permitted_group"] == permitted_group and
+                        ((row["expires"] or "") >= today if expires else row["expires"] is None)
+                    ):
+                        previous = existing.get(row["data_hash"])
+                        if previous is None or (self.permalinks[previous]["expires"] or "") < (row["expires"] or ""):
+                            existing[row["data_hash"]] = key
+            for i, data in enumerate(datas):
+                data_hash = hashes[i] if hashes else None
+                key = existing.get(data_hash)
+                if key is not None:
+                    row = self.permalinks[key]
+                    if expires and (row["expires"] or "") < expires:
+                        row["expires"] = expires
+                    results.append((key, row["expires"]))
+                    continue
+                key = self.allocate(self.permalinks, {
+                    "data": data, "date": date, "expires": expires,
+                    "permitted_group": permitted_group, "data_hash": data_hash
+                })
+                if key is not None and data_hash:
+                    existing[data_hash] = key
+                results.append((key, expires))
+        return results
+
+    def get_permalinks(self, keys):
+        today = datetime.date.today().isoformat()
+        entries = {}
+        with self.lock:
+            for key in keys:
+                row = self.permalinks.get(key)
+                if row is not None and (row["expires"] is None or row["expires"] >= today):
+                    entries[key] = {
+                        "data": row["data"],
+                        "permitted_group": row["permitted_group"],
+                        "expires": iso_date(row["expires"])
+                    }
+        return entries
+
+    def keys(self, kind, since=None):
+        rows = self.permalinks if kind == 'permalinks' else self.bookmarks[kind]
+        since = since.isoformat() if since else ""
+        with self.lock:
+            return [key for key, row in rows.items() if (row["date"] or "") >= since]
+
+    def purge_expired_permalinks(self, batch_size):
+        today = datetime.date.today().isoformat()
+        with self.lock:
+            expired = [
+                key for key, row in self.permalinks.items()
+                if row["expires"] is not None and row["expires"] < today
+            ]
+            for key in expired:
+                del self.permalinks[key]
+        return len(expired)
+
+    def get_user_permalink(self, username):
+        with self.lock:
+            row = self.user_permalinks.get(username)
+            return row["data"] if row else None
+
+    def set_user_permalink(self, username, data, date):
+        with self.lock:
+            self.user_permalinks[username] = {"data": data, "date": date}
+
+    def list_bookmarks(self, kind, username, after=None, limit=None, stream=False):
+        keyset = self.keyset
+        columns = [term[0] for term in keyset.terms]
+        with self.lock:
+            rows = [
+                row for row in self.bookmarks[kind].values()
+                if row["username"] == username or row["public"]
+            ]
+        items = []
+        for row in rows:
+            item = {
+                "key": row["key"],
+                "description": row["description"],
+                "date": row["date"],
+                "theme_id": row["theme_id"],
+                "public": row["public"],
+                "own": row["username"] == username
+            }
+            for i, column in enumerate(columns):
+                item["_sort%d" % i] = row.get(column)
+            items.append(item)
+
+        values = lambda item: [item["_sort%d" % i] for i in range(len(columns))]
+        if after:
+            cursor = keyset.decode(after)
+            items = [item for item in items if keyset.compare(values(item), cursor) > 0]
+        items.sort(key=functools.cmp_to_key(lambda a, b: keyset.compare(values(a), values(b))))
+        return items[0:limit] if limit is not None else items
+
+    def get_bookmark(self, kind, username, key):
+        with self.lock:
+            row = self.bookmarks[kind].get(key)
+            if row is not None and (row["username"] == username or row["public"]):
+                return {"data": row["data"], "theme_id": row["theme_id"], "public": row["public"]}
+        return None
+
+    def insert_bookmark(self, kind, username, data, date, description, theme_id, public):
+        with self.lock:
+            return self.allocate(self.bookmarks[kind], {
+                "username": username, "data": data, "date": date,
+                "description": description, "theme_id": theme_id, "public": public,
+                "base_id": StorageCodec.delta_base_id(data)
+            })
+
+    def update_bookmark(self, kind, username, key, values, public_permitted):
+        with self.lock:
+            row = self.bookmarks[kind].get(key)
+            if row is None or not (row["username"] == username or (public_permitted and row["public"])):
+                return False
+            row.update(values)
+            if "data" in values:
+                row["base_id"] = StorageCodec.delta_base_id(values["data"])
+            return True
+
+    def delete_bookmark(self, kind, username, key, public_permitted):
+        with self.lock:
+            row = self.bookmarks[kind].get(key)
+            if row is None or not (row["username"] == username or (public_permitted and row["public"])):
+                return False
+            del self.bookmarks[kind][key]
+            return True
+
+    def group_bookmark_bases(self, kind, username, theme_id):
+        """Return IDs of bookmark bases of a user and theme, latest last."""
+        return [
+            base_id for base_id, base in self.bookmark_bases.items()
+            if (base["kind"], base["username"], base["theme_id"]) == (kind, username, theme_id)
+        ]
+
+    def latest_bookmark_base(self, kind, username, theme_id):
+        with self.lock:
+            base_ids = self.group_bookmark_bases(kind, username, theme_id)
+            if not base_ids:
+                return None
+            return base_ids[-1], self.bookmark_bases[base_ids[-1]]["data"]
+
+    def insert_bookmark_base(self, kind, username, theme_id, data, date):
+        with self.lock:
+            base_id = max(self.bookmark_bases, default=0) + 1
+            self.bookmark_bases[base_id] = {
+                "kind": kind, "username": username, "theme_id": theme_id,
+                "data": data, "date": date
+            }
+            return base_id
+
+    def get_bookmark_base(self, base_id):
+        with self.lock:
+            base = self.bookmark_bases.get(base_id)
+            return base["data"] if base else None
+
+    def purge_bookmark_bases(self, kind, username, theme_id):
+        with self.lock:
+            referenced = {row["base_id"] for row in self.bookmarks[kind].values()}
+            purged = [
+                base_id for base_id in self.group_bookmark_bases(kind, username, theme_id)[:-2]
+                if base_id not in referenced
+            ]
+            for base_id in purged:
+                del self.bookmark_bases[base_id]
+        return len(purged)
+
+
+def create_storage(config, db_engine, key_allocator, logger):
+    """Return storage backend configured by storage_backend.
+
+    :param RuntimeConfig config: Tenant config
+    :param DatabaseEngine db_engine: Database engines
+    :param KeyAllocator key_allocator: Allocator for new keys
+    :param Logger logger: Application logger
+    """
+    backend = config.get('storage_backend', 'postgresql')
+    if backend == 'memory':
+        return MemoryStorage(config, key_allocator, logger)
+    elif backend == 'sqlite':
+        return SQLiteStorage(
+            db_engine.db_engine(config.get('db_url', 'sqlite:///permalinks.db')),
+            config, key_allocator, logger
+        )
+    db_url_readonly = config.get('db_url_readonly')
+    return PostgresStorage(
+        db_engine.db_engine(config.get('db_url', 'postgresql:///?service=qwc_configdb')),
+        config, key_allocator, logger,
+        db_engine.db_engine(db_url_readonly) if db_url_readonly else None
+    )
@@ -0,0 +1,135 @@
+import base64
+import json
+import re
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import json_codec
+
+
+# version markers of compressed payloads
+ZLIB_MARKER = "z1:"
+ZSTD_MARKER = "zs1:"
+# marker of delta encoded bookmark payloads, see bookmark_delta
+DELTA_MARKER = "d1:"
+
+# non-ASCII characters, which can only occur within JSON strings
+NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+
+class StorageCodec:
+    """Encode and decode JSON payloads stored in the data text columns.
+
+    Payloads are serialized as canonical JSON (see json_codec.dumps()).
+    Compressed payloads are stored as base64 encoded canonical JSON with a
+    version marker prefix, which can never start a JSON document. Legacy
+    plain JSON payloads are decoded transparently, so both can coexist in
+    the same table.
+    """
+
+    def __init__(self, codec="json", min_size=1024, logger=None):
+        """Constructor
+
+        :param str codec: Codec for new payloads ('json', 'zlib' or 'zstd')
+        :param int min_size: Min size in bytes of the JSON payload for
+                             compressing it
+        :param Logger logger: Application logger
+        """
+        if codec == "zstd" and zstandard is None:
+            if logger:
+                logger.warning("zstandard is not installed, using zlib storage codec")
+            codec = "zlib"
+        self.codec = codec
+        self.min_size = min_size
+
+    def encode(self, data):
+        """Return text to store for payload.
+
+        :param obj data: JSON serializable payload
+        """
+        return self.encode_json(json_codec.dumps(data))
+
+    def encode_json(self, raw):
+        """Return text to store for a canonical JSON document.
+
+        Non-ASCII characters of plain JSON text are escaped, so it can be
+        stored regardless of the DB encoding.
+
+        :param bytes raw: UTF-8 encoded JSON document
+        """
+        if self.codec == "json" or len(raw) < self.min_size:
+            text = raw.decode('utf-8')
+            if not text.isascii():
+                text = NON_ASCII.sub(lambda m: json.dumps(m.group(0))[1:-1], text)
+            return text
+        if self.codec == "zstd":
+            compressed = zstandard.ZstdCompressor().compress(raw)
+            marker = ZSTD_MARKER
+        else:
+            compressed = zlib.compress(raw, 9)
+            marker = ZLIB_MARKER
+        return marker + base64.b64encode(compressed).decode('ascii')
+
+    def is_encoded(self, text):
+        """Return whether stored text is already encoded with this codec.
+
+        :param str text: Stored text
+        """
+        if text.startswith(DELTA_MARKER):
+            # patches are encoded when stored
+            return True
+        elif text.startswith(ZLIB_MARKER):
+            return self.codec == "zlib"
+        elif text.startswith(ZSTD_MARKER):
+            return self.codec == "zstd"
+        else:
+            return self.codec == "json" or len(text.encode('utf-8')) < self.min_size
+
+    @staticmethod
+    def is_delta(text):
+        """Return whether stored text is a delta encoded bookmark payload.
+
+        :param str text: Stored text
+        """
+        return text.startswith(DELTA_MARKER)
+
+    @staticmethod
+    def delta_base_id(text):
+        """Return ID of the base of a delta encoded bookmark payload, or
+        None if not delta encoded.
+
+        :param str text: Stored text
+        """
+        if not text or not text.startswith(DELTA_MARKER):
+            return None
+        return int(text[len(DELTA_MARKER):].split(':', 1)[0])
+
+    @staticmethod
+    def decode_bytes(text):
+        """Return JSON document of stored text as UTF-8 bytes.
+
+        :param str text: Stored text
+        """
+        if text.startswith(ZLIB_MARKER):
+            return zlib.decompress(base64.b64decode(text[len(ZLIB_MARKER):]))
+        elif text.startswith(ZSTD_MARKER):
+            if zstandard is None:
+                raise Exception("zstandard is required to decode payload")
+            return zstandard.ZstdDecompressor().decompress(
+                base64.b64decode(text[len(ZSTD_MARKER):])
+            )
+        elif text.startswith(DELTA_MARKER):
+            raise Exception("Base is required to decode delta encoded payload")
+        return text.encode('utf-8')
+
+    @staticmethod
+    def decode(text):
+        """Return payload of stored text.
+
+        :param str text: Stored text
+        """
+        return json_codec.loads(StorageCodec.decode_bytes(text))
@@ -0,0 +1,119 @@
+import threading
+
+from bookmark_delta import BookmarkDeltas
+from caches import NegativeCache
+from expiry_sweeper import ExpirySweeper
+from group_commit import GroupCommit
+from health_check import HealthCheck
+from key_allocator import KeyAllocator
+from permissions_cache import PermissionsCache
+from request_profiler import phase
+from shared_cache import cache_factory
+from storage import create_storage
+from storage_codec import StorageCodec
+
+
+class TenantContext:
+    """Per-tenant config, storage and helpers.
+
+    Built once per tenant and registered with the tenant handler, which
+    discards it when the tenant config or permissions have changed, so
+    requests neither re-read the config file nor rebuild SQL statements.
+    """
+
+    def __init__(self, tenant, config, db_engine, logger):
+        """Constructor
+
+        :param str tenant: Tenant ID
+        :param RuntimeConfig config: Tenant config
+        :param DatabaseEngine db_engine: Database engines
+        :param Logger logger: Application logger
+        """
+        self.tenant = tenant
+        self.config = config
+        self.logger = logger
+
+        # resolve and bookmark caches, optionally shared by all processes
+        make_cache = cache_factory(config, tenant, logger)
+        self.resolve_cache = make_cache(
+            'resolve',
+            config.get('resolve_cache_size', 1000),
+            config.get('resolve_cache_ttl', 300)
+        )
+        self.expiry_sweeper = ExpirySweeper(
+            logger,
+            config.get('expiry_sweep_interval', 3600),
+            config.get('expiry_sweep_batch_size', 1000)
+        )
+        self.key_allocator = KeyAllocator(
+            config.get('key_length', 9),
+            config.get('key_alphabet', 'hex')
+        )
+        self.storage_codec = StorageCodec(
+            config.get('storage_codec', 'json'),
+            config.get('storage_codec_min_size', 1024),
+            logger
+        )
+        self.negative_cache = NegativeCache(
+            config.get('negative_cache_size', 10000),
+            config.get('negative_cache_ttl', 30)
+        )
+        self.storage = create_storage(config, db_engine, self.key_allocator, logger)
+        # DB engine of the storage, None if not stored in a DB
+        self.db = self.storage.db
+        # delta encoding of bookmark payloads, also decodes delta encoded
+        # payloads if disabled
+        self.bookmark_deltas = BookmarkDeltas(
+            self.storage, self.storage_codec, logger,
+            config.get('bookmark_delta_encoding', False),
+            config.get('bookmark_delta_max_ratio', 0.5),
+            config.get('bookmark_delta_min_size', 256),
+            config.get('bookmark_delta_cache_size', 1000),
+            config.get('bookmark_delta_cache_ttl', 3600),
+            make_cache
+        )
+        # cached health check of the storage
+        self.health_check = HealthCheck(
+            self.storage.check, logger,
+            config.get('health_check_interval', 10),
+            config.get('health_check_timeout', 2)
+        )
+        # optional group commit of created permalinks, disabled by default
+        # as it only batches requests of concurrent threads of a process
+        self.group_commit = None
+        if config.get('group_commit', False):
+            self.group_commit = GroupCommit(
+                self.storage,
+                config.get('group_commit_max_batch_size', 100),
+                config.get('group_commit_max_wait', 0.01),
+                config.get('group_commit_timeout', 5)
+            )
+        self._permissions = None
+        self.lock = threading.Lock()
+
+    @property
+    def permissions(self):
+        """Return permissions cache, loading the permissions on first use."""
+        if self._permissions is None:
+            with self.lock, phase('permissions'):
+                if self._permissions is None:
+                    self._permissions = PermissionsCache(
+                        self.tenant, self.logger,
+                        self.config.get('permissions_cache_ttl', 300),
+                        self.config.get('permissions_cache_size', 1000)
+                    )
+        return self._permissions
+
+    def stats(self):
+        """Return dict with stats of the helpers."""
+        return {
+            "storage": self.storage.stats(),
+            "resolve_cache": self.resolve_cache.stats(),
+            "negative_cache": self.negative_cache.stats(),
+            "key_allocator": self.key_allocator.stats(),
+            "expiry_sweeper": self.expiry_sweeper.stats(),
+            "group_commit": self.group_commit.stats() if self.group_commit else None,
+            "bookmark_deltas": self.bookmark_deltas.stats(),
+            "health_check": self.health_check.stats(),
+            "permissions": self._permissions.stats() if self._permissions else None
+        }
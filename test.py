@@ -1,6 +1,29 @@
 import unittest
 
 from tests.api_tests import *
+from tests.archive_tests import *
+from tests.asgi_tests import *
+from tests.async_storage_tests import *
+from tests.bookmark_delta_tests import *
+from tests.caches_tests import *
+from tests.dedup_tests import *
+from tests.expiry_sweeper_tests import *
+from tests.group_commit_tests import *
+from tests.health_check_tests import *
+from tests.json_codec_tests import *
+from tests.key_allocator_tests import *
+from tests.keyset_tests import *
+from tests.load_benchmark_tests import *
+from tests.metrics_tests import *
+from tests.permalink_cli_tests import *
+from tests.permissions_cache_tests import *
+from tests.read_replica_tests import *
+from tests.request_profiler_tests import *
+from tests.shared_cache_tests import *
+from tests.storage_codec_tests import *
+from tests.storage_tests import *
+from tests.tenant_context_tests import *
+from tests.user_id_cache_tests import *
 
 
 if __name__ == '__main__':
@@ -3,18 +3,25 @@ from urllib.parse import urlparse, parse_qs, urlencode
 
 from flask import Response, json
 from flask.testing import FlaskClient
-from flask_jwt_extended import JWTManager, create_access_token
+from flask_jwt_extended import JWTManager
 
 import server
+from caches import NegativeCache
 
 
 class ApiTestCase(unittest.TestCase):
     """Test case for server API"""
 
+    @classmethod
+    def setUpClass(cls):
+        # NOTE: Flask rejects registering the JWT error handlers again once
+        #       the app has handled a request, i.e. in setUp() of the
+        #       second test
+        JWTManager(server.app)
+
     def setUp(self):
         server.app.testing = True
         self.app = FlaskClient(server.app, Response)
-        JWTManager(server.app)
 
     def tearDown(self):
         pass
@@ -52,3 +59,84 @@ class ApiTestCase(unittest.TestCase):
         self.assertIn('state', response_data, 'Response has no state field')
         self.assertEqual({'arg': 'value'}, response_data['query'], 'Response query mismatch')
         self.assertEqual(data, response_data['state'], 'Response state mismatch')
+
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag, 'Response has no ETag')
+        self.assertIn('max-age', response.headers.get('Cache-Control', ''), 'Response has no max-age')
+        response = self.app.get('/resolvepermalink?' + query, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code, "Status code is not Not Modified")
+
+    def test_permalinks_batch(self):
+        testUrl = 'http://www.example.com/?arg=value'
+        query = urlencode({'url': testUrl})
+        states = [
+            {"field1": "value1"},
+            {"field1": "value2", "url": "http://www.example.com/other?arg=other"}
+        ]
+        response = self.app.post('/createpermalinks?' + query, data=json.dumps(states),
+                                 content_type='application/json')
+        self.assertEqual(200, response.status_code, "Status code is not OK")
+
+        response_data = json.loads(response.data)
+        self.assertEqual(2, len(response_data), "Response has wrong number of items")
+        keys = []
+        for item in response_data:
+            self.assertIn('permalink', item, 'Response item has no permalink field')
+            keys.append(parse_qs(urlparse(item['permalink']).query)['k'][0])
+        self.assertEqual('/other', urlparse(response_data[1]['permalink']).path, "Permalink URL path mismatches")
+
+        response = self.app.post('/resolvepermalinks', data=json.dumps(keys + ['unknown']),
+                                 content_type='application/json')
+        self.assertEqual(200, response.status_code, "Status code is not OK")
+
+        response_data = json.loads(response.data)
+        self.assertEqual(3, len(response_data), "Response has wrong number of items")
+        self.assertEqual({'arg': 'value'}, response_data[0]['query'], 'Response query mismatch')
+        self.assertEqual({"field1": "value1"}, response_data[0]['state'], 'Response state mismatch')
+        self.assertEqual({'arg': 'other'}, response_data[1]['query'], 'Response query mismatch')
+        self.assertEqual({"field1": "value2"}, response_data[1]['state'], 'Response state mismatch')
+        self.assertEqual({}, response_data[2], 'Response for unknown key is not empty')
+
+    def test_negative_cache(self):
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        negative_cache = ctx.negative_cache
+        try:
+            ctx.negative_cache = NegativeCache()
+            ctx.negative_cache.listener = negative_cache.listener
+            response = self.app.get('/resolvepermalink?key=unknown')
+            self.assertEqual({}, json.loads(response.data), 'Response for unknown key is not empty')
+            self.assertTrue(ctx.negative_cache.known_missing('permalinks', 'unknown'))
+
+            response = self.app.get('/resolvepermalink?key=unknown')
+            self.assertEqual({}, json.loads(response.data), 'Response for unknown key is not empty')
+            self.assertEqual(2, ctx.negative_cache.stats()["short_circuited"])
+            self.assertIn(
+                'qwc_permalink_negative_cache_hits_total{table="permalinks",tenant="default"}',
+                self.app.get('/metrics').data.decode(), 'Metrics have no negative cache hits'
+            )
+        finally:
+            ctx.negative_cache = negative_cache
+
+    def test_metrics(self):
+        self.app.get('/resolvepermalink?key=unknown')
+        response = self.app.get('/metrics')
+        self.assertEqual(200, response.status_code, "Status code is not OK")
+        self.assertIn(
+            'qwc_permalink_requests_total{method="GET",route="resolvepermalink"',
+            response.data.decode(), 'Metrics have no request count'
+        )
+        for name, labels, value in server.db_pool_stats():
+            self.assertEqual({"tenant", "role"}, set(labels), 'Pool metrics have other labels')
+        self.assertNotIn('engine=', response.data.decode(), 'Metrics have DB connection details')
+        self.assertIn(
+            'qwc_permalink_resolve_cache_misses{tenant="default",', response.data.decode(),
+            'Metrics have no resolve cache stats'
+        )
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        if ctx.db is not None:
+            self.assertIn(
+                'qwc_permalink_db_reads_total{role="primary",tenant="default"}',
+                response.data.decode(), 'Metrics have no DB reads'
+            )
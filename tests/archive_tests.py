@@ -0,0 +1,122 @@
+import datetime
+import logging
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy.sql import text as sql_text
+
+import server
+from key_allocator import KeyAllocator
+from storage import PostgresStorage
+from storage_codec import ZLIB_MARKER, StorageCodec
+
+
+class ArchiveTestCase(unittest.TestCase):
+    """Test case for the archive of stale permalinks"""
+
+    SCHEMA = 'permalink_archive_tests'
+
+    def setUp(self):
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        if type(ctx.storage) is not PostgresStorage:
+            self.skipTest("Archive requires the PostgreSQL storage")
+        self.db = ctx.db
+        with self.db.begin() as connection:
+            connection.execute(sql_text("""
+                DROP SCHEMA IF EXISTS {schema} CASCADE;
+                CREATE SCHEMA {schema};
+                CREATE TABLE {schema}.permalinks (
+                    key character(10) PRIMARY KEY, data text, date date, expires date,
+                    permitted_group character varying, data_hash character varying, last_access date
+                );
+                CREATE TABLE {schema}.permalinks_archive (LIKE {schema}.permalinks INCLUDING ALL);
+            """.format(schema=self.SCHEMA)))
+        self.addCleanup(self.drop_schema)
+        self.storage = self.create_storage()
+        self.today = datetime.date.today()
+
+    def drop_schema(self):
+        with self.db.begin() as connection:
+            connection.execute(sql_text("DROP SCHEMA {schema} CASCADE".format(schema=self.SCHEMA)))
+
+    def create_storage(self, config=None):
+        return PostgresStorage(self.db, {
+            'permalinks_table': self.SCHEMA + '.permalinks',
+            'permalinks_archive_table': self.SCHEMA + '.permalinks_archive',
+            'archive_after_days': 30
+        } | (config or {}), KeyAllocator(), logging.getLogger())
+
+    def store(self, data, days=0, expires=None):
+        date = (self.today - datetime.timedelta(days=days)).isoformat()
+        return self.storage.store_permalinks([data], None, date, expires, None)[0][0]
+
+    def count(self, table):
+        with self.db.connect() as connection:
+            return connection.execute(sql_text(
+                "SELECT count(*) FROM {schema}.{table}".format(schema=self.SCHEMA, table=table)
+            )).scalar()
+
+    def test_archive(self):
+        data = '{"a":"%s"}' % ("x" * 2000)
+        stale = self.store(data, 60)
+        self.store('{"a":1}')
+        accessed = self.store('{"a":2}', 60)
+        self.storage.flush_access([accessed])
+
+        self.assertEqual(1, self.storage.archive_permalinks(100))
+        self.assertEqual(2, self.count('permalinks'))
+        with self.db.connect() as connection:
+            archived = connection.execute(sql_text(
+                "SELECT data FROM {schema}.permalinks_archive".format(schema=self.SCHEMA)
+            )).scalar()
+        self.assertTrue(archived.startswith(ZLIB_MARKER), 'Archived payload was not compressed')
+        self.assertIn(stale, set(key.rstrip(' ') for key in self.storage.keys('permalinks')))
+
+        # resolved from the archive and moved back
+        entry = self.storage.get_permalinks([stale])[stale]
+        self.assertEqual(StorageCodec.decode(data), StorageCodec.decode(entry["data"]))
+        self.assertEqual(3, self.count('permalinks'))
+        self.assertEqual(0, self.count('permalinks_archive'))
+        stats = self.storage.stats()["archive"]
+        self.assertEqual((1, 1), (stats["reads"], stats["promoted"]))
+
+    def test_already_archived(self):
+        stale = self.store('{"a":1}', 60)
+        other = self.store('{"a":2}', 60)
+        with self.db.begin() as connection:
+            connection.execute(sql_text("""
+                INSERT INTO {schema}.permalinks_archive (key, data, date)
+                VALUES (:key, :data, CURRENT_DATE)
+            """.format(schema=self.SCHEMA)), {"key": stale, "data": '{"a":0}'})
+
+        # not deleted without archived copy
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(1, self.storage.archive_permalinks(100))
+        self.assertEqual(1, self.count('permalinks'))
+        self.assertEqual('{"a":1}', self.storage.get_permalinks([stale])[stale]["data"])
+        self.assertIn(other, self.storage.get_permalinks([other]))
+
+    def test_no_promote(self):
+        self.storage = self.create_storage({'archive_promote': False})
+        stale = self.store('{"a":1}', 60)
+        self.storage.archive_permalinks(100)
+        self.assertIn(stale, self.storage.get_permalinks([stale]))
+        self.assertEqual(1, self.count('permalinks_archive'))
+
+    def test_archived_key_not_reused(self):
+        stale = self.store('{"a":1}', 60)
+        self.storage.archive_permalinks(100)
+        with patch.object(self.storage.key_allocator, 'generate', side_effect=[stale, 'free1']):
+            self.assertEqual('free1', self.store('{"a":2}'))
+
+    def test_purge(self):
+        stale = self.store('{"a":1}', 60, (self.today + datetime.timedelta(days=1)).isoformat())
+        self.storage.archive_permalinks(100)
+        with self.db.begin() as connection:
+            connection.execute(sql_text(
+                "UPDATE {schema}.permalinks_archive SET expires = :expires".format(schema=self.SCHEMA)
+            ), {"expires": self.today - datetime.timedelta(days=1)})
+        self.assertEqual({}, self.storage.get_permalinks([stale]))
+        self.assertEqual(1, self.storage.purge_expired_permalinks(100))
+        self.assertEqual(0, self.count('permalinks_archive'))
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from flask import Response, json
+from flask.testing import FlaskClient
+from flask_jwt_extended import create_access_token
+
+import asgi
+import server
+from async_storage import AsyncStorage
+
+
+class AsgiTestCase(unittest.TestCase):
+    """Test case for the async handlers of the ASGI app"""
+
+    def setUp(self):
+        server.app.testing = True
+        self.app = FlaskClient(server.app, Response)
+        with server.app.test_request_context():
+            self.ctx = server.tenant_context()
+            self.token = create_access_token('demo')
+        # storage methods in worker threads, for any storage backend
+        asgi.async_storages[self.ctx] = AsyncStorage(self.ctx.storage)
+
+    def tearDown(self):
+        asgi.async_storages.pop(self.ctx, None)
+
+    def request(self, method, path, query=None):
+        """ Return status, headers and body messages of an ASGI request """
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': urlencode(query or {}).encode(), 'root_path': '',
+            'headers': [(b'authorization', ('Bearer %s' % self.token).encode())]
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(asgi.app(scope, receive, send))
+        return messages[0]['status'], dict(messages[0]['headers']), messages[1:]
+
+    def post_bookmark(self, description):
+        query = urlencode({'url': 'http://www.example.com/?arg=value', 'description': description})
+        response = self.app.post(
+            '/bookmarks/?' + query, data=json.dumps({"description": description}),
+            content_type='application/json', headers={'Authorization': 'Bearer %s' % self.token}
+        )
+        return json.loads(response.data)['key']
+
+    def test_bookmark(self):
+        key = self.post_bookmark('asgi')
+        try:
+            status, headers, messages = self.request('GET', '/bookmarks/%s' % key)
+            self.assertEqual(200, status, "Status code is not OK")
+            self.assertEqual(
+                {"description": "asgi"}, json.loads(messages[0]['body'])['state'],
+                'Response state mismatch'
+            )
+        finally:
+            self.app.delete('/bookmarks/%s' % key, headers={'Authorization': 'Bearer %s' % self.token})
+
+    def test_stream_bookmarks(self):
+        keys = [self.post_bookmark('asgi %d' % i) for i in range(3)]
+        try:
+            with patch.object(asgi, 'STREAM_CHUNK_SIZE', 1):
+                status, headers, messages = self.request('GET', '/bookmarks/', {'stream': 'true'})
+            self.assertEqual(200, status, "Status code is not OK")
+            self.assertNotIn(b'content-length', headers, 'Streamed response has Content-Length')
+            self.assertGreater(len(messages), 3, 'Response was not sent in chunks')
+            self.assertTrue(all(message.get('more_body') for message in messages[:-1]))
+            self.assertFalse(messages[-1].get('more_body'), 'Last chunk has more_body')
+
+            items = json.loads(b''.join(message['body'] for message in messages))
+            self.assertLessEqual(set(keys), set(item['key'] for item in items), 'Bookmarks missing')
+        finally:
+            for key in keys:
+                self.app.delete('/bookmarks/%s' % key, headers={'Authorization': 'Bearer %s' % self.token})
+
+    def test_resolve_unknown(self):
+        status, headers, messages = self.request('GET', '/resolvepermalink', {'key': 'unknown'})
+        self.assertEqual(200, status, "Status code is not OK")
+        self.assertEqual({}, json.loads(messages[0]['body']), 'Response for unknown key is not empty')
+
+    def test_metrics_sync(self):
+        threads = []
+        with patch.object(server.metrics, 'sync', lambda: threads.append(threading.current_thread())):
+            status, headers, messages = self.request('GET', '/resolvepermalink', {'key': 'unknown'})
+        self.assertEqual(200, status, "Status code is not OK")
+        self.assertEqual(1, len(threads), 'Metrics were not synced once')
+        self.assertIsNot(threading.main_thread(), threads[0], 'Metrics were synced in the event loop')
@@ -0,0 +1,131 @@
+import asyncio
+import datetime
+import logging
+import unittest
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+import server
+from async_storage import AsyncPostgresStorage, AsyncStorage
+from key_allocator import KeyAllocator
+from storage import MemoryStorage, PostgresStorage
+
+
+class AsyncStorageTests:
+    """Tests of the async reads, comparing them with the storage"""
+
+    def setUp(self):
+        self.today = datetime.date.today().isoformat()
+
+    def run_async(self, read):
+        """ Return result of read(<AsyncStorage>) in an event loop """
+        raise NotImplementedError
+
+    def insert_bookmarks(self, count):
+        keys = [
+            self.storage.insert_bookmark(
+                'bookmarks', 'demo', '{"a":%d}' % i, self.today, 'async %d' % i, None, False
+            )
+            for i in range(count)
+        ]
+        self.addCleanup(lambda: [
+            self.storage.delete_bookmark('bookmarks', 'demo', key, False) for key in keys
+        ])
+        return keys
+
+    def test_permalinks(self):
+        (key, expires), = self.storage.store_permalinks(['{"a":1}'], None, self.today, None, None)
+        self.assertEqual(
+            self.storage.get_permalinks([key, 'unknown']),
+            self.run_async(lambda storage: storage.get_permalinks([key, 'unknown']))
+        )
+
+    def test_bookmarks(self):
+        keys = self.insert_bookmarks(3)
+        self.assertEqual(
+            [dict(row) for row in self.storage.list_bookmarks('bookmarks', 'demo')],
+            [dict(row) for row in self.run_async(
+                lambda storage: storage.list_bookmarks('bookmarks', 'demo')
+            )]
+        )
+        self.assertEqual(
+            self.storage.get_bookmark('bookmarks', 'demo', keys[1])["data"],
+            self.run_async(lambda storage: storage.get_bookmark('bookmarks', 'demo', keys[1]))["data"]
+        )
+
+    def test_stream_bookmarks(self):
+        self.insert_bookmarks(3)
+
+        async def stream(storage):
+            return [row["key"] async for row in storage.stream_bookmarks('bookmarks', 'demo')]
+
+        self.assertEqual(
+            [row["key"] for row in self.storage.list_bookmarks('bookmarks', 'demo')],
+            self.run_async(stream)
+        )
+
+        async def first(storage):
+            rows = storage.stream_bookmarks('bookmarks', 'demo')
+            try:
+                return (await anext(rows))["key"]
+            finally:
+                await rows.aclose()
+
+        self.assertEqual(
+            self.storage.list_bookmarks('bookmarks', 'demo')[0]["key"], self.run_async(first)
+        )
+
+
+class AsyncStorageTestCase(AsyncStorageTests, unittest.TestCase):
+    """Test case for async reads in worker threads"""
+
+    def setUp(self):
+        super().setUp()
+        self.storage = MemoryStorage({}, KeyAllocator(), logging.getLogger())
+
+    def run_async(self, read):
+        return asyncio.run(read(AsyncStorage(self.storage)))
+
+    def test_stream_closed(self):
+        closed = []
+
+        def list_bookmarks(*args):
+            try:
+                yield from self.storage.list_bookmarks('bookmarks', 'demo')
+            finally:
+                closed.append(True)
+
+        self.insert_bookmarks(2)
+        storage = AsyncStorage(self.storage)
+        storage.storage = type('Storage', (), {'list_bookmarks': staticmethod(list_bookmarks)})
+
+        async def first():
+            rows = storage.stream_bookmarks('bookmarks', 'demo')
+            await anext(rows)
+            await rows.aclose()
+
+        asyncio.run(first())
+        self.assertEqual([True], closed, 'Storage generator was not closed')
+
+
+class AsyncPostgresStorageTestCase(AsyncStorageTests, unittest.TestCase):
+    """Test case for async reads with the async PostgreSQL driver"""
+
+    def setUp(self):
+        super().setUp()
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        if type(ctx.storage) is not PostgresStorage:
+            self.skipTest("Async driver requires the PostgreSQL storage")
+        self.storage = ctx.storage
+        self.url = ctx.db.url.set(drivername="postgresql+psycopg")
+
+    def run_async(self, read):
+        async def run():
+            engine = create_async_engine(self.url, poolclass=NullPool)
+            try:
+                return await read(AsyncPostgresStorage(self.storage, engine))
+            finally:
+                await engine.dispose()
+        return asyncio.run(run())
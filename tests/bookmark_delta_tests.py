@@ -0,0 +1,94 @@
+import copy
+import logging
+import unittest
+
+import json_codec
+from bookmark_delta import BookmarkDeltas, apply, diff
+from key_allocator import KeyAllocator
+from storage import MemoryStorage
+from storage_codec import StorageCodec
+
+
+class BookmarkDeltaTestCase(unittest.TestCase):
+    """Test case for the delta encoding of bookmark payloads"""
+
+    STATE = {
+        "url": "http://www.example.com/?t=theme",
+        "layers": [{"name": "layer %d" % i, "visible": True} for i in range(10)],
+        "extent": [2600000.5, 1200000.25, 2700000, 1300000],
+        "a/b~c": None
+    }
+
+    def setUp(self):
+        self.storage = MemoryStorage({}, KeyAllocator(), logging.getLogger())
+        self.deltas = self.create_deltas()
+
+    def create_deltas(self, **kwargs):
+        return BookmarkDeltas(
+            self.storage, StorageCodec(), logging.getLogger(), **({"enabled": True} | kwargs)
+        )
+
+    def changed(self, visible=False, **values):
+        state = copy.deepcopy(self.STATE | values)
+        state["layers"][3]["visible"] = visible
+        return state
+
+    def encode(self, data, deltas=None):
+        return (deltas or self.deltas).encode('bookmarks', 'demo', None, data, '2024-01-01')
+
+    def test_diff(self):
+        targets = [
+            self.changed(),
+            self.changed(layers=self.STATE["layers"][2:]),
+            self.changed(layers=self.STATE["layers"] + [{"name": "new"}]),
+            self.changed(extent={"xmin": 0}, new="value", **{"a/b~c": [1]}),
+            [1, 2], "text"
+        ]
+        for target in targets:
+            patch = diff(self.STATE, target)
+            self.assertEqual(target, apply(copy.deepcopy(self.STATE), patch))
+        self.assertEqual(
+            [{"op": "replace", "path": "/layers/3/visible", "value": False}],
+            diff(self.STATE, self.changed())
+        )
+        self.assertEqual([], diff(self.STATE, copy.deepcopy(self.STATE)))
+
+    def test_encode(self):
+        text = self.encode(self.STATE)
+        self.assertEqual('d1:1:[]', text, 'First payload did not become the base')
+        delta = self.encode(self.changed())
+        self.assertTrue(delta.startswith('d1:1:['))
+        self.assertLess(len(delta), len(json_codec.dumps(self.STATE)))
+
+        # decoded without cached bases
+        deltas = self.create_deltas()
+        for data, text in [(self.STATE, text), (self.changed(), delta)]:
+            self.assertEqual(data, json_codec.loads(deltas.decode_bytes(text)))
+        self.assertEqual({"deltas": 1, "rebases": 1}, {
+            key: self.deltas.stats()[key] for key in ("deltas", "rebases")
+        })
+
+    def test_rebase(self):
+        self.encode(self.STATE)
+        texts = [self.encode({"other": i, "layers": ["layer %d" % j for j in range(40)]}) for i in range(2)]
+        self.assertEqual(['d1:2:[]', 'd1:2:[{"op":"replace","path":"/other","value":1}]'], texts)
+        self.assertEqual(2, self.deltas.stats()["rebases"])
+
+    def test_missing_base(self):
+        text = self.encode(self.STATE)
+        delta = self.encode(self.changed())
+        self.storage.bookmark_bases.clear()
+
+        deltas = self.create_deltas()
+        self.assertIsNone(deltas.decode_bytes(text))
+        self.assertIsNone(deltas.decode_bytes(delta))
+        # cached bases and payloads are still decoded
+        self.assertEqual(self.changed(), json_codec.loads(self.deltas.decode_bytes(delta)))
+
+    def test_plain(self):
+        # disabled or small payloads are stored as is
+        plain = {"url": "http://www.example.com/ü"}
+        self.assertEqual('{"url":"http://www.example.com/\\u00fc"}', self.encode(plain))
+        text = self.encode(self.STATE, self.create_deltas(enabled=False))
+        self.assertEqual(self.STATE, json_codec.loads(self.deltas.decode_bytes(text)))
+        self.assertEqual(0, self.deltas.stats()["rebases"])
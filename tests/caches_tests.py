@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import patch
+
+from caches import NegativeCache, TTLCache
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    """Test case for the TTL/LRU cache"""
+
+    def test_lru(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        # evicts least recently used 'b'
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual('default', cache.get('b', 'default'))
+        self.assertEqual({"size": 2, "maxsize": 2, "hits": 3, "misses": 2}, cache.stats())
+
+    def test_ttl(self):
+        cache = TTLCache(10, 60)
+        with patch('caches.time.monotonic', return_value=1000):
+            cache.set('a', 1)
+            cache.set('b', 2, ttl=120)
+        with patch('caches.time.monotonic', return_value=1059):
+            self.assertEqual(1, cache.get('a'))
+        with patch('caches.time.monotonic', return_value=1060):
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(2, cache.get('b'))
+        self.assertEqual(1, cache.stats()["size"])
+
+    def test_invalidate(self):
+        cache = TTLCache(10, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.invalidate('unknown')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+    def test_disabled(self):
+        cache = TTLCache(0, 60)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.stats()["size"])
+
+
+class NegativeCacheTestCase(unittest.TestCase):
+    """Test case for the cache of unknown keys"""
+
+    def setUp(self):
+        self.cache = NegativeCache(ttl=60)
+
+    def test_missing(self):
+        self.cache.add_missing('bookmarks', 'k1', 'demo')
+        self.assertTrue(self.cache.known_missing('bookmarks', 'k1', 'demo'))
+        self.assertFalse(self.cache.known_missing('bookmarks', 'k1', 'admin'))
+
+        self.cache.add_existing('bookmarks', 'k1', ('demo',))
+        self.assertFalse(self.cache.known_missing('bookmarks', 'k1', 'demo'))
+
+    def test_short_circuited(self):
+        tables = []
+        self.cache.listener = tables.append
+        self.cache.add_missing('permalinks', 'k1')
+        self.assertTrue(self.cache.known_missing('permalinks', 'k1'))
+        self.assertFalse(self.cache.known_missing('permalinks', 'k2'))
+        self.assertEqual(['permalinks'], tables)
+        self.assertEqual(1, self.cache.stats()["short_circuited"])
+
+    def test_expiry(self):
+        # key stored by another process is found once the miss has expired
+        with patch('caches.time.monotonic', return_value=1000):
+            self.cache.add_missing('permalinks', 'k1')
+        with patch('caches.time.monotonic', return_value=1061):
+            self.assertFalse(self.cache.known_missing('permalinks', 'k1'))
@@ -0,0 +1,117 @@
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from sqlalchemy import create_engine
+
+import json_codec
+import server
+from tenant_context import TenantContext
+
+
+class DedupTests:
+    """Tests of the deduplication of identical permalink payloads, run for
+    each backend
+    """
+
+    def create_context(self, config):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.ctx = self.create_context({'dedup_permalinks': True})
+        self.today = datetime.date.today()
+
+    def date(self, days=0):
+        return (self.today + datetime.timedelta(days=days)).isoformat()
+
+    def store(self, data, permitted_group=None):
+        """ Store permalink with server.store_permalinks, return (key, expires) """
+        with server.app.app_context():
+            (key, expires), = server.store_permalinks(self.ctx, [data], permitted_group)
+        self.assertIsNotNone(key, 'No key allocated')
+        return key, expires
+
+    def test_identical(self):
+        key, expires = self.store({"query": {"a": "1", "b": "2"}, "state": None})
+        self.assertEqual(
+            key, self.store({"state": None, "query": {"b": "2", "a": "1"}})[0],
+            'Identical payload with other key order was not reused'
+        )
+        self.assertNotEqual(key, self.store({"query": {"a": "1"}, "state": None})[0])
+        self.assertEqual(1, len(self.ctx.storage.get_permalinks([key])))
+
+    def test_permitted_group(self):
+        key, expires = self.store({"query": {"a": "1"}}, 'admins')
+        self.assertEqual(key, self.store({"query": {"a": "1"}}, 'admins')[0])
+        self.assertNotEqual(key, self.store({"query": {"a": "1"}}, 'demo')[0])
+        self.assertNotEqual(key, self.store({"query": {"a": "1"}})[0])
+
+    def test_expiry_extended(self):
+        self.ctx.config['default_expiry_period'] = 1
+        key, expires = self.store({"query": {"a": "1"}})
+        self.assertEqual(self.date(1), str(expires))
+
+        self.ctx.config['default_expiry_period'] = 5
+        reused, expires = self.store({"query": {"a": "1"}})
+        self.assertEqual(key, reused)
+        self.assertEqual(self.date(5), str(expires), 'Expiry was not extended')
+        self.assertEqual(self.date(5), str(self.ctx.storage.get_permalinks([key])[key]["expires"]))
+
+        # expiry is never shortened
+        self.ctx.config['default_expiry_period'] = 2
+        reused, expires = self.store({"query": {"a": "1"}})
+        self.assertEqual(self.date(5), str(expires), 'Expiry was shortened')
+
+    def test_expired(self):
+        data = {"query": {"a": "1"}}
+        data_hash = hashlib.sha256(json_codec.dumps(data)).hexdigest()
+        (expired, expires), = self.ctx.storage.store_permalinks(
+            [json_codec.dumps(data).decode()], [data_hash], self.date(-2), self.date(-1), None
+        )
+        self.ctx.config['default_expiry_period'] = 1
+        self.assertNotEqual(expired, self.store(data)[0], 'Expired permalink was reused')
+
+    def test_expiry_policy(self):
+        key, expires = self.store({"query": {"a": "1"}})
+        self.assertIsNone(expires)
+        self.ctx.config['default_expiry_period'] = 1
+        self.assertNotEqual(
+            key, self.store({"query": {"a": "1"}})[0],
+            'Permalink without expiry was reused with an expiry policy'
+        )
+
+    def test_disabled(self):
+        self.ctx = self.create_context({})
+        key, expires = self.store({"query": {"a": "1"}})
+        self.assertNotEqual(key, self.store({"query": {"a": "1"}})[0])
+
+
+class MemoryDedupTestCase(DedupTests, unittest.TestCase):
+    """Test case for the deduplication with the in-memory storage"""
+
+    def create_context(self, config):
+        return TenantContext(
+            'default', config | {'storage_backend': 'memory'}, None, logging.getLogger()
+        )
+
+
+class SQLiteDedupTestCase(DedupTests, unittest.TestCase):
+    """Test case for the deduplication with the SQLite storage"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        super().setUp()
+
+    def create_context(self, config):
+        db = create_engine('sqlite:///%s' % os.path.join(self.tmpdir.name, 'permalinks.db'))
+        self.addCleanup(db.dispose)
+        db_engine = Mock(db_engine=Mock(return_value=db))
+        return TenantContext(
+            'default', config | {'storage_backend': 'sqlite', 'store_bookmarks_by_userid': False},
+            db_engine, logging.getLogger()
+        )
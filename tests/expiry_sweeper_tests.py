@@ -0,0 +1,83 @@
+import logging
+import threading
+import unittest
+from unittest.mock import patch
+
+from expiry_sweeper import ExpirySweeper
+
+
+class FakeStorage:
+    """Storage returning fixed purge and archive results"""
+
+    def __init__(self, purged=0, archived=0):
+        self.purged = purged
+        self.archived = archived
+        self.batch_sizes = []
+        self.done = threading.Event()
+
+    def purge_expired_permalinks(self, batch_size):
+        self.batch_sizes.append(batch_size)
+        if isinstance(self.purged, Exception):
+            raise self.purged
+        return self.purged
+
+    def archive_permalinks(self, batch_size):
+        self.done.set()
+        if isinstance(self.archived, Exception):
+            raise self.archived
+        return self.archived
+
+
+class ExpirySweeperTestCase(unittest.TestCase):
+    """Test case for the purge of expired permalinks"""
+
+    def setUp(self):
+        self.sweeper = ExpirySweeper(logging.getLogger(), interval=60, batch_size=0)
+
+    def test_purge(self):
+        storage = FakeStorage(purged=3, archived=2)
+        self.assertEqual(3, self.sweeper.purge(storage))
+        self.assertEqual(3, self.sweeper.purge(storage))
+        self.assertEqual([1, 1], storage.batch_sizes)
+        stats = self.sweeper.stats()
+        self.assertEqual((2, 6, 4), (stats["runs"], stats["rows_purged"], stats["rows_archived"]))
+        self.assertIsNotNone(stats["last_duration"])
+
+    def test_listener(self):
+        sweeps = []
+        self.sweeper.listener = lambda *args: sweeps.append(args)
+        self.sweeper.purge(FakeStorage(purged=3, archived=2))
+        self.sweeper.purge(FakeStorage(purged=None))
+        self.assertEqual([(3, 2)], [sweep[0:2] for sweep in sweeps])
+        self.assertGreaterEqual(sweeps[0][2], 0)
+
+    def test_locked(self):
+        # purged by another process
+        self.assertIsNone(self.sweeper.purge(FakeStorage(purged=None)))
+        self.assertIsNone(self.sweeper.purge(FakeStorage(purged=RuntimeError("failed"))))
+        self.assertEqual(0, self.sweeper.stats()["runs"])
+
+    def test_archive_failure(self):
+        self.assertEqual(1, self.sweeper.purge(FakeStorage(purged=1, archived=RuntimeError("failed"))))
+        self.assertEqual(0, self.sweeper.stats()["rows_archived"])
+
+    def test_schedule(self):
+        storage = FakeStorage(purged=1)
+        with patch('expiry_sweeper.time.monotonic', return_value=1000):
+            self.sweeper.schedule(storage)
+            self.assertTrue(storage.done.wait(5), 'Purge was not run')
+            self.sweeper.schedule(storage)
+        with patch('expiry_sweeper.time.monotonic', return_value=1059):
+            self.sweeper.schedule(storage)
+        self.assertEqual(1, len(storage.batch_sizes), 'Purge was run before the interval elapsed')
+
+        storage.done.clear()
+        with patch('expiry_sweeper.time.monotonic', return_value=1060):
+            self.sweeper.schedule(storage)
+        self.assertTrue(storage.done.wait(5), 'Purge was not run after the interval')
+        self.assertEqual(2, len(storage.batch_sizes))
+
+    def test_disabled(self):
+        storage = FakeStorage()
+        ExpirySweeper(logging.getLogger(), interval=0).schedule(storage)
+        self.assertEqual([], storage.batch_sizes)
@@ -0,0 +1,168 @@
+import threading
+import time
+import unittest
+
+from group_commit import GroupCommit
+
+
+class FakeStorage:
+    """Storage recording calls of store_permalinks"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+        # optional Event blocking the first call until set
+        self.release = None
+
+    def store_permalinks(self, datas, hashes, date, expires, permitted_group):
+        self.calls.append((threading.current_thread().name, datas, hashes, permitted_group))
+        if self.release is not None and len(self.calls) == 1:
+            self.release.wait(5)
+        if self.error:
+            raise self.error
+        return [("key_%s" % data, expires) for data in datas]
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    """Test case for the group commit of created permalinks"""
+
+    def setUp(self):
+        self.results = {}
+
+    def store(self, group_commit, name, datas, permitted_group=None, hashes=None):
+        """ Store permalinks in a thread and return it """
+        def run():
+            try:
+                self.results[name] = group_commit.store_permalinks(
+                    datas, hashes, '2024-01-01', None, permitted_group
+                )
+            except Exception as e:
+                self.results[name] = e
+        thread = threading.Thread(target=run, name=name)
+        thread.start()
+        return thread
+
+    def wait_for_batch(self, group_commit, size=1):
+        """ Wait until the open batch has the given number of permalinks """
+        for i in range(500):
+            if group_commit.batch is not None and len(group_commit.batch.items) >= size:
+                return
+            time.sleep(0.01)
+        self.fail('No batch with %d permalinks was opened' % size)
+
+    def test_single(self):
+        storage = FakeStorage()
+        group_commit = GroupCommit(storage, 100, 0.01)
+        self.assertEqual(
+            [("key_a", None), ("key_b", None)],
+            group_commit.store_permalinks(['a', 'b'], ['ha', 'hb'], '2024-01-01', None, None)
+        )
+        self.assertEqual([('MainThread', ['a', 'b'], ['ha', 'hb'], None)], storage.calls)
+        self.assertIsNone(group_commit.batch)
+
+    def test_leader_follower(self):
+        storage = FakeStorage()
+        group_commit = GroupCommit(storage, 4, 10)
+        sizes = []
+        group_commit.listener = lambda size, wait: sizes.append(size)
+
+        threads = [self.store(group_commit, 'leader', ['a'])]
+        self.wait_for_batch(group_commit)
+        threads.append(self.store(group_commit, 'follower1', ['b', 'c']))
+        self.wait_for_batch(group_commit, 3)
+        threads.append(self.store(group_commit, 'follower2', ['d', 'e']))
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive(), 'Request of closed batch is still waiting')
+
+        # full batch is flushed by its leader before max_wait
+        self.assertEqual(('leader', ['a', 'b', 'c', 'd', 'e'], None, None), storage.calls[0])
+        self.assertEqual(1, len(storage.calls))
+        self.assertEqual([("key_a", None)], self.results['leader'])
+        self.assertEqual([("key_b", None), ("key_c", None)], self.results['follower1'])
+        self.assertEqual([("key_d", None), ("key_e", None)], self.results['follower2'])
+        self.assertEqual([5], sizes)
+        self.assertEqual({"batches": 1, "permalinks": 5, "timeouts": 0, "avg_batch_size": 5.0}, group_commit.stats())
+
+    def test_next_batch(self):
+        storage = FakeStorage()
+        storage.release = threading.Event()
+        group_commit = GroupCommit(storage, 2, 0.01)
+        threads = [self.store(group_commit, 'leader1', ['a', 'b'])]
+        for i in range(500):
+            if storage.calls:
+                break
+            time.sleep(0.01)
+
+        # next batch is opened while the full batch is being stored
+        threads.append(self.store(group_commit, 'leader2', ['c']))
+        self.wait_for_batch(group_commit)
+        storage.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(
+            [('leader1', ['a', 'b'], None, None), ('leader2', ['c'], None, None)], storage.calls
+        )
+        self.assertEqual([("key_c", None)], self.results['leader2'])
+
+    def test_permitted_groups(self):
+        storage = FakeStorage()
+        group_commit = GroupCommit(storage, 3, 10)
+        threads = [self.store(group_commit, 'leader', ['a'], 'admins')]
+        self.wait_for_batch(group_commit)
+        threads.append(self.store(group_commit, 'follower', ['b', 'c'], None))
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(
+            [('leader', ['a'], None, 'admins'), ('leader', ['b', 'c'], None, None)], storage.calls
+        )
+        self.assertEqual([("key_b", None), ("key_c", None)], self.results['follower'])
+
+    def test_error(self):
+        group_commit = GroupCommit(FakeStorage(RuntimeError("failed")), 2, 10)
+        threads = [self.store(group_commit, 'leader', ['a'])]
+        self.wait_for_batch(group_commit)
+        threads.append(self.store(group_commit, 'follower', ['b']))
+        for thread in threads:
+            thread.join(5)
+        self.assertIsInstance(self.results['leader'], RuntimeError)
+        self.assertIsInstance(self.results['follower'], RuntimeError)
+
+    def test_timeout(self):
+        storage = FakeStorage()
+        group_commit = GroupCommit(storage, 100, 0.5, 0.05)
+        threads = [self.store(group_commit, 'leader', ['a'])]
+        self.wait_for_batch(group_commit)
+        threads.append(self.store(group_commit, 'follower', ['b', 'c']))
+        threads[1].join(5)
+
+        # stored by the follower and withdrawn from the open batch
+        self.assertEqual([('follower', ['b', 'c'], None, None)], storage.calls)
+        self.assertEqual([("key_b", None), ("key_c", None)], self.results['follower'])
+        threads[0].join(5)
+        self.assertEqual(('leader', ['a'], None, None), storage.calls[1])
+        self.assertEqual([("key_a", None)], self.results['leader'])
+        self.assertEqual(
+            {"batches": 1, "permalinks": 1, "timeouts": 1, "avg_batch_size": 1.0},
+            group_commit.stats()
+        )
+
+    def test_flush_timeout(self):
+        storage = FakeStorage()
+        storage.release = threading.Event()
+        group_commit = GroupCommit(storage, 2, 10, 0.05)
+        threads = [self.store(group_commit, 'leader', ['a'])]
+        self.wait_for_batch(group_commit)
+        threads.append(self.store(group_commit, 'follower', ['b']))
+
+        # batch is being stored by the blocked leader
+        threads[1].join(5)
+        self.assertFalse(threads[1].is_alive(), 'Follower did not time out')
+        self.assertEqual([("key_b", None)], self.results['follower'])
+        self.assertEqual(
+            [('leader', ['a', 'b'], None, None), ('follower', ['b'], None, None)], storage.calls
+        )
+        storage.release.set()
+        threads[0].join(5)
+        self.assertEqual([("key_a", None)], self.results['leader'])
+        self.assertEqual(1, group_commit.stats()["timeouts"])
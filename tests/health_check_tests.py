@@ -0,0 +1,87 @@
+import logging
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+from health_check import HealthCheck, pool_status
+
+
+class HealthCheckTestCase(unittest.TestCase):
+    """Test case for the cached health check"""
+
+    def setUp(self):
+        self.calls = 0
+        self.error = None
+        self.release = None
+
+    def check(self):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+
+    def test_status(self):
+        health_check = HealthCheck(self.check, logging.getLogger(), 60, 2)
+        status = health_check.status()
+        self.assertEqual("OK", status["status"])
+        self.assertNotIn("cause", status)
+        health_check.status()
+        self.assertEqual(1, self.calls, 'Cached result was not used')
+        self.assertEqual({"checks": 1, "failures": 0, "timeouts": 0}, health_check.stats())
+
+    def test_refresh(self):
+        health_check = HealthCheck(self.check, logging.getLogger(), 60, 2)
+        health_check.status()
+        self.error = Exception("DB unavailable")
+        health_check.result = (health_check.result[0] - 60,) + health_check.result[1:]
+
+        # previous result while refreshing
+        self.assertEqual("OK", health_check.status()["status"])
+        health_check.done.wait(5)
+        self.assertEqual(
+            {"status": "FAIL", "cause": "DB unavailable"},
+            {key: value for key, value in health_check.status().items() if key != "age"}
+        )
+        self.assertEqual(2, self.calls)
+        self.assertEqual(1, health_check.stats()["failures"])
+
+    def test_uncached(self):
+        health_check = HealthCheck(self.check, logging.getLogger(), 0, 2)
+        for i in range(3):
+            self.assertEqual("OK", health_check.status()["status"])
+        self.assertEqual(3, self.calls)
+
+    def test_timeout(self):
+        self.release = threading.Event()
+        health_check = HealthCheck(self.check, logging.getLogger(), 60, 0.1)
+        status = health_check.status()
+        self.assertEqual("FAIL", status["status"])
+        self.assertIn("timed out", status["cause"])
+        self.assertEqual(1, health_check.stats()["timeouts"])
+
+        # only one refresh runs at a time
+        health_check.status()
+        self.assertEqual(1, self.calls)
+
+        self.release.set()
+        health_check.done.wait(5)
+        self.assertEqual("OK", health_check.status()["status"])
+
+    def test_pool_status(self):
+        engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=2)
+        self.addCleanup(engine.dispose)
+        with engine.connect():
+            status = pool_status(engine)
+        self.assertEqual(
+            {"size": 2, "checked_out": 1, "overflow": 0, "checked_in": 0, "waiting": 0}, status
+        )
+
+        engine = create_engine('sqlite://', poolclass=NullPool)
+        self.addCleanup(engine.dispose)
+        self.assertEqual(
+            {"size": None, "checked_out": None, "overflow": None, "checked_in": None, "waiting": None},
+            pool_status(engine)
+        )
@@ -0,0 +1,55 @@
+import random
+import struct
+import unittest
+from unittest.mock import patch
+
+import json_codec
+
+
+class JsonCodecTestCase(unittest.TestCase):
+    """Test case for canonical JSON documents"""
+
+    FLOATS = [
+        0.0, -0.0, 1.0, -1.5, 0.1, 1 / 3, 2.5e-5, 1e-5, 1e-7, 1.5e-7,
+        123456.789, 1e15, 1e16, 1e17, 1e20, 1.5e20, 9007199254740993.0,
+        1.7976931348623157e308, 5e-324, float('nan'), float('inf'),
+        float('-inf')
+    ]
+
+    def fallback_dumps(self, data):
+        with patch.object(json_codec, 'orjson', None):
+            return json_codec.dumps(data)
+
+    def test_canonical_float(self):
+        self.assertEqual('1e20', json_codec.canonical_float(1e20))
+        self.assertEqual('1.5e20', json_codec.canonical_float(1.5e20))
+        self.assertEqual('1000000000000000.0', json_codec.canonical_float(1e15))
+        self.assertEqual('1e16', json_codec.canonical_float(1e16))
+        self.assertEqual('0.000025', json_codec.canonical_float(2.5e-5))
+        self.assertEqual('1e-7', json_codec.canonical_float(1e-7))
+        self.assertEqual('-0.0', json_codec.canonical_float(-0.0))
+        self.assertEqual('null', json_codec.canonical_float(float('nan')))
+        self.assertEqual('null', json_codec.canonical_float(float('-inf')))
+
+    def test_fallback(self):
+        data = {"z": [1, 2.5, 1e20, None, True], "a": {"ü": "ö\n\"", "b": float('nan')}}
+        self.assertEqual(
+            '{"a":{"b":null,"ü":"ö\\n\\""},"z":[1,2.5,1e20,null,true]}'.encode('utf-8'),
+            self.fallback_dumps(data)
+        )
+
+    @unittest.skipIf(json_codec.orjson is None, "orjson is not installed")
+    def test_fallback_matches_orjson(self):
+        data = {
+            "floats": self.FLOATS,
+            "nested": {"ü": [{"b": 1, "a": -2.0}], "s": " \x00\t"},
+            "ints": [0, -1, 2 ** 53]
+        }
+        self.assertEqual(json_codec.dumps(data), self.fallback_dumps(data))
+
+        rand = random.Random(17)
+        floats = [
+            struct.unpack('<d', struct.pack('<Q', rand.getrandbits(64)))[0]
+            for i in range(2000)
+        ] + [rand.uniform(-1e6, 1e6) for i in range(2000)]
+        self.assertEqual(json_codec.dumps(floats), self.fallback_dumps(floats))
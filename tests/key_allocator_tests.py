@@ -0,0 +1,94 @@
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+from key_allocator import KeyAllocator
+
+
+class FakeConnection:
+    """Connection storing rows of multi-row inserts with unique keys"""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.statements = 0
+
+    def execute(self, sql, params):
+        self.statements += 1
+        stored = [key for key in params["keys"] if key not in self.keys]
+        self.keys.update(stored)
+        return [(key,) for key in stored]
+
+
+class KeyAllocatorTestCase(unittest.TestCase):
+    """Test case for key allocation with retries on collisions"""
+
+    INSERT_SQL = sql_text("""
+        INSERT INTO permalinks (key, data) VALUES (:key, :data)
+        ON CONFLICT DO NOTHING
+        RETURNING key
+    """)
+
+    def setUp(self):
+        self.db = create_engine('sqlite://')
+        with self.db.begin() as connection:
+            connection.execute(sql_text("CREATE TABLE permalinks (key varchar(10) PRIMARY KEY, data text)"))
+            connection.execute(sql_text("INSERT INTO permalinks VALUES ('taken1', ''), ('taken2', '')"))
+        self.calls = []
+
+    def tearDown(self):
+        self.db.dispose()
+
+    def allocator(self, keys, max_attempts=10):
+        allocator = KeyAllocator(max_attempts=max_attempts)
+        allocator.listener = lambda *args: self.calls.append(args)
+        return allocator, patch.object(allocator, 'generate', side_effect=keys)
+
+    def test_generate(self):
+        key = KeyAllocator(12, 'base62').generate()
+        self.assertEqual(12, len(key))
+        self.assertTrue(key.isalnum())
+        self.assertTrue(all(c in '0123456789abcdef' for c in KeyAllocator().generate()))
+
+    def test_collision_retry(self):
+        allocator, generate = self.allocator(['taken1', 'taken2', 'free1'])
+        with generate, self.db.begin() as connection:
+            key = allocator.insert(connection, self.INSERT_SQL, {"data": "new"})
+            self.assertEqual('free1', key)
+            self.assertEqual('new', connection.execute(
+                sql_text("SELECT data FROM permalinks WHERE key = 'free1'")
+            ).scalar())
+        self.assertEqual([(2, 0, [3])], self.calls)
+        stats = allocator.stats()
+        self.assertEqual((1, 0, 2), (stats["inserts"], stats["failures"], stats["collisions"]))
+        self.assertEqual({3: 1}, stats["attempts"])
+
+    def test_max_attempts(self):
+        allocator, generate = self.allocator(['taken1', 'taken2', 'free1'], max_attempts=2)
+        with generate, self.db.begin() as connection:
+            self.assertIsNone(allocator.insert(connection, self.INSERT_SQL, {"data": "new"}))
+        self.assertEqual([(2, 1, [2])], self.calls)
+        self.assertEqual(1, allocator.stats()["failures"])
+
+    def test_insert_many(self):
+        # rows 0 and 2 collide, the duplicate candidate of row 2 in the
+        # second statement is replaced, but collides again
+        allocator, generate = self.allocator(
+            ['taken1', 'free1', 'taken2', 'free2', 'free2', 'taken1', 'free3']
+        )
+        connection = FakeConnection(['taken1', 'taken2'])
+        with generate:
+            keys = allocator.insert_many(connection, None, {}, {"datas": ['a', 'b', 'c']})
+        self.assertEqual(['free2', 'free1', 'free3'], keys)
+        self.assertEqual(3, connection.statements)
+        self.assertEqual([(3, 0, [2, 1, 3])], self.calls)
+        self.assertEqual({1: 1, 2: 1, 3: 1}, allocator.stats()["attempts"])
+
+    def test_insert_many_max_attempts(self):
+        allocator, generate = self.allocator(['taken1', 'free1', 'taken2'], max_attempts=2)
+        connection = FakeConnection(['taken1', 'taken2'])
+        with generate:
+            keys = allocator.insert_many(connection, None, {}, {"datas": ['a', 'b']})
+        self.assertEqual([None, 'free1'], keys)
+        self.assertEqual([(2, 1, [2, 1])], self.calls)
@@ -0,0 +1,89 @@
+import datetime
+import functools
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+from keyset import KeysetPagination
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    """Test case for the cursor based pagination"""
+
+    ROWS = [
+        ('a', '2024-01-02', 'x'), ('b', '2024-01-02', None), ('c', '2024-01-01', 'x'),
+        ('d', '2024-01-03', 'y'), ('e', '2024-01-01', None), ('f', '2024-01-02', 'x')
+    ]
+
+    def setUp(self):
+        self.db = create_engine('sqlite://')
+        with self.db.begin() as connection:
+            connection.execute(sql_text("CREATE TABLE items (key text, date text, description text)"))
+            for key, date, description in self.ROWS:
+                connection.execute(
+                    sql_text("INSERT INTO items VALUES (:key, :date, :description)"),
+                    {"key": key, "date": date, "description": description}
+                )
+
+    def tearDown(self):
+        self.db.dispose()
+
+    def query(self, keyset, cursor=None):
+        where, params = keyset.where(cursor, "i") if cursor else ("TRUE", {})
+        sql = sql_text("SELECT i.key, %s FROM items i WHERE %s ORDER BY %s" % (
+            keyset.select_columns("i"), where, keyset.order_by("i")
+        ))
+        with self.db.connect() as connection:
+            return [row._mapping for row in connection.execute(sql, params)]
+
+    def test_terms(self):
+        keyset = KeysetPagination("date DESC, description NULLS FIRST")
+        self.assertEqual(
+            [("date", True, True), ("description", False, True), ("key", False, False)], keyset.terms
+        )
+        self.assertEqual(
+            "i.date DESC NULLS FIRST, i.description ASC NULLS FIRST, i.key ASC NULLS LAST",
+            keyset.order_by("i")
+        )
+        self.assertEqual([("key", True, True)], KeysetPagination("key desc").terms)
+        with self.assertRaises(ValueError):
+            KeysetPagination("date; DROP TABLE items")
+
+    def test_cursor(self):
+        keyset = KeysetPagination("date DESC, description")
+        row = {"_sort0": datetime.date(2024, 1, 2), "_sort1": None, "_sort2": "a"}
+        cursor = keyset.cursor(row)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(["2024-01-02", None, "a"], keyset.decode(cursor))
+
+        for cursor in ['invalid', '', keyset.cursor({"_sort0": 1, "_sort1": 2, "_sort2": 3})[:-2]]:
+            with self.assertRaises(ValueError):
+                keyset.decode(cursor)
+        with self.assertRaises(ValueError):
+            KeysetPagination("date").decode(keyset.cursor(row))
+
+    def test_compare(self):
+        keyset = KeysetPagination("date DESC, description")
+        self.assertEqual(0, keyset.compare(["2024-01-02", "x", "a"], [datetime.date(2024, 1, 2), "x", "a"]))
+        self.assertLess(keyset.compare(["2024-01-03", "x", "a"], ["2024-01-02", "x", "a"]), 0)
+        # NULLS LAST for ascending terms
+        self.assertLess(keyset.compare(["2024-01-02", "x", "b"], ["2024-01-02", None, "a"]), 0)
+        self.assertLess(keyset.compare(["2024-01-02", "x", "a"], ["2024-01-02", "x", "b"]), 0)
+
+    def test_pages(self):
+        for sort_order in ["date DESC, description", "description NULLS FIRST, date", "date"]:
+            keyset = KeysetPagination(sort_order)
+            rows = self.query(keyset)
+
+            # same order in memory as in the DB
+            values = [[row["_sort%d" % i] for i in range(len(keyset.terms))] for row in rows]
+            self.assertEqual(values, sorted(values, key=functools.cmp_to_key(keyset.compare)))
+
+            # rows after each cursor
+            for i, row in enumerate(rows):
+                self.assertEqual(
+                    [row["key"] for row in rows[i + 1:]],
+                    [row["key"] for row in self.query(keyset, keyset.cursor(row))],
+                    "Rows after %s mismatch for '%s'" % (row["key"], sort_order)
+                )
@@ -0,0 +1,121 @@
+import argparse
+import json
+import random
+import unittest
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks import load
+
+
+class StubSession:
+    """Session answering requests without the app"""
+
+    def __init__(self):
+        # requests[<(method, path)>] = <count>
+        self.requests = Counter()
+
+    def request(self, method, path, data=None):
+        self.requests[(method, urlparse(path).path)] += 1
+        if path.startswith('/createpermalink'):
+            return 200, {"permalink": "https://example.com/?k=key%d" % sum(self.requests.values())}
+        if path.startswith('/resolvepermalink'):
+            key = parse_qs(urlparse(path).query)['key'][0]
+            return (200, {"query": {}}) if key.startswith('key') else (404, None)
+        if method == 'POST' and path.startswith('/bookmarks/'):
+            return 200, {"success": True, "key": "bookmark"}
+        return 200, {}
+
+
+class LoadBenchmarkTestCase(unittest.TestCase):
+    """Test case for the load benchmark"""
+
+    def args(self, **kwargs):
+        return argparse.Namespace(**{
+            "requests": 50, "warmup": 5, "alloc_requests": 5, "keys": 10, "zipf_s": 1.1,
+            "resolve_ratio": 0.8, "public_bookmarks": 3, "own_bookmarks": 2,
+            "payload_layers": 5, "seed": 42
+        } | kwargs)
+
+    def test_percentiles(self):
+        result = load.percentiles([i / 1000 for i in range(1, 101)])
+        self.assertEqual({"p50": 50.5, "p95": 95.95, "p99": 99.99, "mean": 50.5}, result)
+
+    def test_zipf_sampler(self):
+        sample = load.zipf_sampler(random.Random(1), 10, 1.1)
+        counts = Counter(sample() for i in range(5000))
+        self.assertLessEqual(set(counts), set(range(10)))
+        self.assertGreater(counts[0], counts[1], 'First key is not the most popular')
+        self.assertGreater(counts[1], counts[9])
+
+        # reproducible with the same seed
+        samples = [load.zipf_sampler(random.Random(1), 10, 1.1) for i in range(2)]
+        self.assertEqual(
+            [samples[0]() for i in range(20)], [samples[1]() for i in range(20)]
+        )
+
+    def test_qwc2_state(self):
+        state = load.qwc2_state(random.Random(1), 30)
+        self.assertEqual(state, load.qwc2_state(random.Random(1), 30))
+        self.assertEqual(30, len(state["layers"][0]["sublayers"]))
+        self.assertGreater(len(json.dumps(state)), 3000, 'Payload is not QWC2 sized')
+
+    def test_run_scenario(self):
+        session = StubSession()
+        result = load.run_scenario(self.args(), session, 'create_resolve')
+        self.assertEqual(0, result["errors"])
+        self.assertEqual(50, result["requests"])
+        self.assertEqual(['create', 'resolve'], sorted(result["ops"]))
+        self.assertEqual(50, sum(op["count"] for op in result["ops"].values()))
+        self.assertGreater(result["ops"]["resolve"]["count"], result["ops"]["create"]["count"])
+        # setup, warm up, measured and traced steps
+        self.assertEqual(10 + 5 + 50 + 5, sum(session.requests.values()))
+        for op in result["ops"].values():
+            self.assertEqual(['mean', 'p50', 'p95', 'p99'], sorted(op["latency_ms"]))
+
+        result = load.run_scenario(self.args(), StubSession(), 'bookmark_crud')
+        self.assertEqual(['create', 'delete', 'get', 'update'], sorted(result["ops"]))
+        self.assertEqual(200, result["requests"])
+
+    def test_errors(self):
+        session = StubSession()
+        session.request = lambda method, path, data=None: (500, None)
+        result = load.run_scenario(self.args(), session, 'bookmark_crud')
+        self.assertEqual(50, result["errors"])
+        self.assertEqual(['create'], list(result["ops"]), 'Steps continued after a failed create')
+
+    def test_compare(self):
+        baseline = {"scenarios": {"crud": {
+            "throughput_rps": 100.0,
+            "ops": {"get": {"latency_ms": {"p50": 1.0, "p95": 2.0, "p99": 4.0}}}
+        }}}
+
+        def results(throughput, p99):
+            return {"scenarios": {
+                "crud": {
+                    "throughput_rps": throughput,
+                    "ops": {
+                        "get": {"latency_ms": {"p50": 1.0, "p95": 2.0, "p99": p99}},
+                        "new": {"latency_ms": {"p50": 9.0, "p95": 9.0, "p99": 9.0}}
+                    }
+                },
+                "new": {"throughput_rps": 1.0, "ops": {}}
+            }}
+
+        self.assertEqual([], load.compare(results(91.0, 4.3), baseline, 0.1))
+        self.assertEqual(
+            [
+                {"scenario": "crud", "metric": "throughput_rps", "baseline": 100.0, "value": 89.0},
+                {"scenario": "crud", "op": "get", "metric": "p99", "baseline": 4.0, "value": 4.5}
+            ],
+            load.compare(results(89.0, 4.5), baseline, 0.1)
+        )
+
+    def test_in_process(self):
+        session = load.FlaskClientSession('demo')
+        result = load.run_scenario(
+            self.args(requests=20, warmup=0, alloc_requests=2, keys=5), session, 'create_resolve'
+        )
+        self.assertEqual(0, result["errors"], 'Requests to the app failed')
+        self.assertEqual(20, result["requests"])
+        self.assertIsNotNone(result["ops"]["resolve"]["alloc_peak_kib"])
@@ -0,0 +1,78 @@
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from metrics import Metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test case for metrics of multiple processes"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def metrics(self, sync_interval=1.0):
+        metrics = Metrics(self.directory, sync_interval)
+        metrics.counter('requests_total', "Requests")
+        return metrics
+
+    def snapshot_files(self):
+        return sorted(os.path.basename(path) for path in glob.glob(
+            os.path.join(self.directory, "metrics_*.json")
+        ))
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.counter('requests_total', "Requests")
+        metrics.histogram('attempts', "Attempts", (1, 2))
+        metrics.inc('requests_total', {"route": "a"}, 2)
+        metrics.observe('attempts', {}, 1)
+        metrics.observe('attempts', {}, 3)
+        text = metrics.render()
+        self.assertIn('requests_total{route="a"} 2\n', text)
+        self.assertIn('attempts_bucket{le="1"} 1\n', text)
+        self.assertIn('attempts_bucket{le="2"} 1\n', text)
+        self.assertIn('attempts_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('attempts_sum 4\n', text)
+
+    def test_deferred_sync(self):
+        metrics = self.metrics(0.1)
+        metrics.inc('requests_total', {})
+        metrics.sync()
+        # not due, written by a timer
+        metrics.inc('requests_total', {})
+        metrics.sync()
+        time.sleep(0.3)
+
+        other = self.metrics()
+        self.assertIn('requests_total 2\n', other.render())
+
+    def test_exited_process(self):
+        script = "\n".join([
+            "from metrics import Metrics",
+            "metrics = Metrics(%r, 3600)" % self.directory,
+            "metrics.inc('requests_total', {}, 3)",
+            "metrics.sync()",
+            "metrics.inc('requests_total', {}, 2)"
+        ])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.run([sys.executable, "-c", script], env=env, check=True)
+        # written on exit
+        self.assertEqual(1, len(self.snapshot_files()))
+
+        metrics = self.metrics()
+        metrics.inc('requests_total', {})
+        self.assertIn('requests_total 6\n', metrics.render())
+        self.assertEqual(
+            ["metrics_%d_%d.json" % (metrics.pid, metrics.started), "metrics_exited.json"],
+            self.snapshot_files()
+        )
+        self.assertIn('requests_total 6\n', metrics.render())
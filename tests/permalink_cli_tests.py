@@ -0,0 +1,194 @@
+import argparse
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from sqlalchemy.sql import text as sql_text
+
+import json_codec
+import permalink_cli
+import server
+from bookmark_delta import BookmarkDeltas
+from key_allocator import KeyAllocator
+from storage import PostgresStorage
+from storage_codec import StorageCodec
+
+
+class PermalinkCliTestCase(unittest.TestCase):
+    """Test case for the NDJSON export and import"""
+
+    SCHEMA = 'permalink_cli_tests'
+
+    def setUp(self):
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        if type(ctx.storage) is not PostgresStorage:
+            self.skipTest("Export and import require the PostgreSQL storage")
+        if ctx.db.dialect.driver != 'psycopg2':
+            self.skipTest("Import requires the psycopg2 driver")
+        self.db = ctx.db
+        with self.db.begin() as connection:
+            connection.execute(sql_text("""
+                DROP SCHEMA IF EXISTS {schema} CASCADE;
+                CREATE SCHEMA {schema};
+                CREATE TABLE {schema}.users (id integer PRIMARY KEY, name character varying UNIQUE);
+                INSERT INTO {schema}.users (id, name) VALUES (1, 'admin'), (2, 'demo');
+                CREATE TABLE {schema}.permalinks (
+                    key character(10) PRIMARY KEY, data text, date date, expires date,
+                    permitted_group character varying, data_hash character varying(64)
+                );
+                CREATE TABLE {schema}.user_permalinks (
+                    username character varying PRIMARY KEY, data text, date date
+                );
+                CREATE TABLE {schema}.user_bookmarks (
+                    username character varying NOT NULL, user_id integer, data text,
+                    key character varying(10) NOT NULL, date date, description text,
+                    theme_id character varying, public boolean DEFAULT false, base_id integer,
+                    PRIMARY KEY (username, key)
+                );
+                CREATE TABLE {schema}.user_visibility_presets (LIKE {schema}.user_bookmarks INCLUDING ALL);
+                CREATE TABLE {schema}.user_bookmark_bases (
+                    id serial PRIMARY KEY, kind character varying NOT NULL,
+                    username character varying NOT NULL, theme_id character varying NOT NULL,
+                    data text, date date
+                );
+            """.format(schema=self.SCHEMA)))
+        self.addCleanup(self.drop_schema)
+        self.config = {
+            'db_url': ctx.config.get('db_url'),
+            'qwc_config_schema': self.SCHEMA,
+            'bookmark_delta_encoding': True
+        }
+        self.storage = PostgresStorage(self.db, self.config, KeyAllocator(), logging.getLogger())
+        self.logger = logging.getLogger('permalink_cli_tests')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'rows.ndjson')
+        self.today = datetime.date.today().isoformat()
+
+    def drop_schema(self):
+        with self.db.begin() as connection:
+            connection.execute(sql_text("DROP SCHEMA {schema} CASCADE".format(schema=self.SCHEMA)))
+
+    def execute(self, sql, params=None):
+        with self.db.begin() as connection:
+            return connection.execute(sql_text(sql.format(schema=self.SCHEMA)), params or {})
+
+    def export(self, **kwargs):
+        """ Export rows, return list of exported objects """
+        args = argparse.Namespace(**{
+            "output": self.path, "tables": None, "since": None, "until": None,
+            "expires_before": None, "exclude_expired": False, "batch_size": 2
+        } | kwargs)
+        self.assertEqual(0, permalink_cli.export_rows(args, self.config, self.logger))
+        with open(self.path, 'rb') as fh:
+            return [json_codec.loads(line) for line in fh]
+
+    def import_rows(self, key_map=None):
+        """ Import exported rows, return exit code and log """
+        args = argparse.Namespace(
+            input=self.path, tables=None, key_map=key_map, batch_size=2
+        )
+        with self.assertLogs(self.logger, 'INFO') as logs:
+            code = permalink_cli.import_rows(args, self.config, self.logger)
+        return code, "\n".join(logs.output)
+
+    def store_permalinks(self, count):
+        datas = ['{"query":{"a":"%d"}}' % i for i in range(count)]
+        return [key for key, expires in self.storage.store_permalinks(datas, None, self.today, None, None)]
+
+    def test_round_trip(self):
+        keys = self.store_permalinks(3)
+        self.storage.set_user_permalink('demo', '{"state":{"a":1}}', self.today)
+        bookmark = self.storage.insert_bookmark(
+            'bookmarks', 'demo', '{"query":{"b":"1"}}', self.today, 'bookmark', None, False
+        )
+        rows = self.export()
+        self.assertEqual(
+            ['permalinks'] * 3 + ['user_permalinks', 'user_bookmarks'], [row["table"] for row in rows]
+        )
+        self.assertEqual(set(keys), set(row["key"] for row in rows[:3]))
+        self.assertEqual({"query": {"b": "1"}}, rows[4]["data"])
+        self.assertEqual(bookmark, rows[4]["key"])
+        self.assertNotIn("user_id", rows[4])
+
+        # identical rows are skipped
+        code, log = self.import_rows()
+        self.assertEqual(0, code)
+        self.assertIn("permalinks: 0 inserted, 0 re-keyed, 3 skipped, 0 failed", log)
+        self.assertIn("user_bookmarks: 0 inserted, 0 re-keyed, 1 skipped, 0 failed", log)
+        self.assertIn("user_permalinks: 0 inserted, 0 re-keyed, 1 skipped, 0 failed", log)
+        self.assertEqual(3, self.execute("SELECT count(*) FROM {schema}.permalinks").scalar())
+
+    def test_rekey(self):
+        keys = self.store_permalinks(3)
+        self.export(tables=['permalinks'])
+        self.execute("DELETE FROM {schema}.permalinks WHERE key = :key", {"key": keys[0]})
+        self.execute("UPDATE {schema}.permalinks SET data = '{{}}' WHERE key = :key", {"key": keys[1]})
+
+        key_map = os.path.join(self.tmpdir.name, 'keys.ndjson')
+        code, log = self.import_rows(key_map)
+        self.assertEqual(0, code)
+        self.assertIn("permalinks: 2 inserted, 1 re-keyed, 1 skipped, 0 failed", log)
+
+        with open(key_map, 'rb') as fh:
+            mapped, = [json_codec.loads(line) for line in fh]
+        self.assertEqual("permalinks", mapped["table"])
+        self.assertEqual(keys[1], mapped["key"])
+        self.assertNotIn(mapped["new_key"], keys)
+
+        entries = self.storage.get_permalinks(keys + [mapped["new_key"]])
+        self.assertEqual('{"query":{"a":"0"}}', entries[keys[0]]["data"], 'Deleted row was not restored')
+        self.assertEqual('{}', entries[keys[1]]["data"], 'Colliding row was overwritten')
+        self.assertEqual('{"query":{"a":"1"}}', entries[mapped["new_key"]]["data"])
+
+    def test_user_id(self):
+        self.storage.insert_bookmark(
+            'bookmarks', 'demo', '{"query":{"b":"1"}}', self.today, 'bookmark', None, False
+        )
+        self.export(tables=['user_bookmarks'])
+        self.execute("DELETE FROM {schema}.user_bookmarks")
+        # other user ID of demo in the target
+        self.execute("UPDATE {schema}.users SET id = 7 WHERE name = 'demo'")
+
+        code, log = self.import_rows()
+        self.assertEqual(0, code)
+        self.assertEqual(
+            [(7, 'demo')],
+            self.execute("SELECT user_id, username FROM {schema}.user_bookmarks").all()
+        )
+
+    def test_delta_export(self):
+        deltas = BookmarkDeltas(self.storage, StorageCodec(), self.logger, enabled=True, min_size=0)
+        docs = [
+            {"state": {"layers": ["a", "b", "c", "d"], "view": {"scale": scale}}} for scale in [1000, 5000]
+        ]
+        for i, doc in enumerate(docs):
+            datastr = deltas.encode('bookmarks', 'demo', 'theme', doc, self.today)
+            self.assertTrue(StorageCodec.is_delta(datastr))
+            self.storage.insert_bookmark('bookmarks', 'demo', datastr, self.today, 'delta %d' % i, 'theme', False)
+
+        rows = self.export(tables=['user_bookmarks'])
+        self.assertEqual(docs, [row["data"] for row in sorted(rows, key=lambda row: row["description"])])
+
+        # imported as plain payloads
+        self.execute("DELETE FROM {schema}.user_bookmarks")
+        code, log = self.import_rows()
+        self.assertEqual(0, code)
+        stored = self.execute("SELECT data, base_id FROM {schema}.user_bookmarks").all()
+        self.assertFalse(any(StorageCodec.is_delta(data) for data, base_id in stored))
+        self.assertEqual([None, None], [base_id for data, base_id in stored], 'Base ID was imported')
+
+    def test_driver(self):
+        self.config['db_url'] = self.db.url.set(drivername='postgresql+psycopg').render_as_string(False)
+        with open(self.path, 'wb') as fh:
+            fh.write(b'{"table":"permalinks","key":"abc","data":{}}\n')
+        with self.assertLogs(self.logger, 'ERROR') as logs:
+            code = permalink_cli.import_rows(
+                argparse.Namespace(input=self.path, tables=None, key_map=None, batch_size=2),
+                self.config, self.logger
+            )
+        self.assertEqual(1, code)
+        self.assertIn("psycopg2", logs.output[0])
@@ -0,0 +1,71 @@
+import logging
+import unittest
+from unittest.mock import patch
+
+from permissions_cache import PermissionsCache
+
+
+class FakePermissionsReader:
+    """Permissions reader counting lookups"""
+
+    instances = []
+    fail = False
+
+    def __init__(self, tenant, logger):
+        if FakePermissionsReader.fail:
+            raise Exception("Invalid permissions")
+        self.permissions = {"user_groups": {"demo": ["editors"]}}
+        self.lookups = 0
+        FakePermissionsReader.instances.append(self)
+
+    def resource_permissions(self, resource_type, identity):
+        self.lookups += 1
+        return ["bookmarks", "bookmarks"] if identity == "demo" else []
+
+
+class PermissionsCacheTestCase(unittest.TestCase):
+    """Test case for the permissions cache of a tenant"""
+
+    def setUp(self):
+        FakePermissionsReader.instances = []
+        FakePermissionsReader.fail = False
+        patcher = patch('permissions_cache.PermissionsReader', FakePermissionsReader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_memoized(self):
+        cache = PermissionsCache('default', logging.getLogger())
+        self.assertEqual({"bookmarks"}, cache.capabilities("demo"))
+        self.assertEqual({"bookmarks"}, cache.capabilities("demo"))
+        self.assertEqual(frozenset(), cache.capabilities("admin"))
+        self.assertEqual(2, FakePermissionsReader.instances[0].lookups)
+
+        self.assertEqual({"editors"}, cache.user_groups("demo"))
+        self.assertEqual(frozenset(), cache.user_groups("unknown"))
+        stats = cache.stats()
+        self.assertEqual((0, 0, 1), (stats["generation"], stats["reloads"], stats["hits"]))
+
+    def test_reload(self):
+        with patch('permissions_cache.time.monotonic', return_value=1000):
+            cache = PermissionsCache('default', logging.getLogger(), ttl=60)
+            cache.capabilities("demo")
+        with patch('permissions_cache.time.monotonic', return_value=1060):
+            cache.capabilities("demo")
+        self.assertEqual(2, len(FakePermissionsReader.instances), 'Permissions were not reloaded')
+        self.assertEqual(1, FakePermissionsReader.instances[1].lookups, 'Lookup of previous permissions was reused')
+        self.assertEqual(1, cache.stats()["generation"])
+
+        # keep previous permissions if reload fails
+        FakePermissionsReader.fail = True
+        with patch('permissions_cache.time.monotonic', return_value=1120):
+            self.assertEqual({"bookmarks"}, cache.capabilities("demo"))
+        self.assertEqual(1, cache.stats()["reloads"])
+
+    def test_no_reload(self):
+        with patch('permissions_cache.time.monotonic', return_value=1000):
+            cache = PermissionsCache('default', logging.getLogger(), ttl=0)
+        with patch('permissions_cache.time.monotonic', return_value=100000):
+            cache.capabilities("demo")
+            cache.capabilities("demo")
+        self.assertEqual(1, len(FakePermissionsReader.instances))
+        self.assertEqual(1, FakePermissionsReader.instances[0].lookups)
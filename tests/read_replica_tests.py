@@ -0,0 +1,72 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from key_allocator import KeyAllocator
+from storage import SQLiteStorage
+
+
+class ReadReplicaTestCase(unittest.TestCase):
+    """Test case for reads from a read-only DB"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.today = datetime.date.today().isoformat()
+
+        self.storage = self.create_storage('primary.db')
+        # storage of another process, whose writes are not tracked
+        self.other = self.create_storage('primary.db')
+        self.replica = self.create_storage('replica.db')
+        self.storage.db_readonly = self.replica.db
+
+    def create_storage(self, filename):
+        db = create_engine('sqlite:///%s' % os.path.join(self.tmpdir.name, filename))
+        self.addCleanup(db.dispose)
+        return SQLiteStorage(db, {'read_your_writes_window': 60}, KeyAllocator(), logging.getLogger())
+
+    def store(self, storage):
+        return storage.store_permalinks(['{"a":1}'], None, self.today, None, None)[0][0]
+
+    def reads(self):
+        return self.storage.stats()["reads"]
+
+    def test_replica(self):
+        key = self.store(self.replica)
+        self.assertIn(key, self.storage.get_permalinks([key]))
+        self.assertEqual({"replica": 1, "primary": 0, "replica_failures": 0}, self.reads())
+
+    def test_read_your_writes(self):
+        key = self.store(self.storage)
+        self.assertIn(key, self.storage.get_permalinks([key]))
+        self.assertEqual({"replica": 0, "primary": 1, "replica_failures": 0}, self.reads())
+
+        self.storage.insert_bookmark('bookmarks', 'demo', '{}', self.today, 'demo', None, False)
+        self.assertEqual(1, len(self.storage.list_bookmarks('bookmarks', 'demo')))
+        self.assertEqual([], self.storage.list_bookmarks('bookmarks', 'admin'))
+        self.assertEqual({"replica": 1, "primary": 2, "replica_failures": 0}, self.reads())
+
+    def test_missing_on_replica(self):
+        # not yet replicated
+        key = self.store(self.other)
+        self.assertIn(key, self.storage.get_permalinks([key]))
+        self.assertEqual({"replica": 1, "primary": 1, "replica_failures": 0}, self.reads())
+
+        # not looked up on the primary for multiple keys
+        self.assertEqual({}, self.storage.get_permalinks([key, 'unknown']))
+        self.assertEqual({"replica": 2, "primary": 1, "replica_failures": 0}, self.reads())
+
+    def test_replica_failure(self):
+        db = create_engine('sqlite:///%s' % os.path.join(self.tmpdir.name, 'missing', 'replica.db'))
+        self.addCleanup(db.dispose)
+        self.storage.db_readonly = db
+        counters = []
+        self.storage.listener = counters.append
+        key = self.store(self.other)
+        self.assertIn(key, self.storage.get_permalinks([key, 'unknown']))
+        self.assertEqual({"replica": 0, "primary": 1, "replica_failures": 1}, self.reads())
+        self.assertEqual(['replica_failures', 'primary_reads'], counters)
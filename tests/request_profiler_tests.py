@@ -0,0 +1,89 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from flask import Response
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+import request_profiler
+from request_profiler import RequestProfiler, instrument_engine, phase
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+    """Test case for the timing of request phases"""
+
+    def setUp(self):
+        self.logger = logging.getLogger('request_profiler_tests')
+        self.addCleanup(request_profiler.current.set, None)
+
+    def test_disabled(self):
+        profiler = RequestProfiler(self.logger)
+        self.assertFalse(profiler.enabled)
+        profiler.start({RequestProfiler.PROFILE_HEADER: 'token'})
+        self.assertIs(request_profiler.NO_PHASE, phase('auth'))
+        response = profiler.finish(Response(), 'resolve', {})
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_server_timing(self):
+        profiler = RequestProfiler(self.logger, header_token='token')
+        profiler.start({})
+        self.assertIsNone(request_profiler.current.get(), 'Request without header was timed')
+
+        profiler.start({RequestProfiler.PROFILE_HEADER: 'token'})
+        with phase('auth'):
+            pass
+        with phase('json'):
+            pass
+        with phase('json'):
+            pass
+        response = profiler.finish(Response(), 'resolve', {})
+        names = [item.split(';')[0] for item in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(['auth', 'json', 'other', 'total'], names)
+        self.assertIsNone(request_profiler.current.get())
+
+    def test_slow_log(self):
+        profiler = RequestProfiler(self.logger, slow_threshold=0.000001)
+        profiler.start({})
+        with phase('json'):
+            pass
+        with self.assertLogs(self.logger, 'WARNING') as logs:
+            response = profiler.finish(Response(status=201), 'store', {"route": "store"})
+        self.assertNotIn('Server-Timing', response.headers, 'Unsampled request has Server-Timing')
+        entry = json.loads(logs.output[0].split('Slow request: ', 1)[1])
+        self.assertEqual(("store", 201), (entry["route"], entry["status"]))
+        self.assertEqual(["json", "other"], sorted(entry["phases_ms"]))
+        self.assertEqual({"json": 1}, entry["counts"])
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = RequestProfiler(self.logger, sample_rate=1, profile_dir=directory)
+            profiler.start({})
+            profiler.finish(Response(), 'resolve', {})
+            self.assertEqual(1, len(glob.glob(os.path.join(directory, 'resolve-*.prof'))))
+
+            # profiler is released on abort
+            profiler.start({})
+            profiler.abort()
+            self.assertIsNone(request_profiler.current.get())
+            self.assertFalse(profiler.profile_lock.locked())
+
+    def test_sql(self):
+        engine = create_engine('sqlite://')
+        self.addCleanup(engine.dispose)
+        instrument_engine(engine)
+        instrument_engine(engine)
+        profiler = RequestProfiler(self.logger, sample_rate=1)
+        profiler.start({})
+        with engine.connect() as connection:
+            connection.execute(sql_text("SELECT 1"))
+            connection.execute(sql_text("SELECT 2"))
+        self.assertEqual(2, request_profiler.current.get().phases['sql'][1])
+        profiler.abort()
+
+        # queries outside of timed requests
+        with engine.connect() as connection:
+            connection.execute(sql_text("SELECT 1"))
@@ -0,0 +1,189 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from caches import TTLCache
+from shared_cache import (
+    MmapTable, SharedCache, cache_factory, decode_value, encode_value, private_dir
+)
+
+
+class TornBuffer(bytearray):
+    """Table buffer which is written concurrently whenever a slot is read"""
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # bump seqlock counter of first slot
+            struct.pack_into('<I', self, 0, struct.unpack_from('<I', self, 0)[0] + 2)
+        return super().__getitem__(index)
+
+
+def write_values(path, values, count):
+    """ Repeatedly store values under the same key in another process """
+    table = MmapTable(path, slots=16, slot_size=1024, ways=8, stripes=4)
+    for i in range(count):
+        table.set(b'key', values[i % len(values)], 60)
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """Test case for the cache shared by the processes of a host"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.directory = private_dir(self.tmpdir.name)
+
+    def table(self, slots=16, slot_size=1024, ways=8):
+        return MmapTable(os.path.join(self.directory, 'cache'), slots, slot_size, ways, 4)
+
+    def test_encode_value(self):
+        values = [
+            b'\x00bytes',
+            {"data": b'{"a":1}', "expires": datetime.date(2024, 1, 2), "key": None},
+            [b'a', b'', {"$bytes": "not bytes"}, datetime.datetime(2024, 1, 2, 3, 4, 5)],
+            {"$date": b'', "$$ref": {"$datetime": 1}, "key": [{"$": None}]},
+            "text"
+        ]
+        for value in values:
+            self.assertEqual(value, decode_value(encode_value(value)))
+        with self.assertRaises(TypeError):
+            encode_value({"set": {1}})
+        with self.assertRaises(ValueError):
+            # pickled values are not decoded
+            decode_value(b'\x80\x04K\x01.')
+
+    def test_table(self):
+        table = self.table()
+        self.assertIsNone(table.get(b'a'))
+        self.assertTrue(table.set(b'a', b'value', 60))
+        self.assertEqual(b'value', table.get(b'a'))
+        self.assertTrue(table.set(b'a', b'new', 60))
+        self.assertEqual(b'new', table.get(b'a'))
+
+        # shared with other tables on the same file
+        self.assertEqual(b'new', self.table().get(b'a'))
+
+        table.invalidate(b'a')
+        self.assertIsNone(table.get(b'a'))
+        self.assertFalse(table.set(b'large', b'x' * 1024, 60))
+        self.assertEqual(1, table.stats()["too_large"])
+
+    def test_expiry(self):
+        table = self.table()
+        with patch('shared_cache.time.time', return_value=1000):
+            table.set(b'a', b'value', 60)
+        with patch('shared_cache.time.time', return_value=1059):
+            self.assertEqual(b'value', table.get(b'a'))
+        with patch('shared_cache.time.time', return_value=1061):
+            self.assertIsNone(table.get(b'a'))
+
+    def test_eviction(self):
+        # single bucket of two slots
+        table = self.table(slots=2, ways=2)
+        with patch('shared_cache.time.time', return_value=1000):
+            table.set(b'a', b'1', 60)
+        with patch('shared_cache.time.time', return_value=1001):
+            table.set(b'b', b'2', 60)
+        with patch('shared_cache.time.time', return_value=1002):
+            table.get(b'a')
+            table.set(b'c', b'3', 60)
+            self.assertEqual(b'1', table.get(b'a'))
+            self.assertIsNone(table.get(b'b'), 'Least recently used key was not evicted')
+            self.assertEqual(b'3', table.get(b'c'))
+
+            table.clear(b'a')
+            self.assertIsNone(table.get(b'a'))
+            self.assertEqual(b'3', table.get(b'c'))
+        self.assertEqual(1, table.stats()["evictions"])
+
+    def test_seqlock(self):
+        table = self.table(slots=1, ways=1)
+        table.set(b'a', b'value', 60)
+        seq = struct.unpack_from('<I', table.mmap, 0)[0]
+        self.assertEqual(0, seq % 2)
+
+        # being written
+        struct.pack_into('<I', table.mmap, 0, seq + 1)
+        self.assertIsNone(table.get(b'a'))
+        struct.pack_into('<I', table.mmap, 0, seq)
+        self.assertEqual(b'value', table.get(b'a'))
+
+        # written while being read
+        table.mmap = TornBuffer(table.mmap[:])
+        self.assertIsNone(table.get(b'a'))
+
+    def test_concurrent_writes(self):
+        values = [b'a' * 100, b'b' * 700, b'c' * 10]
+        path = os.path.join(self.directory, 'cache')
+        table = self.table()
+        table.set(b'key', values[0], 60)
+        writer = multiprocessing.get_context('fork').Process(
+            target=write_values, args=(path, values, 20000)
+        )
+        writer.start()
+        reads = set()
+        while writer.is_alive():
+            value = table.get(b'key')
+            self.assertIn(value, values + [None], 'Torn read')
+            reads.add(value)
+        writer.join()
+        self.assertEqual(0, writer.exitcode)
+        self.assertIn(table.get(b'key'), values)
+
+    def test_shared_cache(self):
+        table = self.table()
+        cache = SharedCache(table, 'default:resolve', 10, 60)
+        other = SharedCache(table, 'default:resolve', 10, 60)
+        entry = {"data": b'{"a":1}', "expires": datetime.date(2024, 1, 2)}
+        cache.set('key', entry)
+        self.assertEqual(entry, other.get('key'))
+        self.assertIsNone(SharedCache(table, 'other:resolve').get('key'))
+
+        long_key = 'k' * 100
+        cache.set(long_key, b'long')
+        self.assertEqual(b'long', other.get(long_key))
+
+        # too large for the table, cached in this process
+        cache.set('large', b'x' * 1024)
+        self.assertEqual(b'x' * 1024, cache.get('large'))
+        self.assertIsNone(other.get('large'))
+
+        cache.invalidate('key')
+        self.assertIsNone(other.get('key'))
+        cache.clear()
+        self.assertIsNone(other.get(long_key))
+        self.assertEqual(0, cache.stats()["local_size"])
+
+    def test_private_dir(self):
+        self.assertEqual(self.directory, private_dir(self.tmpdir.name))
+        self.assertEqual(0o700, os.stat(self.directory).st_mode & 0o777)
+
+        os.chmod(self.directory, 0o755)
+        with self.assertRaises(PermissionError):
+            private_dir(self.tmpdir.name)
+        os.chmod(self.directory, 0o700)
+
+        path = os.path.join(self.directory, 'cache')
+        with open(path, 'w'):
+            pass
+        os.chmod(path, 0o644)
+        with self.assertRaises(PermissionError):
+            self.table()
+
+    def test_cache_factory(self):
+        logger = logging.getLogger()
+        self.assertIsInstance(cache_factory({}, 'default', logger)('resolve', 10, 60), TTLCache)
+        make_cache = cache_factory(
+            {'shared_cache': 'mmap', 'shared_cache_dir': self.tmpdir.name, 'shared_cache_slots': 16},
+            'default', logger
+        )
+        cache = make_cache('resolve', 10, 60)
+        self.assertIsInstance(cache, SharedCache)
+        cache.set('key', b'value')
+        self.assertEqual(b'value', make_cache('resolve', 10, 60).get('key'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'cache-16x4096')))
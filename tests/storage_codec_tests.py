@@ -0,0 +1,71 @@
+import json
+import logging
+import unittest
+
+import storage_codec
+from storage_codec import StorageCodec
+
+
+class StorageCodecTestCase(unittest.TestCase):
+    """Test case for the codec of stored payloads"""
+
+    PAYLOAD = {"url": "http://www.example.com/?layers=a,b", "description": "Zürich " * 200}
+
+    def test_json(self):
+        codec = StorageCodec("json")
+        text = codec.encode(self.PAYLOAD)
+        self.assertTrue(text.startswith('{'))
+        self.assertTrue(text.isascii(), 'Non-ASCII characters were not escaped')
+        self.assertIn('Z\\u00fcrich', text)
+        self.assertEqual(self.PAYLOAD, StorageCodec.decode(text))
+        self.assertTrue(codec.is_encoded(text))
+
+    def test_zlib(self):
+        codec = StorageCodec("zlib", min_size=100)
+        text = codec.encode(self.PAYLOAD)
+        self.assertTrue(text.startswith(storage_codec.ZLIB_MARKER))
+        self.assertLess(len(text), len(StorageCodec("json").encode(self.PAYLOAD)))
+        self.assertEqual(self.PAYLOAD, StorageCodec.decode(text))
+        self.assertTrue(codec.is_encoded(text))
+        self.assertFalse(StorageCodec("json").is_encoded(text))
+
+        # small payloads are stored as plain JSON
+        text = codec.encode({"a": "ü"})
+        self.assertEqual('{"a":"\\u00fc"}', text)
+        self.assertTrue(codec.is_encoded(text))
+
+    @unittest.skipIf(storage_codec.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        codec = StorageCodec("zstd", min_size=100)
+        text = codec.encode(self.PAYLOAD)
+        self.assertTrue(text.startswith(storage_codec.ZSTD_MARKER))
+        self.assertEqual(self.PAYLOAD, StorageCodec.decode(text))
+        self.assertFalse(StorageCodec("zlib").is_encoded(text))
+
+    @unittest.skipIf(storage_codec.zstandard is not None, "zstandard is installed")
+    def test_zstd_fallback(self):
+        self.assertEqual("zlib", StorageCodec("zstd", logger=logging.getLogger()).codec)
+
+    def test_legacy_rows(self):
+        # rows written before the codec, with non-canonical JSON and
+        # unescaped non-ASCII characters
+        for text in ['{ "a": [1, 2.5], "b": null }', '{"description": "Zürich"}', '[]']:
+            self.assertEqual(json.loads(text), StorageCodec.decode(text))
+            self.assertEqual(text.encode('utf-8'), StorageCodec.decode_bytes(text))
+
+        codec = StorageCodec("zlib", min_size=100)
+        legacy = '{"description": "%s"}' % ("x" * 200)
+        self.assertFalse(codec.is_encoded(legacy), 'Large legacy row would not be compressed')
+        self.assertTrue(codec.is_encoded('{"description": "x"}'))
+        self.assertEqual(
+            StorageCodec.decode(legacy),
+            StorageCodec.decode(codec.encode_json(StorageCodec.decode_bytes(legacy)))
+        )
+
+    def test_delta(self):
+        text = storage_codec.DELTA_MARKER + '12:[]'
+        self.assertTrue(StorageCodec.is_delta(text))
+        self.assertFalse(StorageCodec.is_delta('{"a":1}'))
+        self.assertTrue(StorageCodec("zlib").is_encoded(text))
+        with self.assertRaises(Exception):
+            StorageCodec.decode(text)
@@ -0,0 +1,207 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+from key_allocator import KeyAllocator
+from storage import MemoryStorage, SQLiteStorage
+
+
+class StorageTests:
+    """Tests of the Storage interface, run for each backend"""
+
+    def create_storage(self, config):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage = self.create_storage({})
+        self.today = datetime.date.today()
+
+    def date(self, days=0):
+        return (self.today + datetime.timedelta(days=days)).isoformat()
+
+    def test_permalinks(self):
+        results = self.storage.store_permalinks(
+            ['{"a":1}', '{"a":2}'], None, self.date(), None, 'admins'
+        )
+        self.assertEqual(2, len(results))
+        keys = [key for key, expires in results]
+        self.assertTrue(all(keys), 'No key allocated')
+        self.assertNotEqual(keys[0], keys[1])
+
+        entries = self.storage.get_permalinks(keys + ['unknown'])
+        self.assertEqual(set(keys), set(entries))
+        self.assertEqual('{"a":2}', entries[keys[1]]["data"])
+        self.assertEqual('admins', entries[keys[1]]["permitted_group"])
+        self.assertIsNone(entries[keys[1]]["expires"])
+
+        self.assertEqual(set(keys), set(self.storage.keys('permalinks')))
+        self.assertEqual(set(), set(self.storage.keys('permalinks', self.today + datetime.timedelta(days=1))))
+
+    def test_expired_permalinks(self):
+        (expired, expires), = self.storage.store_permalinks(
+            ['{"a":1}'], None, self.date(-2), self.date(-1), None
+        )
+        (valid, expires), = self.storage.store_permalinks(
+            ['{"a":2}'], None, self.date(), self.date(1), None
+        )
+        entries = self.storage.get_permalinks([expired, valid])
+        self.assertEqual([valid], list(entries))
+        self.assertEqual(self.today + datetime.timedelta(days=1), entries[valid]["expires"])
+
+        self.assertEqual(1, self.storage.purge_expired_permalinks(100))
+        self.assertEqual([valid], list(self.storage.keys('permalinks')))
+
+    def test_dedup_permalinks(self):
+        self.storage = self.create_storage({'dedup_permalinks': True})
+        first = self.storage.store_permalinks(['{"a":1}'], ['hash1'], self.date(), self.date(1), None)
+        second = self.storage.store_permalinks(
+            ['{"a":1}', '{"a":2}'], ['hash1', 'hash2'], self.date(), self.date(2), None
+        )
+        self.assertEqual(first[0][0], second[0][0], 'Identical payload was not reused')
+        self.assertEqual(self.date(2), second[0][1], 'Expiry of reused permalink was not extended')
+        self.assertNotEqual(second[0][0], second[1][0])
+
+    def test_user_permalink(self):
+        self.assertIsNone(self.storage.get_user_permalink('demo'))
+        self.storage.set_user_permalink('demo', '{"a":1}', self.date())
+        self.storage.set_user_permalink('demo', '{"a":2}', self.date())
+        self.assertEqual('{"a":2}', self.storage.get_user_permalink('demo'))
+
+    def test_bookmarks(self):
+        storage = self.storage
+        own = storage.insert_bookmark('bookmarks', 'demo', '{"a":1}', self.date(), 'own', 'theme', False)
+        public = storage.insert_bookmark('bookmarks', 'admin', '{"a":2}', self.date(), 'public', None, True)
+        private = storage.insert_bookmark('bookmarks', 'admin', '{"a":3}', self.date(), 'private', None, False)
+
+        items = list(storage.list_bookmarks('bookmarks', 'demo'))
+        self.assertEqual(['own', 'public'], [item["description"] for item in items])
+        self.assertEqual([True, False], [bool(item["own"]) for item in items])
+        self.assertEqual([], list(storage.list_bookmarks('visibility_presets', 'demo')))
+
+        self.assertEqual('{"a":1}', storage.get_bookmark('bookmarks', 'demo', own)["data"])
+        self.assertEqual('theme', storage.get_bookmark('bookmarks', 'demo', own)["theme_id"])
+        self.assertTrue(storage.get_bookmark('bookmarks', 'demo', public)["public"])
+        self.assertIsNone(storage.get_bookmark('bookmarks', 'demo', private))
+        self.assertIsNone(storage.get_bookmark('visibility_presets', 'demo', own))
+
+        self.assertFalse(storage.update_bookmark(
+            'bookmarks', 'demo', public, {"description": "edited"}, False
+        ))
+        self.assertTrue(storage.update_bookmark(
+            'bookmarks', 'demo', public, {"description": "edited"}, True
+        ))
+        self.assertFalse(storage.update_bookmark(
+            'bookmarks', 'demo', private, {"description": "edited"}, True
+        ))
+        self.assertEqual(
+            ['edited', 'own'],
+            [item["description"] for item in storage.list_bookmarks('bookmarks', 'demo')]
+        )
+
+        self.assertFalse(storage.delete_bookmark('bookmarks', 'demo', private, True))
+        self.assertTrue(storage.delete_bookmark('bookmarks', 'demo', own, False))
+        self.assertIsNone(storage.get_bookmark('bookmarks', 'demo', own))
+
+    def test_bookmark_pages(self):
+        storage = self.storage
+        for i in range(5):
+            storage.insert_bookmark(
+                'bookmarks', 'demo', '{}', self.date(-i % 2), 'bookmark %d' % i, None, False
+            )
+        items = list(storage.list_bookmarks('bookmarks', 'demo'))
+        self.assertEqual(5, len(items))
+
+        pages = []
+        after = None
+        while True:
+            page = list(storage.list_bookmarks('bookmarks', 'demo', after, 3))
+            pages.append([item["key"] for item in page[0:2]])
+            if len(page) <= 2:
+                break
+            after = storage.keyset.cursor(page[1])
+        self.assertEqual([item["key"] for item in items], sum(pages, []))
+        self.assertEqual(
+            [item["key"] for item in items],
+            [item["key"] for item in storage.list_bookmarks('bookmarks', 'demo', stream=True)]
+        )
+        with self.assertRaises(ValueError):
+            list(storage.list_bookmarks('bookmarks', 'demo', 'invalid'))
+
+    def test_bookmark_bases(self):
+        storage = self.storage
+        self.assertIsNone(storage.latest_bookmark_base('bookmarks', 'demo', ''))
+        base_ids = [
+            storage.insert_bookmark_base('bookmarks', 'demo', '', '{"b":%d}' % i, self.date())
+            for i in range(4)
+        ]
+        self.assertEqual((base_ids[-1], '{"b":3}'), storage.latest_bookmark_base('bookmarks', 'demo', ''))
+        self.assertEqual('{"b":0}', storage.get_bookmark_base(base_ids[0]))
+
+        # delta encoded public bookmark of another user against the first base
+        storage.insert_bookmark(
+            'bookmarks', 'admin', 'd1:%d:[]' % base_ids[0], self.date(), 'public', None, True
+        )
+        self.assertEqual(1, storage.purge_bookmark_bases('bookmarks', 'demo', ''))
+        self.assertEqual('{"b":0}', storage.get_bookmark_base(base_ids[0]))
+        self.assertIsNone(storage.get_bookmark_base(base_ids[1]))
+        self.assertEqual('{"b":2}', storage.get_bookmark_base(base_ids[2]))
+
+        # reference dropped by an update
+        key = storage.insert_bookmark(
+            'bookmarks', 'demo', 'd1:%d:[]' % base_ids[2], self.date(), 'delta', None, False
+        )
+        storage.insert_bookmark_base('bookmarks', 'demo', '', '{"b":4}', self.date())
+        self.assertEqual(0, storage.purge_bookmark_bases('bookmarks', 'demo', ''))
+        storage.update_bookmark('bookmarks', 'demo', key, {"data": '{"b":2}'}, False)
+        self.assertEqual(1, storage.purge_bookmark_bases('bookmarks', 'demo', ''))
+        self.assertIsNone(storage.get_bookmark_base(base_ids[2]))
+
+
+class MemoryStorageTestCase(StorageTests, unittest.TestCase):
+    """Test case for the memory storage"""
+
+    def create_storage(self, config):
+        return MemoryStorage(config, KeyAllocator(), logging.getLogger())
+
+
+class SQLiteStorageTestCase(StorageTests, unittest.TestCase):
+    """Test case for the SQLite storage"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create_storage(self, config):
+        db = create_engine('sqlite:///%s' % os.path.join(self.tmpdir.name, 'permalinks.db'))
+        self.addCleanup(db.dispose)
+        return SQLiteStorage(db, config | {'store_bookmarks_by_userid': False}, KeyAllocator(), logging.getLogger())
+
+    def test_base_id_migration(self):
+        db = create_engine('sqlite:///%s' % os.path.join(self.tmpdir.name, 'old.db'))
+        self.addCleanup(db.dispose)
+        with db.begin() as connection:
+            connection.execute(sql_text("""
+                CREATE TABLE user_bookmarks (
+                    username varchar NOT NULL, data text, key varchar(10) NOT NULL,
+                    date date, description text, theme_id varchar,
+                    public boolean DEFAULT FALSE, PRIMARY KEY (username, key)
+                )
+            """))
+            connection.execute(sql_text("""
+                INSERT INTO user_bookmarks (username, data, key) VALUES
+                ('demo', 'd1:12:[]', 'a'), ('demo', '{}', 'b')
+            """))
+        storage = SQLiteStorage(db, {}, KeyAllocator(), logging.getLogger())
+        self.assertNotIn('bookmarks', storage.check_tables(True))
+        with db.connect() as connection:
+            self.assertEqual([('a', 12), ('b', None)], connection.execute(
+                sql_text("SELECT key, base_id FROM user_bookmarks ORDER BY key")
+            ).all())
@@ -0,0 +1,51 @@
+import logging
+import unittest
+from unittest.mock import Mock, patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text as sql_text
+
+import server
+from key_allocator import KeyAllocator
+from storage import SQLiteStorage
+from tenant_context import TenantContext
+
+
+class TenantContextTestCase(unittest.TestCase):
+    """Test case for the per-tenant request context"""
+
+    def test_reused(self):
+        with server.app.test_request_context():
+            ctx = server.tenant_context()
+        with server.app.test_request_context():
+            self.assertIs(ctx, server.tenant_context(), 'Context was rebuilt')
+
+    def test_permissions(self):
+        ctx = TenantContext('default', {'storage_backend': 'memory'}, None, logging.getLogger())
+        self.assertIsNone(ctx.stats()["permissions"])
+        with patch('tenant_context.PermissionsCache') as PermissionsCache:
+            self.assertIs(ctx.permissions, ctx.permissions)
+        PermissionsCache.assert_called_once_with('default', ctx.logger, 300, 1000)
+
+    def test_group_commit(self):
+        logger = logging.getLogger()
+        ctx = TenantContext('default', {'storage_backend': 'memory'}, None, logger)
+        self.assertIsNone(ctx.group_commit, 'Group commit is enabled by default')
+        self.assertIsNone(ctx.stats()["group_commit"])
+
+        ctx = TenantContext('default', {
+            'storage_backend': 'memory', 'group_commit': True, 'group_commit_timeout': 1
+        }, None, logger)
+        self.assertIs(ctx.storage, ctx.group_commit.storage)
+        self.assertEqual(1, ctx.group_commit.timeout)
+
+    def test_statements(self):
+        db = create_engine('sqlite://')
+        self.addCleanup(db.dispose)
+        storage = SQLiteStorage(db, {}, KeyAllocator(), logging.getLogger())
+        build = Mock(side_effect=lambda: sql_text("SELECT 1"))
+        sql = storage.statement(('select', 'a'), build)
+        self.assertIs(sql, storage.statement(('select', 'a'), build))
+        self.assertIsNot(sql, storage.statement(('select', 'b'), build))
+        self.assertEqual(2, build.call_count)
+        self.assertEqual('select', sql.get_execution_options()["statement_name"])
@@ -0,0 +1,59 @@
+import logging
+import unittest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import text as sql_text
+
+from key_allocator import KeyAllocator
+from storage import PostgresStorage
+
+
+class UserIdCacheTestCase(unittest.TestCase):
+    """Test case for the cached user IDs of bookmark queries"""
+
+    def setUp(self):
+        self.db = create_engine('sqlite://')
+        event.listen(self.db, 'connect', lambda connection, record: connection.execute(
+            "ATTACH DATABASE ':memory:' AS qwc_config"
+        ))
+        with self.db.begin() as connection:
+            connection.execute(sql_text("CREATE TABLE qwc_config.users (id integer, name text)"))
+            connection.execute(sql_text(
+                "CREATE TABLE qwc_config.user_bookmarks (key text, user_id integer, public boolean)"
+            ))
+            connection.execute(sql_text("INSERT INTO qwc_config.users VALUES (1, 'demo')"))
+        self.storage = PostgresStorage(self.db, {}, KeyAllocator(), logging.getLogger())
+
+    def tearDown(self):
+        self.db.dispose()
+
+    def user_id(self, username):
+        with self.db.connect() as connection:
+            return self.storage.user_params(connection, username).get("user_id")
+
+    def test_cached(self):
+        self.assertEqual(1, self.user_id('demo'))
+        with self.db.begin() as connection:
+            connection.execute(sql_text("UPDATE qwc_config.users SET id = 2"))
+        self.assertEqual(1, self.user_id('demo'))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 1}, {
+            key: self.storage.stats()["user_ids"][key] for key in ("size", "hits", "misses")
+        })
+
+        # stale ID is invalidated if no bookmark was deleted
+        self.assertFalse(self.storage.delete_bookmark('bookmarks', 'demo', 'unknown', False))
+        self.assertEqual(2, self.user_id('demo'))
+
+    def test_unknown_user(self):
+        self.assertIsNone(self.user_id('admin'))
+        with self.db.begin() as connection:
+            connection.execute(sql_text("INSERT INTO qwc_config.users VALUES (3, 'admin')"))
+        self.assertEqual(3, self.user_id('admin'), 'Unknown user was cached')
+
+    def test_username_mode(self):
+        storage = PostgresStorage(
+            self.db, {'store_bookmarks_by_userid': False}, KeyAllocator(), logging.getLogger()
+        )
+        with self.db.connect() as connection:
+            self.assertEqual({"username": "demo"}, storage.user_params(connection, 'demo'))
+        self.assertEqual(0, storage.stats()["user_ids"]["misses"])